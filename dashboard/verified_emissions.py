@@ -50,15 +50,19 @@ import plotly.graph_objs as go
 holding = pd.read_csv("data_holding_account.csv")
 
 
-holding[holding.columns[29:]] = holding[holding.columns[29:]].replace(
+# The quantities are scraped as numbers (TypeCoercionPipeline), only the files scraped before hold them as text
+# ('1,234'), these columns are cleaned
+text_columns = [c for c in holding.columns[29:] if holding[c].dtype == object]
+
+holding[text_columns] = holding[text_columns].replace(
     "[^0-9\.]+", "", regex=True
 )
 
 # Replace empty strings with NaN values
-holding[holding.columns[29:]] = holding[holding.columns[29:]].replace("", np.nan)
+holding[text_columns] = holding[text_columns].replace("", np.nan)
 
 # Convert columns to float
-holding[holding.columns[29:]] = holding[holding.columns[29:]].astype(float)
+holding[text_columns] = holding[text_columns].astype(float)
 
 holding_type = holding.groupby(["Main_Activity_Type"]).sum().reset_index()
 holding_type_mean = holding.groupby(["Main_Activity_Type"]).mean().reset_index()
@@ -0,0 +1,219 @@
+"""
+Benchmark of the parse callbacks of the spiders over the HTML pages saved in the 'fixtures' directory, compared to a
+stored baseline.
+
+Each callback is run on a fresh copy of its page (the HTML is parsed again each time) by a spider built as for a
+crawl, and its time per page and per row is measured: the rows are the transactions of transaction_spider.parse, the
+accounts (requests of compliance pages) of europa_spider.parse and the compliance years of
+europa_spider.parse_compliances, with a single EU table and with both an EU and a CH table.
+
+The timings depend on the machine, so each callback is also compared to a reference timed on the same page: the former
+extraction with one CSS query per cell (see bench_parsers.py), which does not change. The baseline.json of the
+repository holds the time of each callback relative to its reference, and a callback whose relative time got slower
+than the baseline by more than the tolerance, or which yields another number of rows, makes the benchmark fail (exit
+code 1). The baseline is saved again with --save once a change of a parser is accepted. From the scrapy_scraper
+directory:
+    python benchmarks/bench_callbacks.py --save
+    python benchmarks/bench_callbacks.py --tolerance 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+from types import AsyncGeneratorType
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_parsers import ACCOUNT_ROWS_CSS, TRANSACTION_ROWS_CSS, css_compliances, css_rows  # noqa: E402
+from scrapy_scraper.spiders.europa_spider import ACCOUNT_COLUMNS, ACCOUNT_TABLE, europa_spider  # noqa: E402
+from scrapy_scraper.spiders.transaction_spider import TRANSACTION_COLUMNS, transaction_spider  # noqa: E402
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(BENCHMARKS, "fixtures")
+BASELINE = os.path.join(BENCHMARKS, "baseline.json")
+
+
+def load_response(name, meta=None):
+    """Build a response from a saved page, with the request (and its meta) the callback expects."""
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        body = f.read()
+    url = f"https://ec.europa.eu/clima/ets/{name}"
+    return HtmlResponse(url=url, body=body, encoding="utf-8", request=Request(url, meta=meta or {}))
+
+
+def fresh(response):
+    """Copy of a response whose HTML is not parsed yet."""
+    return response.replace(body=response.body)
+
+
+def run_callback(callback, response):
+    """Run a callback to the end and get what it yields, driving the asynchronous callbacks without an event loop (they
+    do not wait for anything)."""
+    results = callback(response)
+    if not isinstance(results, AsyncGeneratorType):
+        return list(results or ())
+    collected = []
+    while True:
+        try:
+            results.__anext__().send(None)
+        except StopIteration as result:
+            collected.append(result.value)
+        except StopAsyncIteration:
+            return collected
+
+
+def make_spider(spidercls):
+    """Build a spider as for a crawl (without its frontier, as when the dead letters are replayed)."""
+    crawler = get_crawler(spidercls)
+    return spidercls.from_crawler(crawler)
+
+
+def count_items(results):
+    return sum(1 for result in results if not isinstance(result, Request))
+
+
+def count_requests(results):
+    return sum(1 for result in results if isinstance(result, Request))
+
+
+def count_compliance_years(results):
+    return sum(1 for item in results for key in item if key.endswith("_Compliance_Code"))
+
+
+def first_account():
+    """The data of the first account of the table of accounts, given to parse_compliances by parse."""
+    response = load_response("oha_listing.html")
+    return next(data for _, data in ACCOUNT_TABLE.extract(response.selector.root))
+
+
+def reference_transactions(response):
+    return css_rows(response, TRANSACTION_ROWS_CSS, TRANSACTION_COLUMNS)
+
+
+def reference_accounts(response):
+    return css_rows(response, ACCOUNT_ROWS_CSS, ACCOUNT_COLUMNS)
+
+
+# name: (spider, callback, page, meta of the request, counter of the rows in the results, reference extraction)
+CASES = {
+    "transaction_spider.parse": (
+        transaction_spider, "parse", "transaction_listing.html", lambda: {"page": 2}, count_items,
+        reference_transactions,
+    ),
+    "europa_spider.parse": (
+        europa_spider, "parse", "oha_listing.html", lambda: {"page": 1}, count_requests, reference_accounts,
+    ),
+    "europa_spider.parse_compliances (EU)": (
+        europa_spider, "parse_compliances", "compliance_single.html", lambda: {"dico_table_data": first_account()},
+        count_compliance_years, css_compliances,
+    ),
+    "europa_spider.parse_compliances (EU+CH)": (
+        europa_spider, "parse_compliances", "compliance_dual.html", lambda: {"dico_table_data": first_account()},
+        count_compliance_years, css_compliances,
+    ),
+}
+
+
+def time_runs(functions, response, number, repeat):
+    """Time functions on fresh copies of a page, in turn at each repetition so that a change of the load of the machine
+    affects all of them.
+
+    Returns:
+        list: the times of the functions (seconds per run) at each repetition.
+    """
+    timers = [timeit.Timer(lambda function=function: function(fresh(response))) for function in functions]
+    return [[timer.timeit(number) / number for timer in timers] for _ in range(repeat)]
+
+
+def bench(name, number, repeat):
+    """Time a callback and its reference on their page.
+
+    Args:
+        name (str): the name of the case in CASES.
+        number (int): the number of runs of the callback timed together.
+        repeat (int): the number of times the runs are timed.
+
+    Returns:
+        dict: the number of rows of the page, the best time per page (ms) and per row (us), the best time per page of
+        the reference (ms) and the median over the repetitions of the time of the callback relative to the reference.
+    """
+    spidercls, callback_name, page, meta, count_rows, reference = CASES[name]
+    callback = getattr(make_spider(spidercls), callback_name)
+    response = load_response(page, meta())
+    rows = count_rows(run_callback(callback, fresh(response)))
+    timings = time_runs((lambda r: run_callback(callback, r), reference), response, number, repeat)
+    best, reference_best = (min(times) for times in zip(*timings))
+    return {
+        "rows": rows,
+        "ms_per_page": round(best * 1e3, 4),
+        "us_per_row": round(best * 1e6 / max(rows, 1), 2),
+        "reference_ms_per_page": round(reference_best * 1e3, 4),
+        # the median of the repetitions is steadier than the ratio of the best times
+        "relative": round(statistics.median(time / reference_time for time, reference_time in timings), 4),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Compare the result of a case to its baseline.
+
+    Returns:
+        str: the regression, None if there is none (or no baseline).
+    """
+    if baseline is None:
+        return None
+    if result["rows"] != baseline["rows"]:
+        return f"{result['rows']} rows instead of {baseline['rows']}"
+    if result["relative"] > baseline["relative"] * (1 + tolerance):
+        slowdown = result["relative"] / baseline["relative"] - 1
+        return f"{slowdown:.0%} slower than the baseline ({baseline['relative']:.3f} x the reference)"
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the parse callbacks against a baseline")
+    parser.add_argument("--baseline", default=BASELINE, help="JSON file of the baseline (default: baseline.json)")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown of the time per page tolerated before failing (default: 0.2 for 20%%)")
+    parser.add_argument("--number", type=int, default=20, help="runs of a callback timed together (default: 20)")
+    parser.add_argument("--repeat", type=int, default=25, help="repetitions of the timings (default: 25)")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["callbacks"]
+
+    results, regressions = {}, 0
+    for name in CASES:
+        result = results[name] = bench(name, args.number, args.repeat)
+        regression = compare(result, baseline.get(name), args.tolerance)
+        reference = baseline.get(name)
+        change = f" ({result['relative'] / reference['relative'] - 1:+.0%})" if reference else ""
+        print(
+            f"{name:<42} {result['rows']:>4} rows {result['ms_per_page']:8.3f} ms/page "
+            f"{result['us_per_row']:8.1f} us/row {result['relative']:6.3f} x reference{change:<7}"
+            f"{'  REGRESSION: ' + regression if regression else ''}"
+        )
+        regressions += regression is not None
+
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "callbacks": results}, f,
+                      indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+    elif not baseline:
+        print(f"No baseline in {args.baseline}, save one with --save")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
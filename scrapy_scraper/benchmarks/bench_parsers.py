@@ -0,0 +1,166 @@
+"""
+Benchmark of the parsing of the pages of the EU ETS registry, over the HTML pages saved in the 'fixtures' directory.
+
+For each page, the former extraction (one CSS query per cell) is compared to the single-pass extraction of
+scrapy_scraper.extractors, both starting from the raw body of the page, and the extracted data is checked to be
+identical. The compliance pages are measured with a single EU table and with both an EU and a CH table.
+
+To run the benchmark, from the scrapy_scraper directory:
+    python benchmarks/bench_parsers.py
+"""
+
+import os
+import sys
+import timeit
+
+from scrapy.http import HtmlResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from scrapy_scraper.spiders.europa_spider import (  # noqa: E402
+    ACCOUNT_COLUMNS,
+    ACCOUNT_TABLE,
+    COMPLIANCE_PAGE,
+)
+from scrapy_scraper.spiders.transaction_spider import (  # noqa: E402
+    TRANSACTION_COLUMNS,
+    TRANSACTION_TABLE,
+)
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# rows of the tables of the saved pages, for the former extraction
+TRANSACTION_ROWS_CSS = "table#tblTransactionSearchResult tr:nth-child(n+3)"
+ACCOUNT_ROWS_CSS = "table#tblAccountSearchResult tr:nth-child(n+3)"
+
+
+def load_response(name):
+    """Build a response from a saved page."""
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        body = f.read()
+    return HtmlResponse(url=f"https://ec.europa.eu/clima/ets/{name}", body=body, encoding="utf-8")
+
+
+def fresh(response):
+    """Copy of a response whose HTML is not parsed yet."""
+    return response.replace(body=response.body)
+
+
+def css_rows(response, rows_css, columns):
+    """Former extraction: one CSS query per cell."""
+    return [
+        {
+            field: row.css(f"td:nth-child({column}) span::text").get(default="").strip()
+            for field, column in columns
+        }
+        for row in response.css(rows_css)
+    ]
+
+
+def single_pass_rows(response, table):
+    """Extraction of scrapy_scraper.extractors."""
+    return [data for _, data in table.extract(response.selector.root)]
+
+
+# former queries of europa_spider.parse_compliances: (row selector, columns) of the header blocks
+COMPLIANCE_HEADER_CSS = (
+    ("table#tblAccountGeneralInfo tr:nth-child(3)", (("Account_Status", 6),)),
+    (
+        "table#tblAccountContactInfo tr:nth-child(3)",
+        tuple(zip(
+            ("Type", "Legal_Entity_Identifier", "Main_Adress_Line", "Secondary_Adress_Line", "Postal_Code", "City",
+             "Country", "Telephone_1", "Telephone_2", "E-Mail_Adress"),
+            (1, 3, 4, 5, 6, 7, 8, 9, 10, 11),
+        )),
+    ),
+    (
+        "table#tblChildDetails table:nth-child(1) tr:nth-child(3)",
+        tuple(zip(
+            ("Monitoring_plan—year_of_expiry", "Name_of_Subsidiary_undertaking", "Name_of_Parent_undertaking",
+             "E-PRTR_identification", "Call_Sign_(ICAO_designator)", "First_Year_of_Emissions",
+             "Last_Year_of_Emissions"),
+            range(5, 12),
+        )),
+    ),
+)
+COMPLIANCE_METRICS = (
+    "Allowances_in_Allocation", "Verified_Emissions", "Units_Surrendered", "Cumulative_Surrendered_Units",
+    "Cumulative_Verified_Emissions", "Compliance_Code",
+)
+
+
+def css_compliances(response):
+    """Former extraction of a compliance page: one CSS query per field and per cell of the yearly tables."""
+    data = {}
+    for row_css, columns in COMPLIANCE_HEADER_CSS:
+        for field, column in columns:
+            data[field] = response.css(f"{row_css} td:nth-child({column}) span::text").get(default="").strip()
+    if response.css("[id=tblChildDetails] div:nth-child(2)") == []:
+        tables = (("EU", "[id=tblChildDetails] div table tr:nth-child(n+3)"),)
+    else:
+        tables = (
+            ("EU", "[id=tblChildDetails] div:nth-child(1) table tr:nth-child(n+3)"),
+            ("CH", "[id=tblChildDetails] div:nth-child(2) table tr:nth-child(n+5):not(:nth-last-child(-n+4))"),
+        )
+    for scheme, rows_css in tables:
+        for row in response.css(rows_css):
+            key_year = row.css("td:nth-child(2) span::text").get(default="").strip()
+            if len(key_year) == 4:
+                for cell in row.css("tr"):
+                    for column, metric in enumerate(COMPLIANCE_METRICS, start=3):
+                        data[f"{scheme}_Compliance_{key_year}_{metric}"] = (
+                            cell.css(f"td:nth-child({column}) span::text").get(default="").strip()
+                        )
+    return data
+
+
+def single_pass_compliances(response):
+    """Extraction of scrapy_scraper.extractors."""
+    return COMPLIANCE_PAGE.extract(response.selector.root)
+
+
+def bench(label, func, response, rows, number=200):
+    """Time a parsing function on a fresh copy of the page, and print the time per page and per row."""
+    best = min(
+        timeit.repeat(lambda: func(fresh(response)), number=number, repeat=5)
+    ) / number
+    print(f"{label:<45} {best * 1e3:8.3f} ms/page {best * 1e6 / max(rows, 1):8.1f} us/row")
+    return best
+
+
+def bench_table(name, rows_css, columns, table):
+    response = load_response(name)
+    expected = css_rows(fresh(response), rows_css, columns)
+    assert single_pass_rows(fresh(response), table) == expected, f"different rows for {name}"
+    print(f"{name} ({len(expected)} rows)")
+    before = bench("  css query per cell", lambda r: css_rows(r, rows_css, columns), response, len(expected))
+    after = bench("  single pass", lambda r: single_pass_rows(r, table), response, len(expected))
+    print(f"  speedup x{before / after:.1f}\n")
+
+
+def bench_compliance(name):
+    response = load_response(name)
+    expected = css_compliances(fresh(response))
+    assert list(single_pass_compliances(fresh(response)).items()) == list(expected.items()), f"different data for {name}"
+    years = sum(1 for key in expected if key.endswith("_Compliance_Code"))
+    print(f"{name} ({len(expected)} fields, {years} compliance years)")
+    before = bench("  css query per cell", css_compliances, response, years)
+    after = bench("  single pass", single_pass_compliances, response, years)
+    print(f"  speedup x{before / after:.1f}\n")
+
+
+if __name__ == "__main__":
+    bench_table(
+        "transaction_listing.html",
+        TRANSACTION_ROWS_CSS,
+        TRANSACTION_COLUMNS,
+        TRANSACTION_TABLE,
+    )
+    bench_table(
+        "oha_listing.html",
+        ACCOUNT_ROWS_CSS,
+        ACCOUNT_COLUMNS,
+        ACCOUNT_TABLE,
+    )
+    bench_compliance("compliance_single.html")
+    bench_compliance("compliance_dual.html")
@@ -0,0 +1,4 @@
+# This package contains the custom commands of the project (scrapy <command>)
+#
+# Please refer to the documentation for information on how to create custom commands:
+# https://docs.scrapy.org/en/latest/topics/commands.html#custom-project-commands
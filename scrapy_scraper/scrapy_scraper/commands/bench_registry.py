@@ -0,0 +1,187 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.conf import arglist_to_dict
+
+from scrapy_scraper import mock_registry
+from scrapy_scraper.launcher import crawl_command, process_environment
+
+SPIDERS = ("europa_spider", "transaction_spider")
+
+
+class Command(ScrapyCommand):
+    """
+        Measure the throughput of the spiders offline, against the mock of the registry (scrapy_scraper.mock_registry).
+
+        The mock is started in its own process with the given dataset, latency and error pages, then each spider is
+        run in its own 'scrapy crawl' process with REGISTRY_MIRROR pointing to the mock (transaction_spider with
+        start_date and end_date, so that its state files are left untouched). The requests and items per second come
+        from the metrics of the crawl (METRICS_JSON_FILE), the CPU time and the peak memory from the resource usage of
+        the process. The settings given with -s are passed to the spiders.
+    """
+
+    requires_project = True
+
+    def syntax(self):
+        return "[options] [spider ...]"
+
+    def short_desc(self):
+        return "Measure the throughput of the spiders against a local mock of the registry"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        group = parser.add_argument_group(title="Mock registry options")
+        mock_registry.add_arguments(group)
+        group.add_argument("--port", type=int, default=8765, help="port of the mock registry (default: 8765)")
+        parser.add_argument("-o", "--output", default=None, help="write the results to this JSON file")
+        parser.add_argument("--keep", action="store_true", help="keep the directory of the outputs of the spiders")
+
+    def run(self, args, opts):
+        spiders = args or list(SPIDERS)
+        unknown = set(spiders) - set(SPIDERS)
+        if unknown:
+            raise UsageError(f"Unknown spider(s): {', '.join(sorted(unknown))}, expected {' or '.join(SPIDERS)}")
+
+        if port_open(opts.port):
+            raise UsageError(f"Port {opts.port} is already in use, choose another one with --port", print_help=False)
+        mirror = f"http://127.0.0.1:{opts.port}"
+        server = subprocess.Popen(
+            [sys.executable, "-m", "scrapy_scraper.mock_registry", "--port", str(opts.port)]
+            + mock_registry.arguments_command_line(opts),
+            env=process_environment(),
+        )
+        directory = tempfile.mkdtemp(prefix="bench_registry-")
+        results = []
+        try:
+            wait_for_port(opts.port, server)
+            for spider in spiders:
+                result = run_spider(spider, mirror, directory, opts)
+                print(result_line(result))
+                results.append(result)
+        finally:
+            server.terminate()
+            server.wait()
+            if not opts.keep:
+                shutil.rmtree(directory)
+            else:
+                print(f"Outputs of the spiders kept in {directory}")
+
+        if opts.output:
+            with open(opts.output, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"mock_registry": mock_options(opts), "results": results},
+                    f,
+                    indent=2,
+                )
+        if any(result["returncode"] for result in results):
+            self.exitcode = 1
+
+
+def run_spider(spider, mirror, directory, opts):
+    """Run a spider against the mock registry and measure it.
+
+    Args:
+        spider (str): the name of the spider.
+        mirror (str): the URL of the mock registry.
+        directory (str): the directory of the outputs of the spider.
+        opts (argparse.Namespace): the options of the command.
+
+    Returns:
+        dict: the figures of the run.
+    """
+    metrics_file = os.path.join(directory, f"{spider}.metrics.jsonl")
+    settings = {
+        "REGISTRY_MIRROR": mirror,
+        "METRICS_JSON_FILE": metrics_file,
+        "DEAD_LETTER_ENABLED": False,
+        "DEDUP_FILE": os.path.join(directory, f"{spider}.ids.bin"),
+        "LOG_LEVEL": "WARNING",
+    }
+    settings.update(arglist_to_dict(opts.set))
+    arguments = {}
+    if spider == "transaction_spider":
+        # the whole period of the mock, the search of a window not touching the state files of the spider
+        arguments = {"start_date": "2005-01-01", "end_date": "2023-12-31"}
+    command = crawl_command(spider, os.path.join(directory, f"{spider}.csv"), arguments, settings)
+
+    start = time.monotonic()
+    process = subprocess.Popen(command, env=process_environment())
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall_seconds = time.monotonic() - start
+
+    metrics = last_metrics(metrics_file)
+    crawl_seconds = metrics.get("elapsed_seconds") or wall_seconds
+    responses = sum(figures["responses"] for figures in metrics.get("callbacks", {}).values())
+    soft_errors = sum(figures["soft_errors"] for figures in metrics.get("callbacks", {}).values())
+    items = metrics.get("items", 0)
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+    return {
+        "spider": spider,
+        "returncode": process.returncode,
+        "wall_seconds": round(wall_seconds, 2),
+        "crawl_seconds": crawl_seconds,
+        "responses": responses,
+        "soft_errors": soft_errors,
+        "items": items,
+        "requests_per_second": round(responses / crawl_seconds, 1) if crawl_seconds else None,
+        "items_per_second": round(items / crawl_seconds, 1) if crawl_seconds else None,
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_share": round(cpu_seconds / wall_seconds, 2) if wall_seconds else None,
+        # kilobytes on Linux
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+    }
+
+
+def last_metrics(path):
+    """The last snapshot of a file of JSON lines written by the CrawlMetrics extension, {} if there is none."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+    except FileNotFoundError:
+        return {}
+    return json.loads(lines[-1]) if lines else {}
+
+
+def wait_for_port(port, server, timeout=10.0):
+    """Wait until the mock registry accepts connections."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise UsageError(f"The mock registry exited with code {server.returncode}", print_help=False)
+        if port_open(port):
+            return
+        time.sleep(0.1)
+    raise UsageError(f"The mock registry is not listening on port {port} after {timeout:.0f}s", print_help=False)
+
+
+def port_open(port):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def mock_options(opts):
+    names = ("transactions", "accounts", "page_size", "latency", "latency_sigma", "soft_error_rate", "capacity", "seed")
+    return {name: getattr(opts, name) for name in names}
+
+
+def result_line(result):
+    status = "" if result["returncode"] == 0 else f" (exit code {result['returncode']})"
+    return (
+        f"{result['spider']}{status}: {result['responses']} responses, {result['items']} items in "
+        f"{result['crawl_seconds']:.1f}s ({result['requests_per_second']} req/s, {result['items_per_second']} "
+        f"items/s), {result['soft_errors']} soft errors, CPU {result['cpu_seconds']:.1f}s "
+        f"({result['cpu_share']:.0%} of a core), peak RSS {result['peak_rss_mb']} MB"
+    )
+
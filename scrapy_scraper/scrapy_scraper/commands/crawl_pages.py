@@ -0,0 +1,138 @@
+import os
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.conf import arglist_to_dict
+
+from scrapy_scraper.launcher import (
+    account_sort_key,
+    crawl_command,
+    crawl_succeeded,
+    fetch_page_count,
+    has_rows,
+    incomplete_marker,
+    merge_csv,
+    run_workers,
+    split_pages,
+    transaction_sort_key,
+)
+from scrapy_scraper.utils import mirror_url
+
+# how the CSV files of the ranges of pages of each spider are merged: (sort key of the rows, field identifying a row)
+MERGES = {
+    "europa_spider": (account_sort_key, None),
+    "transaction_spider": (transaction_sort_key, "Transaction_ID"),
+}
+
+
+class Command(ScrapyCommand):
+    """
+        Scrape the pages of a spider in parallel processes, each process scraping its own range of pages, then merge
+        them.
+
+        The number of pages of the listing (the table of accounts, or the search of transactions) is read once, then
+        split into --chunks ranges, each one scraped by its own 'scrapy crawl <spider> -a first_page=... -a
+        last_page=...' process into its own CSV file, at most --workers processes running at the same time. A single
+        process parses on a single core, with one process per core the throughput grows with the number of cores (as
+        long as the registry keeps up). The settings given with -s and the arguments given with -a are passed to every
+        process. A range whose file already exists is not scraped again, so the command can be launched again after a
+        failure. A range is failed when its process gave up pages (see extensions.IncompleteCrawlMarker) or exported
+        no row.
+    """
+
+    requires_project = True
+
+    def syntax(self):
+        return "[options] <spider>"
+
+    def short_desc(self):
+        return "Scrape ranges of pages of a spider in parallel processes and merge them"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("-a", dest="spargs", action="append", default=[], metavar="NAME=VALUE",
+                            help="set spider argument (may be repeated)")
+        parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                            help="number of processes scraping at the same time (default: number of cores)")
+        parser.add_argument("-c", "--chunks", type=int, default=None,
+                            help="number of ranges of pages (default: the number of workers)")
+        parser.add_argument("-p", "--pages", type=int, default=None,
+                            help="number of pages of the listing, read from the registry if not given")
+        parser.add_argument("-d", "--directory", default="chunks",
+                            help="directory of the CSV file of each range of pages (default: chunks)")
+        parser.add_argument("-o", "--output", default=None,
+                            help="merge the ranges of pages into this CSV file once they are all scraped")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError("Invalid -a value, use -a NAME=VALUE", print_help=False)
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        spider_name = args[0]
+        if spider_name not in MERGES:
+            raise UsageError(f"Unknown spider {spider_name}, expected {' or '.join(MERGES)}", print_help=False)
+        if "first_page" in opts.spargs or "last_page" in opts.spargs:
+            raise UsageError("The ranges of pages are given by the command, not with -a", print_help=False)
+        spidercls = self.crawler_process.spider_loader.load(spider_name)
+
+        pages = opts.pages or self.page_count(spidercls(**opts.spargs))
+        if pages is None:
+            print("The number of pages could not be read from the registry, give it with --pages.")
+            self.exitcode = 1
+            return
+        ranges = split_pages(pages, opts.chunks or opts.workers)
+        print(f"{pages} pages of {spider_name} split into {len(ranges)} ranges")
+        os.makedirs(opts.directory, exist_ok=True)
+
+        # the processes starting at the same time would race for the ports of their telnet consoles
+        settings = dict({"TELNETCONSOLE_ENABLED": False}, **arglist_to_dict(opts.set))
+        commands, parts = [], []
+        for first, last in ranges:
+            path = chunk_output(opts.directory, spider_name, first, last)
+            if os.path.exists(path):
+                continue
+            # the file only gets its final name once the range is complete
+            part = path + ".part"
+            parts.append((part, path))
+            commands.append(
+                crawl_command(
+                    spider_name,
+                    part + ":csv",
+                    dict(opts.spargs, first_page=first, last_page=last),
+                    dict(settings, INCOMPLETE_MARKER=incomplete_marker(part)),
+                )
+            )
+
+        failed = 0
+        for (part, path), returncode in zip(parts, run_workers(commands, opts.workers)):
+            # every page of a range holds rows, a range given up or without any row is scraped again
+            if crawl_succeeded(returncode, part) and has_rows(part):
+                os.replace(part, path)
+            else:
+                failed += 1
+        if failed:
+            print(f"{failed} range(s) of pages failed, launch the command again to scrape them.")
+            self.exitcode = 1
+            return
+
+        if opts.output:
+            sort_key, unique_field = MERGES[spider_name]
+            paths = [chunk_output(opts.directory, spider_name, first, last) for first, last in ranges]
+            rows = merge_csv(paths, opts.output, sort_key, unique_field)
+            print(f"{rows} rows merged into {opts.output}")
+
+    def page_count(self, spider):
+        """Read the number of pages of the listing of a spider from the registry (or its mirror)."""
+        # the first page of the search of transactions, or of the table of accounts
+        url = spider.search_url() if hasattr(spider, "search_url") else spider.start_urls
+        return fetch_page_count(mirror_url(url, self.settings.get("REGISTRY_MIRROR")), self.settings.get("USER_AGENT"))
+
+
+def chunk_output(directory, spider_name, first, last):
+    """Name of the CSV file holding the items of a range of pages."""
+    return os.path.join(directory, f"{spider_name}_pages_{first:06d}_{last:06d}.csv")
@@ -0,0 +1,89 @@
+import os
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.conf import arglist_to_dict
+
+from scrapy_scraper.launcher import (
+    crawl_command,
+    crawl_succeeded,
+    has_rows,
+    incomplete_marker,
+    load_shards,
+    merge_csv,
+    run_workers,
+    shard_output,
+    transaction_sort_key,
+)
+
+
+class Command(ScrapyCommand):
+    """
+        Scrape the shards of the transactions in parallel processes, then merge them.
+
+        Each shard is scraped by its own 'scrapy crawl transaction_spider -a start_date=... -a end_date=...' process,
+        into its own CSV file, the settings given with -s being passed to every process. A shard whose file already
+        exists is not scraped again, so the command can be launched again after a failure. A shard is failed when its
+        process gave up pages (see extensions.IncompleteCrawlMarker), or when it got no transaction although the
+        registry did not list it as empty ('Pages': 0): a window whose number of pages is unknown (the registry kept
+        answering with error pages) is only complete once its transactions were scraped.
+    """
+
+    requires_project = True
+
+    def syntax(self):
+        return "[options] <shards.json>"
+
+    def short_desc(self):
+        return "Scrape the shards of transaction_spider in parallel processes and merge them"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                            help="number of shards scraped at the same time (default: number of cores)")
+        parser.add_argument("-d", "--directory", default="shards",
+                            help="directory of the CSV file of each shard (default: shards)")
+        parser.add_argument("-o", "--output", default=None,
+                            help="merge the shards into this CSV file once they are all scraped")
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        shards = load_shards(args[0])
+        os.makedirs(opts.directory, exist_ok=True)
+
+        commands, parts = [], []
+        for shard in shards:
+            path = shard_output(opts.directory, shard)
+            if os.path.exists(path):
+                continue
+            # the file only gets its final name once the shard is complete
+            part = path + ".part"
+            parts.append((shard, part, path))
+            commands.append(
+                crawl_command(
+                    "transaction_spider",
+                    part + ":csv",
+                    {"start_date": shard["Start_Date"], "end_date": shard["End_Date"]},
+                    dict(arglist_to_dict(opts.set), INCOMPLETE_MARKER=incomplete_marker(part)),
+                )
+            )
+
+        failed = 0
+        for (shard, part, path), returncode in zip(parts, run_workers(commands, opts.workers)):
+            if crawl_succeeded(returncode, part) and (shard["Pages"] == 0 or has_rows(part)):
+                os.replace(part, path)
+            else:
+                if shard["Pages"] is None:
+                    print(f"No transaction between {shard['Start_Date']} and {shard['End_Date']}, "
+                          "the registry did not give its number of pages.")
+                failed += 1
+        if failed:
+            print(f"{failed} shard(s) failed, launch the command again to scrape them.")
+            self.exitcode = 1
+            return
+
+        if opts.output:
+            paths = [shard_output(opts.directory, shard) for shard in shards]
+            rows = merge_csv(paths, opts.output, transaction_sort_key, "Transaction_ID")
+            print(f"{rows} transactions merged into {opts.output}")
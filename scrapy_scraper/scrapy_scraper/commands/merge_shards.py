@@ -0,0 +1,40 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from scrapy_scraper.launcher import (
+    load_shards,
+    merge_csv,
+    shard_output,
+    transaction_sort_key,
+)
+
+
+class Command(ScrapyCommand):
+    """
+        Merge the CSV files of the shards of the transactions.
+
+        The shards are merged in the order of their dates, the transactions of a shard being sorted by date and ID, so
+        the merged file does not depend on the order in which the pages or the shards were scraped.
+    """
+
+    requires_project = True
+
+    def syntax(self):
+        return "[options] <shards.json>"
+
+    def short_desc(self):
+        return "Merge the CSV files of the shards of transaction_spider"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("-d", "--directory", default="shards",
+                            help="directory of the CSV file of each shard (default: shards)")
+        parser.add_argument("-o", "--output", required=True,
+                            help="the merged CSV file")
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        paths = [shard_output(opts.directory, shard) for shard in load_shards(args[0])]
+        rows = merge_csv(paths, opts.output, transaction_sort_key, "Transaction_ID")
+        print(f"{rows} transactions merged into {opts.output}")
@@ -0,0 +1,125 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from scrapy.commands import BaseRunSpiderCommand
+from scrapy.exceptions import UsageError
+
+from scrapy_scraper.pagestore import PageArchive
+from scrapy_scraper.replay import ItemWriter, init_worker, parse_pages
+
+
+class Command(BaseRunSpiderCommand):
+    """
+        Parse again the pages archived by ArchiveMiddleware, without downloading anything.
+
+        The archived pages of the spider are split into chunks parsed by a pool of processes (one per core by default),
+        each process running the callbacks of its own instance of the spider. The items go through the item pipelines
+        to the -o / -O files, in the order the pages were archived. The requests yielded by the callbacks are not
+        downloaded: the pages they lead to were archived as well, and are parsed from the archive.
+
+        The meta that a request gets from the page leading to it (the derived_meta of the spider, e.g. the data of an
+        account in the table of accounts, given to its compliance page) was archived with the request, as extracted
+        when the page was downloaded. So that it is extracted again too, the pages of the other callbacks are parsed
+        first, and the pages of the derived callbacks then get the meta of the requests yielded by them (matched by
+        URL), the archived meta being kept for the pages no re-parsed page leads to.
+    """
+
+    requires_project = True
+
+    def syntax(self):
+        return "[options] <spider>"
+
+    def short_desc(self):
+        return "Parse again the archived pages of a spider in parallel processes"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                            help="number of processes parsing the pages (default: number of cores)")
+        parser.add_argument("--chunk", type=int, default=100,
+                            help="number of pages given at a time to a process (default: 100)")
+        parser.add_argument("--callback", action="append", default=[],
+                            help="only parse the pages of this callback of the spider (can be repeated)")
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        spider_name = args[0]
+        directory = self.settings.get("ARCHIVE_DIR")
+        archive = PageArchive(directory)
+        crawler = self.crawler_process.create_crawler(spider_name)
+        writer = ItemWriter(crawler, crawler.spidercls.from_crawler(crawler, **opts.spargs))
+        writer.open()
+        print(f"{archive.count(spider_name)} pages archived for {spider_name}")
+
+        callbacks = archive.callbacks(spider_name)
+        selected = [callback for callback in callbacks if not opts.callback or callback in opts.callback]
+        derived = getattr(crawler.spidercls, "derived_meta", {})
+        second = [callback for callback in selected if callback in derived]
+        # the pages leading to the pages of the derived callbacks are parsed even if not selected, for their requests
+        first = [callback for callback in callbacks if callback not in derived and (callback in selected or second)]
+
+        items, failed = 0, 0
+        metas = {}
+        if first:
+            (items, failed), metas = self.parse(
+                archive.pages(spider_name, first), writer, opts, selected, spider_name, directory
+            )
+        if second:
+            (second_items, second_failed), _ = self.parse(
+                archive.pages(spider_name, second), writer, opts, second, spider_name, directory, metas
+            )
+            items, failed = items + second_items, failed + second_failed
+
+        writer.close()
+        archive.close()
+        print(f"{items} items exported, {failed} pages failed")
+        if failed:
+            self.exitcode = 1
+
+    def parse(self, pages, writer, opts, export, spider_name, directory, metas=None):
+        """Parse archived pages in the pool of processes.
+
+        Args:
+            pages (iterable): the archived pages, as yielded by PageArchive.pages().
+            writer (replay.ItemWriter): the writer of the items.
+            opts (argparse.Namespace): the options of the command.
+            export (list): the callbacks whose items are exported, the other pages are only parsed for the derived
+                meta of their requests.
+            spider_name (str): the name of the spider.
+            directory (str): the location of the PageArchive.
+            metas (dict): the meta given to the requests of the pages, by URL.
+
+        Returns:
+            tuple: the number of items exported and of pages failed, and the derived meta of the requests yielded by
+            the pages, by URL.
+        """
+        chunks = iter(lambda: list(islice(pages, opts.chunk)), [])
+        counts, found = (0, 0), {}
+        with ProcessPoolExecutor(
+            max_workers=opts.workers,
+            initializer=init_worker,
+            initargs=(spider_name, opts.spargs, self.settings.copy_to_dict(), directory, metas),
+        ) as executor:
+            # a few chunks ahead per process, the archive is never loaded at once
+            running = deque()
+            for chunk in chunks:
+                running.append(executor.submit(parse_pages, chunk, export))
+                if len(running) >= 2 * opts.workers:
+                    counts = self.export(running.popleft().result(), writer, counts, found)
+            while running:
+                counts = self.export(running.popleft().result(), writer, counts, found)
+        return counts, found
+
+    def export(self, result, writer, counts, found):
+        chunk_items, failures, metas = result
+        items, failed = counts
+        for item in chunk_items:
+            if writer.write(item):
+                items += 1
+        for url, error in failures:
+            print(f"{url} failed: {error}")
+        found.update(metas)
+        return items, failed + len(failures)
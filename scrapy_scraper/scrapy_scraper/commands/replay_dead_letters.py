@@ -0,0 +1,79 @@
+from scrapy.commands import BaseRunSpiderCommand
+from scrapy.exceptions import UsageError
+from scrapy.http import Request
+
+from scrapy_scraper.pagestore import DeadLetterStore
+from scrapy_scraper.replay import ItemWriter, collect
+
+
+class Command(BaseRunSpiderCommand):
+    """
+        Parse again the pages saved by DeadLetterMiddleware.
+
+        By default the spider is launched with only the saved requests as start requests (DEAD_LETTER_REPLAY), the
+        pages being downloaded again and their items exported like with 'scrapy crawl' (-o / -O). With --offline,
+        nothing is downloaded: the saved bodies are given to the callbacks of their requests, and the items go through
+        the item pipelines to the -o / -O files. An entry is removed from the store once its page was parsed
+        successfully, except offline when its callback yields new requests (e.g. the compliance pages of a page of
+        accounts), which need a crawl.
+    """
+
+    requires_project = True
+
+    def syntax(self):
+        return "[options] <spider>"
+
+    def short_desc(self):
+        return "Parse again the pages saved in the dead letters of a spider"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--offline", action="store_true",
+                            help="parse the saved bodies instead of downloading the pages again")
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        if opts.offline:
+            self.replay_offline(args[0], opts)
+            return
+        self.settings.set("DEAD_LETTER_REPLAY", True, priority="cmdline")
+        self.crawler_process.crawl(args[0], **opts.spargs)
+        self.crawler_process.start()
+        if self.crawler_process.bootstrap_failed:
+            self.exitcode = 1
+
+    def replay_offline(self, spider_name, opts):
+        crawler = self.crawler_process.create_crawler(spider_name)
+        spider = crawler.spidercls.from_crawler(crawler, **opts.spargs)
+        store = DeadLetterStore(self.settings.get("DEAD_LETTER_STORE"))
+        writer = ItemWriter(crawler, spider)
+        writer.open()
+
+        is_soft_error = getattr(spider, "is_soft_error", lambda request, response: False)
+        parsed = items = kept = 0
+        for entry_id, request, response in store.entries(spider):
+            if response is None or is_soft_error(request, response):
+                kept += 1
+                continue
+            try:
+                output = collect(request.callback or spider.parse, response)
+            except Exception as e:
+                print(f"{request.url} still fails: {e!r}")
+                kept += 1
+                continue
+            for item in output:
+                if not isinstance(item, Request) and writer.write(item):
+                    items += 1
+            parsed += 1
+            if any(isinstance(item, Request) for item in output):
+                kept += 1
+            else:
+                store.remove(entry_id)
+
+        writer.close()
+        store.close()
+        if hasattr(spider, "closed"):
+            # not a crawl through every page: e.g. the incremental state of transaction_spider must not be saved
+            spider.closed("offline_replay")
+        print(f"{parsed} pages parsed, {items} items exported, {kept} pages left in the dead letters")
@@ -0,0 +1,154 @@
+# Embedded SQLite database of the scraped data (see DatabasePipeline)
+#
+# Each run of a spider adds its items to the same database instead of overwriting a file: the rows are keyed on the
+# natural keys of the registry (the Transaction_ID of a transaction, the registry and the installation of an account),
+# a row scraped again replacing the former values of its columns.
+
+import sqlite3
+from datetime import date
+
+from scrapy_scraper.items import ComplianceYearItem, HoldingAccountItem, TransactionItem
+
+# the key of an Operator Holding account: its registry (National_Administrator) and its installation or aircraft
+ACCOUNT_KEY = ("National_Administrator", "Installation/Aircraft_ID")
+
+
+class Table:
+    """
+        A table of the database, its columns being the fields of an item (INTEGER for the int fields, TEXT else, the
+        dates in ISO format).
+
+    Attributes:
+
+        name (str): the name of the table.
+        fields (dict): the declarations of the fields of the columns (see items.py).
+        key (tuple): the columns of the primary key.
+        indexes (tuple): the columns of each index.
+    """
+
+    def __init__(self, name, fields, key, indexes=()):
+        self.name = name
+        self.fields = fields
+        self.key = key
+        self.indexes = indexes
+
+    def create(self, db):
+        columns = ", ".join(
+            f"{quote(name)} {'INTEGER' if field.get('type') is int else 'TEXT'}" for name, field in self.fields.items()
+        )
+        db.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.name} ({columns}, PRIMARY KEY ({', '.join(map(quote, self.key))}))"
+        )
+        for columns in self.indexes:
+            db.execute(
+                f"CREATE INDEX IF NOT EXISTS {quote(self.name + '_' + '_'.join(columns))} ON {self.name} "
+                f"({', '.join(map(quote, columns))})"
+            )
+
+    def upsert(self, columns):
+        """The statement inserting rows with the given columns, or updating these columns of the existing rows."""
+        updated = [quote(column) for column in columns if column not in self.key]
+        on_conflict = "DO UPDATE SET " + ", ".join(f"{c} = excluded.{c}" for c in updated) if updated else "DO NOTHING"
+        return (
+            f"INSERT INTO {self.name} ({', '.join(map(quote, columns))}) VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT ({', '.join(map(quote, self.key))}) {on_conflict}"
+        )
+
+
+TRANSACTIONS = Table(
+    "transactions",
+    TransactionItem.fields,
+    ("Transaction_ID",),
+    (("Transaction_Date",), ("Transferring_Account_Holder",), ("Acquiring_Account_Holder",)),
+)
+
+HOLDING_ACCOUNTS = Table(
+    "holding_accounts",
+    HoldingAccountItem.fields,
+    ACCOUNT_KEY,
+    (("Account_ID",), ("Account_Holder_Name",)),
+)
+
+# the compliances are keyed on the account like the holding accounts, the Account_ID of the long output being kept too
+COMPLIANCE_YEARS = Table(
+    "compliance_years",
+    dict({name: HoldingAccountItem.fields[name] for name in ACCOUNT_KEY}, **ComplianceYearItem.fields),
+    ACCOUNT_KEY + ("Scheme", "Year"),
+    (("Account_ID",), ("Year",)),
+)
+
+
+class Database:
+    """
+        SQLite database of the transactions, the holding accounts and their compliances.
+
+        The rows are buffered and written by batches, each batch in a single transaction, with an upsert on the key
+        of their table: only the columns given for a row are updated, e.g. the Account_ID of an account scraped with
+        -a output=long is kept when it is scraped again in the wide output.
+
+    Attributes:
+
+        path (str): location of the SQLite database.
+        batch_size (int): number of rows buffered before they are written.
+    """
+
+    tables = (TRANSACTIONS, HOLDING_ACCOUNTS, COMPLIANCE_YEARS)
+
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self._db = sqlite3.connect(path)
+        for table in self.tables:
+            table.create(self._db)
+        self._db.commit()
+        self._rows = {}
+        self._pending = 0
+
+    def add(self, table, row):
+        """Buffer a row, written with the next batch.
+
+        Args:
+            table (Table): the table of the row.
+            row (dict): the values of the columns of the row.
+        """
+        columns = tuple(name for name in row if name in table.fields)
+        values = []
+        for name in columns:
+            value = row[name]
+            if value is None and name in table.key:
+                # NULL values are all different, the row would never be updated
+                value = ""
+            elif isinstance(value, date):
+                value = str(value)
+            values.append(value)
+        self._rows.setdefault((table, columns), []).append(values)
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows in a transaction."""
+        with self._db:
+            for (table, columns), rows in self._rows.items():
+                self._db.executemany(table.upsert(columns), rows)
+        self._rows = {}
+        self._pending = 0
+
+    def account_key(self, account_id):
+        """The key of an account (see ACCOUNT_KEY) from its Account_ID, None if the account is not in the database."""
+        self.flush()
+        row = self._db.execute(
+            f"SELECT {', '.join(map(quote, ACCOUNT_KEY))} FROM {HOLDING_ACCOUNTS.name} WHERE Account_ID = ?",
+            (account_id,),
+        ).fetchone()
+        return dict(zip(ACCOUNT_KEY, row)) if row is not None else None
+
+    def close(self):
+        """Write the buffered rows and close the database."""
+        self.flush()
+        self._db.close()
+
+
+def quote(name):
+    """Quote the name of a column, the names of the registry holding '/' or '—'."""
+    return '"' + name.replace('"', '""') + '"'
@@ -0,0 +1,542 @@
+# Feed exporters
+#
+# Columnar files (Parquet and Arrow IPC), registered in FEED_EXPORTERS as 'parquet' and 'arrow':
+# scrapy crawl transaction_spider -O transactions.parquet. The items are buffered into row groups, written by a
+# background thread, with a typed schema taken from the declarations of the fields in items.py. pyarrow is only
+# needed when one of these formats is used.
+#
+# CSV with the union of the fields of the items as header, registered as 'csv' in place of the exporter of Scrapy. The
+# rows are spilled to <feed>.rows.jl until the feed is closed.
+#
+# Compressed chunks of JSON lines or CSV, registered as 'jsonl-chunks' and 'csv-chunks':
+# scrapy crawl transaction_spider -O transactions.json:csv-chunks. The feed file is the manifest of the chunks.
+
+import gzip
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+from itemadapter import ItemAdapter
+from scrapy.exporters import BaseItemExporter, CsvItemExporter, JsonLinesItemExporter
+
+from scrapy_scraper.items import COMPLIANCE_COLUMN, field_metadata
+from scrapy_scraper.pipelines import coerce_value
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+class UnionCsvItemExporter(CsvItemExporter):
+    """
+        CSV exporter whose header holds the fields of all the items, instead of the fields of the first item only.
+
+        Without fields to export (FEED_EXPORT_FIELDS, or the 'fields' option of the feed), the rows are spilled as
+        JSON lines to a file next to the feed (<feed>.rows.jl, or the 'spill' option of the feed) as they are
+        exported, only the names of the columns being kept in memory, and the CSV file is written once the feed is
+        closed, with every column: the fields in the order they first appeared, then the compliance columns of
+        europa_spider sorted by scheme, year and metric (see sorted_columns), whatever the order in which the pages
+        were parsed. The spill file is deleted once the CSV file is written, unless keep_spill is set. If the crawl
+        is interrupted, it holds the rows exported so far, and a resumed crawl (see middlewares.CheckpointMiddleware,
+        which keeps the spill file until the crawl is finished) continues it instead of starting a new one. With
+        fields to export, the rows are written directly, as by the CSV exporter of Scrapy.
+
+    Attributes:
+
+        spill_batch_size (int): the number of rows buffered before they are written to the spill file
+            (item_export_kwargs of the feed, 1000 by default).
+        spill (str): the location of the spill file, None for an anonymous temporary file (a feed without a local
+            file, e.g. stdout).
+        keep_spill (bool): True to keep the spill file once the CSV file is written.
+    """
+
+    def __init__(self, file, spill_batch_size=1000, spill=None, **kwargs):
+        super().__init__(file, **kwargs)
+        self.spill_batch_size = spill_batch_size
+        name = getattr(file, "name", None)
+        if spill is None and isinstance(name, str) and not name.startswith("<"):
+            # not for stdout ('<stdout>')
+            spill = name + ".rows.jl"
+        self.spill = spill
+        self.keep_spill = False
+        self._union = not self.fields_to_export
+        self._columns = {}
+        self._rows = []
+        self._spill = None
+
+    def export_item(self, item):
+        if not self._union:
+            return super().export_item(item)
+        # all the declared fields of an Item are columns, as for the CSV exporter of Scrapy
+        for name in ItemAdapter(item).field_names():
+            self._columns.setdefault(name, None)
+        row = dict(self._get_serialized_fields(item))
+        self._columns.update(dict.fromkeys(row))
+        self._rows.append(row)
+        if len(self._rows) >= self.spill_batch_size:
+            self._spill_rows()
+
+    def flush(self):
+        """Write the buffered rows to the spill file, and the spill file to the disk."""
+        if self._rows:
+            self._spill_rows()
+        if self._spill is not None:
+            self._spill.flush()
+
+    def resume(self):
+        """Continue the spill file left by an interrupted crawl, instead of replacing it.
+
+        Returns:
+            int: the number of rows read back from the spill file.
+        """
+        if not self._union or self.spill is None or not os.path.exists(self.spill):
+            return 0
+        rows = 0
+        self._spill = open(self.spill, "r+", encoding="utf-8")
+        end = 0
+        for line in iter(self._spill.readline, ""):
+            try:
+                row = json.loads(line)
+            except ValueError:
+                # last line cut by the interruption of the crawl
+                break
+            self._columns.update(dict.fromkeys(row))
+            rows += 1
+            end = self._spill.tell()
+        self._spill.seek(end)
+        self._spill.truncate()
+        logger.info(f"Resuming the rows of {self.spill}: {rows} rows already exported")
+        return rows
+
+    def finish_exporting(self):
+        if not self._union:
+            return
+        self.flush()
+        self.fields_to_export = sorted_columns(self._columns)
+        if self.include_headers_line:
+            self.csv_writer.writerow(self.fields_to_export)
+        if self._spill is None:
+            return
+        self._spill.seek(0)
+        for line in self._spill:
+            row = json.loads(line)
+            self.csv_writer.writerow(self._build_row(row.get(name, "") for name in self.fields_to_export))
+        self._spill.close()
+        if self.spill is not None and not self.keep_spill:
+            os.remove(self.spill)
+
+    def _spill_rows(self):
+        if self._spill is None:
+            if self.spill is None:
+                self._spill = tempfile.TemporaryFile("w+", encoding="utf-8", prefix="feed-")
+            else:
+                if os.path.exists(self.spill):
+                    logger.warning(f"{self.spill} was left by an interrupted crawl, it is replaced")
+                self._spill = open(self.spill, "w+", encoding="utf-8")
+        for row in self._rows:
+            self._spill.write(json.dumps(row, default=str) + "\n")
+        self._rows = []
+
+
+def sorted_columns(names):
+    """Order of the columns of a CSV file.
+
+    Args:
+        names (iterable): the names of the columns, in the order they first appeared.
+
+    Returns:
+        list: the columns which are not compliances in their order, then the compliance columns (see
+        items.COMPLIANCE_COLUMN) by scheme (EU first, as the dashboard reads the EU columns by position), year and
+        metric, the metrics in the order they first appeared.
+    """
+    columns = []
+    compliances = []
+    metrics = {}
+    for name in names:
+        match = COMPLIANCE_COLUMN.fullmatch(name)
+        if match is None:
+            columns.append(name)
+        else:
+            scheme, year, metric = match.groups()
+            compliances.append((scheme != "EU", scheme, int(year), metrics.setdefault(metric, len(metrics)), name))
+    return columns + [name for *_, name in sorted(compliances)]
+
+
+def writes_on_close(exporter):
+    """Tell whether an exporter keeps the items until the feed is closed, instead of writing them as they come.
+
+    Args:
+        exporter (type): the class of the exporter of a feed.
+
+    Returns:
+        bool: True for the columnar exporters (a row group at a time). The union CSV without fields writes its rows
+        to its spill file as they come (see UnionCsvItemExporter.flush).
+    """
+    return issubclass(exporter, ColumnarItemExporter)
+
+
+class ColumnarItemExporter(BaseItemExporter):
+    """
+        Base of the exporters writing the items as columns, a row group at a time.
+
+        The schema is set by the first row group: the fields to export (FEED_EXPORT_FIELDS, or the 'fields' option of
+        the feed) or else the fields of the first items, each column getting the type of its field (see
+        items.field_type, text for the unknown fields), the text fields declared with dictionary=True being
+        dictionary-encoded. The columns appearing after the first row group can't be added to the file, they are
+        logged and left out (the wide output of europa_spider has new columns for each year, write it with
+        -a output=long).
+
+        The conversion of the items to columns and the writing of the file are done by a background thread, so the
+        crawl goes on while a row group is written. At most one row group is written while the next one is filled.
+
+    Attributes:
+
+        file (file): the file of the feed, opened in binary mode.
+        row_group_size (int): the number of items per row group (item_export_kwargs of the feed, 100000 by default).
+        compression (str): the compression codec of the columns ('zstd' by default).
+    """
+
+    def __init__(self, file, row_group_size=100000, compression="zstd", **kwargs):
+        if pa is None:
+            raise ImportError("the parquet and arrow feeds need pyarrow (pip install pyarrow)")
+        super().__init__(dont_fail=True, **kwargs)
+        self.file = file
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self._rows = []
+        self._columns = None
+        self._dictionaries = None
+        self._dropped = set()
+        self._writer = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="feed-writer")
+        self._pending = None
+
+    def export_item(self, item):
+        row = dict(self._get_serialized_fields(item, default_value=None, include_empty=True))
+        if self._columns is None:
+            row["__item__"] = item
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group_size:
+            self._flush()
+
+    def finish_exporting(self):
+        if self._rows:
+            self._flush()
+        self._wait()
+        if self._writer is not None:
+            self._executor.submit(self._writer.close).result()
+        self._executor.shutdown()
+
+    def _flush(self):
+        rows, self._rows = self._rows, []
+        if self._columns is None:
+            self._set_schema(rows)
+        self._wait()
+        self._pending = self._executor.submit(self._write, rows)
+
+    def _wait(self):
+        # an error of the thread is raised here, in the reactor thread
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def _set_schema(self, rows):
+        names = list(self.fields_to_export or ())
+        declarations = {}
+        for row in rows:
+            item = row.pop("__item__")
+            for name in row:
+                if name not in declarations:
+                    declarations[name] = field_metadata(item, name) or {}
+                    if not self.fields_to_export:
+                        names.append(name)
+        self._columns = []
+        fields = []
+        for name in names:
+            declaration = declarations.get(name, {})
+            value_type = declaration.get("type", str)
+            dictionary = value_type is str and declaration.get("dictionary", False)
+            self._columns.append((name, value_type, dictionary))
+            fields.append(pa.field(name, arrow_type(value_type, dictionary)))
+        self.schema = pa.schema(fields)
+        # the dictionaries only grow, so each row group only adds values to the ones already written
+        self._dictionaries = {name: {} for name, _, dictionary in self._columns if dictionary}
+
+    def _write(self, rows):
+        known = {name for name, _, _ in self._columns}
+        for row in rows:
+            for name in row.keys() - known - self._dropped:
+                logger.warning(f"The column {name} is not in the schema of the {self.format} feed, it is left out")
+                self._dropped.add(name)
+        arrays = [
+            self._array([row.get(name) for row in rows], value_type, dictionary, name)
+            for name, value_type, dictionary in self._columns
+        ]
+        batch = pa.record_batch(arrays, schema=self.schema)
+        if self._writer is None:
+            self._writer = self.open_writer(self.schema)
+        self._writer.write_batch(batch)
+
+    def _array(self, values, value_type, dictionary, name):
+        if value_type is str:
+            values = [None if value is None else str(value) for value in values]
+        else:
+            # the values which were not converted while scraping (ITEM_COERCION_ENABLED=False)
+            values = [coerce_value(value, value_type) for value in values]
+        if not dictionary:
+            return pa.array(values, type=arrow_type(value_type, False))
+        index = self._dictionaries[name]
+        indices = [None if value is None else index.setdefault(value, len(index)) for value in values]
+        return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), pa.array(list(index), pa.string()))
+
+    def open_writer(self, schema):
+        """Create the writer of the file once the schema is known, the writer having write_batch() and close()."""
+        raise NotImplementedError
+
+
+class ParquetItemExporter(ColumnarItemExporter):
+    """Write the items to a Parquet file, a row group of the file per row group of items."""
+
+    format = "parquet"
+
+    def open_writer(self, schema):
+        return pa.parquet.ParquetWriter(self.file, schema, compression=self.compression)
+
+
+class ArrowItemExporter(ColumnarItemExporter):
+    """Write the items to an Arrow IPC file (Feather v2), e.g. read with pyarrow.feather.read_table()."""
+
+    format = "arrow"
+
+    def open_writer(self, schema):
+        options = pa.ipc.IpcWriteOptions(compression=self.compression, emit_dictionary_deltas=True)
+        return pa.ipc.new_file(self.file, schema, options=options)
+
+
+class ChunkedItemExporter(BaseItemExporter):
+    """
+        Base of the exporters writing the items to compressed chunks, the feed file being the manifest of the chunks.
+
+        The chunks are written next to the manifest, in a directory named after it (transactions.json ->
+        transactions/part-00000.csv.gz), each chunk being a complete file (with its header for CSV) compressed with
+        zstd or gzip as it is written. A chunk is closed and the next one started once it holds max_items items or
+        max_bytes compressed bytes (0 for no limit). With partition_by, the items are split by the month of this date
+        field (transactions/month=2021-03/part-00000.csv.gz, month=unknown for the items without date), so the
+        months can be read without the others.
+
+        At most max_open chunks are open at a time: the chunk of the month written the longest ago is suspended, and
+        continued in a new zstd frame (gzip member) of the same file when an item of its month comes again. The
+        readers of zstd and gzip (zstd -d, gzip -d, pandas, pyarrow) read the frames of a file one after the other.
+
+        The options are given by the item_export_kwargs of the feed, or else the FEED_CHUNK_* settings. The manifest
+        lists the chunks with their partition, number of items and size, once the feed is closed.
+
+    Attributes:
+
+        file (file): the file of the feed, where the manifest is written.
+        directory (str): the directory of the chunks (the name of the feed file without its extension by default).
+        compression (str): 'zstd', 'gzip' or None.
+        max_items (int): the number of items after which a chunk is closed.
+        max_bytes (int): the compressed size after which a chunk is closed.
+        partition_by (str): the date field whose month partitions the items, None to not partition them.
+        max_open (int): the number of chunks open at a time.
+    """
+
+    format = None
+    extension = None
+
+    def __init__(self, file, directory=None, compression="gzip", max_items=0, max_bytes=0, partition_by=None,
+                 max_open=16, **kwargs):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {', '.join(map(str, COMPRESSIONS))}")
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("the zstd compression of the chunks needs zstandard (pip install zstandard)")
+        # the options of the exporter of each chunk (fields_to_export, encoding, ...)
+        self._chunk_kwargs = kwargs
+        super().__init__(dont_fail=True, **kwargs)
+        self.file = file
+        if directory is None:
+            directory = os.path.splitext(getattr(file, "name", "chunks"))[0]
+        self.directory = directory
+        # the paths of the manifest are relative to it
+        self._base = os.path.dirname(os.path.abspath(getattr(file, "name", directory)))
+        self.compression = compression
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.partition_by = partition_by or None
+        self.max_open = max(max_open, 1)
+        # the current chunk of each partition, and the ones open, the most recently written last
+        self._chunks = {}
+        self._open = OrderedDict()
+        self._numbers = {}
+        self._written = []
+
+    @classmethod
+    def from_crawler(cls, crawler, file, **kwargs):
+        settings = crawler.settings
+        kwargs.setdefault("compression", settings.get("FEED_CHUNK_COMPRESSION") or None)
+        kwargs.setdefault("max_items", settings.getint("FEED_CHUNK_MAX_ITEMS"))
+        kwargs.setdefault("max_bytes", settings.getint("FEED_CHUNK_MAX_BYTES"))
+        kwargs.setdefault("partition_by", settings.get("FEED_CHUNK_PARTITION_BY"))
+        kwargs.setdefault("max_open", settings.getint("FEED_CHUNK_MAX_OPEN", 16))
+        return cls(file, **kwargs)
+
+    def export_item(self, item):
+        partition = self._partition(item) if self.partition_by else None
+        chunk = self._chunks.get(partition)
+        if chunk is None:
+            chunk = self._chunks[partition] = self._new_chunk(partition)
+        if partition in self._open:
+            self._open.move_to_end(partition)
+        else:
+            self._open_chunk(partition, chunk)
+        chunk.exporter.export_item(item)
+        chunk.items += 1
+        if (self.max_items and chunk.items >= self.max_items) or (self.max_bytes and chunk.size() >= self.max_bytes):
+            self._finish(partition)
+
+    def finish_exporting(self):
+        for partition in list(self._chunks):
+            self._finish(partition)
+        manifest = {
+            "format": self.format,
+            "compression": self.compression,
+            "partition_by": self.partition_by,
+            "fields": list(self.fields_to_export) if self.fields_to_export else None,
+            "chunks": sorted(self._written, key=lambda chunk: chunk["path"]),
+        }
+        self.file.write(json.dumps(manifest, indent=2).encode("utf-8"))
+
+    def _partition(self, item):
+        value = coerce_value(item.get(self.partition_by), datetime)
+        return value.strftime("%Y-%m") if isinstance(value, date) else "unknown"
+
+    def _new_chunk(self, partition):
+        number = self._numbers.get(partition, 0)
+        self._numbers[partition] = number + 1
+        name = f"part-{number:05d}.{self.extension}" + COMPRESSIONS[self.compression]
+        if partition is not None:
+            name = os.path.join(f"month={partition}", name)
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return Chunk(path, self.compression)
+
+    def _open_chunk(self, partition, chunk):
+        if len(self._open) >= self.max_open:
+            self._open.popitem(last=False)[1].suspend()
+        kwargs = dict(self._chunk_kwargs)
+        resumed = chunk.exporter is not None
+        if resumed:
+            # the columns of the beginning of the chunk
+            kwargs["fields_to_export"] = chunk.exporter.fields_to_export
+        chunk.exporter = self.chunk_exporter(chunk.open(), header=not resumed, **kwargs)
+        chunk.exporter.start_exporting()
+        self._open[partition] = chunk
+
+    def _finish(self, partition):
+        chunk = self._chunks.pop(partition)
+        if self._open.pop(partition, None) is not None:
+            chunk.suspend()
+        self._written.append({
+            "path": os.path.relpath(chunk.path, self._base),
+            "partition": partition,
+            "items": chunk.items,
+            "bytes": os.path.getsize(chunk.path),
+        })
+
+    def chunk_exporter(self, stream, header, **kwargs):
+        """The exporter writing items to the compressed stream of a chunk, header being False for a resumed chunk."""
+        raise NotImplementedError
+
+
+class ChunkedJsonLinesItemExporter(ChunkedItemExporter):
+    """Write the items to compressed chunks of JSON lines."""
+
+    format = "jsonl"
+    extension = "jsonl"
+
+    def chunk_exporter(self, stream, header, **kwargs):
+        return JsonLinesItemExporter(stream, **kwargs)
+
+
+class ChunkedCsvItemExporter(ChunkedItemExporter):
+    """Write the items to compressed chunks of CSV, each chunk starting with the header."""
+
+    format = "csv"
+    extension = "csv"
+
+    def chunk_exporter(self, stream, header, **kwargs):
+        return CsvItemExporter(stream, include_headers_line=header, **kwargs)
+
+
+# the extension of the chunks for each compression
+COMPRESSIONS = {"zstd": ".zst", "gzip": ".gz", None: ""}
+
+
+class Chunk:
+    """
+        A chunk of a feed, written in one or several zstd frames (gzip members), each time it is opened.
+
+    Attributes:
+
+        path (str): the location of the chunk.
+        compression (str): 'zstd', 'gzip' or None.
+        items (int): the number of items written.
+        exporter (BaseItemExporter): the exporter of the items to the chunk, None before the chunk is opened.
+    """
+
+    def __init__(self, path, compression):
+        self.path = path
+        self.compression = compression
+        self.items = 0
+        self.exporter = None
+        self._file = None
+        self._stream = None
+
+    def open(self):
+        """Open the chunk for writing, after what was already written, and return the stream of the exporter."""
+        self._file = open(self.path, "ab")
+        if self.compression == "zstd":
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._file, closefd=False)
+        elif self.compression == "gzip":
+            self._stream = gzip.GzipFile(fileobj=self._file, mode="wb", mtime=0)
+        else:
+            self._stream = self._file
+        return self._stream
+
+    def size(self):
+        """The number of compressed bytes written so far (the compressors keep the last ones until they are full)."""
+        return self._file.tell()
+
+    def suspend(self):
+        """End the frame being written and close the file."""
+        self.exporter.finish_exporting()
+        if self._stream is not self._file:
+            self._stream.close()
+        self._file.close()
+        self._file = self._stream = None
+
+
+def arrow_type(value_type, dictionary):
+    """Arrow type of the column of a field."""
+    if dictionary:
+        return pa.dictionary(pa.int32(), pa.string())
+    return {
+        int: pa.int64(),
+        datetime: pa.timestamp("us"),
+        date: pa.date32(),
+    }.get(value_type, pa.string())
@@ -0,0 +1,469 @@
+# Instrumentation of the crawls
+#
+# A crawl of the registry takes hours: CrawlMetrics reports its progress, with an estimate of its end, and the cost of
+# each callback of the spider at a regular interval, in the log and, if they are set, in a Prometheus textfile (e.g.
+# read by the textfile collector of the node exporter) and in a file of JSON lines. The figures of the callbacks are
+# collected in the stats by middlewares.CallbackMetricsMiddleware.
+#
+# CrawlProfiler profiles a crawl without changing the spiders (-s PROFILE_SAMPLING=True, -s PROFILE_TRACEMALLOC=True),
+# the callbacks being profiled by middlewares.CallbackProfilerMiddleware (-s PROFILE_CALLBACKS=parse_compliances).
+#
+# IncompleteCrawlMarker tells the process launching a crawl whether pages were given up (-s INCOMPLETE_MARKER=<path>),
+# 'scrapy crawl' exiting with 0 as long as the spider could be started.
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+# the figures of each callback in the stats, as 'metrics/<callback>/<name>'
+CALLBACK_METRICS = ("responses", "bytes", "soft_errors", "selector_seconds", "wall_seconds", "items", "requests")
+
+# the Prometheus metrics of the callbacks: (name, type, help, figure of the snapshot)
+PROMETHEUS_CALLBACK_METRICS = (
+    ("scrapy_callback_responses_total", "counter", "Responses downloaded for the callback", "responses"),
+    ("scrapy_callback_bytes_total", "counter", "Bytes of the responses of the callback", "bytes"),
+    ("scrapy_callback_soft_errors_total", "counter", "Error pages of the registry among the responses", "soft_errors"),
+    ("scrapy_callback_selector_seconds_total", "counter", "Time spent parsing the pages into trees", "selector_seconds"),
+    ("scrapy_callback_wall_seconds_total", "counter", "Time spent in the callback", "wall_seconds"),
+    ("scrapy_callback_items_total", "counter", "Items yielded by the callback", "items"),
+    ("scrapy_callback_requests_total", "counter", "Requests yielded by the callback", "requests"),
+    ("scrapy_callback_items_per_second", "gauge", "Items yielded per second since the last report", "items_per_second"),
+    ("scrapy_callback_bytes_per_second", "gauge", "Bytes downloaded per second since the last report", "bytes_per_second"),
+    ("scrapy_callback_soft_error_ratio", "gauge", "Share of the responses being error pages", "soft_error_rate"),
+)
+
+# the Prometheus metrics of the crawl: (name, type, help, figure of the snapshot)
+PROMETHEUS_CRAWL_METRICS = (
+    ("scrapy_scheduler_queue_depth", "gauge", "Requests waiting in the scheduler", "scheduled"),
+    ("scrapy_downloader_in_flight", "gauge", "Requests being downloaded", "in_flight"),
+    ("scrapy_items_scraped_total", "counter", "Items which went through the pipelines", "items"),
+    ("scrapy_pages_done", "gauge", "Pages of the pagination parsed or skipped", "pages_done"),
+    ("scrapy_pages_total", "gauge", "Pages of the pagination", "pages_total"),
+    ("scrapy_eta_seconds", "gauge", "Estimated time left before the last page is parsed", "eta_seconds"),
+)
+
+
+class CrawlMetrics:
+    """
+        Extension reporting the progress of the crawl and the figures of each callback every METRICS_INTERVAL seconds,
+        and once more when the spider is closed.
+
+        The progress is the number of pages of the pagination of the spider done (see pagination.PageFrontier), the
+        end of the crawl being estimated from the rate of the pages done since the start. For each callback, the
+        snapshot holds the counts of the stats (see CALLBACK_METRICS), the items and the bytes per second since the
+        last report and the share of the responses being error pages. The snapshot is logged, written to the
+        Prometheus textfile METRICS_PROMETHEUS_FILE (replaced at each report) and appended to METRICS_JSON_FILE.
+
+    Attributes:
+
+        crawler (scrapy.crawler.Crawler): the crawler of the spider.
+        interval (float): the number of seconds between two reports.
+        prometheus_file (str): the location of the Prometheus textfile, '' to not write it.
+        json_file (str): the location of the file of JSON lines, '' to not write it.
+    """
+
+    def __init__(self, crawler, interval, prometheus_file="", json_file=""):
+        self.crawler = crawler
+        self.interval = interval
+        self.prometheus_file = prometheus_file
+        self.json_file = json_file
+        self.task = None
+        self.start = None
+        # the time of the last report and the figures of the callbacks then
+        self.previous = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool("METRICS_ENABLED"):
+            raise NotConfigured
+        extension = cls(
+            crawler,
+            settings.getfloat("METRICS_INTERVAL", 60.0),
+            settings.get("METRICS_PROMETHEUS_FILE"),
+            settings.get("METRICS_JSON_FILE"),
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        self.start = time.monotonic()
+        self.previous = (self.start, {})
+        self.task = task.LoopingCall(self.report, spider)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.report(spider)
+
+    def report(self, spider):
+        snapshot = self.snapshot(spider)
+        logger.info(progress_message(snapshot))
+        for callback, figures in snapshot["callbacks"].items():
+            logger.info(callback_message(callback, figures))
+        if self.prometheus_file:
+            write_prometheus(self.prometheus_file, snapshot)
+        if self.json_file:
+            with open(self.json_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(snapshot) + "\n")
+
+    def snapshot(self, spider):
+        """The figures of the crawl and of each callback at this time.
+
+        Args:
+            spider (scrapy.Spider): the spider of the crawl.
+
+        Returns:
+            dict: the figures, written as a line of JSON.
+        """
+        now = time.monotonic()
+        stats = self.crawler.stats
+        callbacks = {}
+        for key, value in stats.get_stats().items():
+            if key.startswith("metrics/"):
+                _, callback, name = key.split("/", 2)
+                callbacks.setdefault(callback, dict.fromkeys(CALLBACK_METRICS, 0))[name] = value
+        since, previous = self.previous
+        elapsed = now - since
+        for callback, figures in callbacks.items():
+            before = previous.get(callback, {})
+            figures["items_per_second"] = rate(figures["items"] - before.get("items", 0), elapsed)
+            figures["bytes_per_second"] = rate(figures["bytes"] - before.get("bytes", 0), elapsed)
+            figures["soft_error_rate"] = rate(figures["soft_errors"], figures["responses"])
+        self.previous = (now, {callback: dict(figures) for callback, figures in callbacks.items()})
+
+        engine = self.crawler.engine
+        snapshot = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "spider": spider.name,
+            "elapsed_seconds": round(now - self.start, 1),
+            "scheduled": len(engine.slot.scheduler) if engine is not None and engine.slot is not None else 0,
+            "in_flight": len(engine.downloader.active) if engine is not None else 0,
+            "items": stats.get_value("item_scraped_count", 0),
+            "pages_done": None,
+            "pages_total": None,
+            "eta_seconds": None,
+            "callbacks": callbacks,
+        }
+        frontier = getattr(spider, "frontier", None)
+        if frontier is not None:
+            snapshot["pages_done"] = frontier.completed + frontier.skipped
+            snapshot["pages_total"] = frontier.total
+            if frontier.total is not None and frontier.completed:
+                left = frontier.total - snapshot["pages_done"]
+                snapshot["eta_seconds"] = round(max(left, 0) * (now - self.start) / frontier.completed)
+        return snapshot
+
+
+def rate(count, total):
+    """count / total, 0 when total is 0."""
+    return count / total if total else 0
+
+
+def progress_message(snapshot):
+    """The line of the log for the progress of the crawl."""
+    message = f"Progress: {snapshot['items']} items"
+    if snapshot["pages_total"]:
+        message = (
+            f"Progress: page {snapshot['pages_done']} out of {snapshot['pages_total']} "
+            f"({snapshot['pages_done'] / snapshot['pages_total']:.1%}), {snapshot['items']} items"
+        )
+    message += f", {snapshot['scheduled']} requests queued, {snapshot['in_flight']} downloading"
+    if snapshot["eta_seconds"] is not None:
+        end = datetime.now() + timedelta(seconds=snapshot["eta_seconds"])
+        message += f", ETA {end:%Y-%m-%d %H:%M} (in {timedelta(seconds=snapshot['eta_seconds'])})"
+    return message
+
+
+def callback_message(callback, figures):
+    """The line of the log for the figures of a callback."""
+    responses = figures["responses"] or 1
+    return (
+        f"Callback {callback}: {figures['responses']} responses, {figures['items_per_second']:.1f} items/s, "
+        f"{figures['bytes_per_second'] / 1024:.0f} kB/s, {figures['soft_error_rate']:.1%} error pages, "
+        f"{figures['wall_seconds'] * 1000 / responses:.1f} ms per response in the callback "
+        f"+ {figures['selector_seconds'] * 1000 / responses:.1f} ms parsing the page"
+    )
+
+
+def write_prometheus(path, snapshot):
+    """Replace the Prometheus textfile with the figures of a snapshot (written to a temporary file first, so that
+    the collector never reads a partial file)."""
+    labels = f'spider="{snapshot["spider"]}"'
+    lines = []
+    for name, kind, help_text, figure in PROMETHEUS_CRAWL_METRICS:
+        if snapshot[figure] is None:
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name}{{{labels}}} {snapshot[figure]}"]
+    for name, kind, help_text, figure in PROMETHEUS_CALLBACK_METRICS:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for callback, figures in snapshot["callbacks"].items():
+            lines.append(f'{name}{{{labels},callback="{callback}"}} {figures[figure]}')
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary, path)
+
+
+# the frames of the threads waiting (the reactor for the network, the pools of threads for work), left out of the
+# summary of the sampling
+IDLE_MODULES = ("threading.py", "selectors.py", "queue.py")
+
+
+class CrawlProfiler:
+    """
+        Extension profiling the whole process during a crawl, the results being written to PROFILE_DIR at the end.
+
+        - With PROFILE_SAMPLING, a thread samples the stacks of all the other threads every PROFILE_SAMPLING_INTERVAL
+          seconds (the reactor, the writers of the feeds, ...), without slowing them down like a deterministic
+          profiler. The stacks are written as collapsed stacks (<run>.collapsed, one 'thread;frame;frame count' line
+          per stack), read by flamegraph.pl or https://www.speedscope.app.
+        - With PROFILE_TRACEMALLOC, the allocations of memory are traced, and every PROFILE_TRACEMALLOC_INTERVAL
+          seconds the lines of code whose allocations grew the most since the previous snapshot are logged. Tracing
+          the allocations slows the crawl down, and taking a snapshot blocks it for a moment.
+
+        A summary (the functions where the samples were taken the most, the growth of the memory at each snapshot)
+        is written to <run>.json, <run> being the name of the spider and the start of the crawl.
+
+    Attributes:
+
+        crawler (scrapy.crawler.Crawler): the crawler of the spider.
+        directory (str): the directory of the results.
+        sampling_interval (float): the seconds between two samples of the stacks, 0 to not sample them.
+        tracemalloc_interval (float): the seconds between two snapshots of the memory, 0 to not trace it.
+        tracemalloc_frames (int): the number of frames of the tracebacks of the allocations.
+        top (int): the number of functions or lines of code of the summaries.
+    """
+
+    def __init__(self, crawler, directory, sampling_interval=0, tracemalloc_interval=0, tracemalloc_frames=1, top=20):
+        self.crawler = crawler
+        self.directory = directory
+        self.sampling_interval = sampling_interval
+        self.tracemalloc_interval = tracemalloc_interval
+        self.tracemalloc_frames = tracemalloc_frames
+        self.top = top
+        self.stacks = Counter()
+        self.memory = []
+        self._sampler = None
+        self._stop = threading.Event()
+        self._snapshot = None
+        self._task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        sampling = settings.getbool("PROFILE_SAMPLING")
+        tracing = settings.getbool("PROFILE_TRACEMALLOC")
+        if not sampling and not tracing:
+            raise NotConfigured
+        extension = cls(
+            crawler,
+            settings.get("PROFILE_DIR"),
+            settings.getfloat("PROFILE_SAMPLING_INTERVAL", 0.01) if sampling else 0,
+            settings.getfloat("PROFILE_TRACEMALLOC_INTERVAL", 600.0) if tracing else 0,
+            settings.getint("PROFILE_TRACEMALLOC_FRAMES", 1),
+            settings.getint("PROFILE_TOP", 20),
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        if self.sampling_interval:
+            self._sampler = threading.Thread(target=self.sample, name="profiler", daemon=True)
+            self._sampler.start()
+        if self.tracemalloc_interval:
+            tracemalloc.start(self.tracemalloc_frames)
+            self._snapshot = take_snapshot()
+            self._task = task.LoopingCall(self.compare_memory)
+            self._task.start(self.tracemalloc_interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        summary = {"spider": spider.name, "reason": reason}
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, run_name(self.crawler, spider))
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            with open(f"{path}.collapsed", "w", encoding="utf-8") as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            summary["sampling"] = self.sampling_summary()
+        if self._task is not None:
+            if self._task.running:
+                self._task.stop()
+            self.compare_memory()
+            tracemalloc.stop()
+            summary["memory"] = self.memory
+        with open(f"{path}.json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        logger.info(f"Profile of the crawl written to {path}.*")
+
+    def sample(self):
+        """Loop of the sampling thread, until the spider is closed."""
+        own = threading.get_ident()
+        while not self._stop.wait(self.sampling_interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(frames))] += 1
+
+    def sampling_summary(self):
+        """The functions running (self) or on the stack (total) in the most samples."""
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            # the frames are 'function (file:line)'
+            if not frames or frames[-1].rpartition("(")[2].partition(":")[0] in IDLE_MODULES:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return {
+            "interval": self.sampling_interval,
+            "samples": sum(self.stacks.values()),
+            "busy_samples": sum(own.values()),
+            "self": own.most_common(self.top),
+            "total": total.most_common(self.top),
+        }
+
+    def compare_memory(self):
+        """Take a snapshot of the memory and log the lines of code whose allocations grew the most since the last."""
+        snapshot = take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        growth = [
+            {"where": str(stat.traceback), "size_diff": stat.size_diff, "size": stat.size, "count_diff": stat.count_diff}
+            for stat in snapshot.compare_to(self._snapshot, "lineno")[: self.top]
+        ]
+        self._snapshot = snapshot
+        self.memory.append({
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "current": current,
+            "peak": peak,
+            "growth": growth,
+        })
+        logger.info(f"Memory traced: {current / 2**20:.1f} MB (peak {peak / 2**20:.1f} MB), grown the most by:")
+        for stat in growth[:10]:
+            logger.info(f"  {stat['where']}: {stat['size_diff'] / 1024:+.0f} kB ({stat['count_diff']:+d} blocks)")
+
+
+def take_snapshot():
+    """A snapshot of the memory traced, without the allocations of the tracing itself and of the imports."""
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+
+
+def run_name(crawler, spider):
+    """Name of the results of the profiling of a crawl: the spider and the time it was started."""
+    start = crawler.stats.get_value("start_time") or datetime.now()
+    return f"{spider.name}-{start:%Y%m%d-%H%M%S}"
+
+
+# the stats counting the pages given up during a crawl
+GIVEN_UP_STATS = (
+    "retry/max_reached",
+    "soft_retry/max_reached",
+    "soft_retry/budget_exhausted",
+    "spider_exceptions/count",
+    "dead_letters/count",
+    "shards/unknown_pages",
+)
+
+
+class IncompleteCrawlMarker:
+    """
+        Extension writing the file INCOMPLETE_MARKER when the crawl closes with pages given up, so that the commands
+        running crawls in parallel processes (crawl_pages, crawl_shards) don't take a partial output for a complete
+        one.
+
+        The crawl is incomplete when the spider was not closed because it was finished, when one of GIVEN_UP_STATS
+        was counted (downloads failed after their retries, error pages of the registry given up, callbacks raising an
+        exception), when pages of the pagination failed or were lost (see pagination.PageFrontier) or when the spider
+        set its `incomplete` attribute. The file holds the reasons, as JSON. It is removed when the spider is opened,
+        so a crawl launched again with the same marker starts clean.
+
+    Attributes:
+
+        crawler (scrapy.crawler.Crawler): the crawler of the spider.
+        path (str): the location of the marker.
+    """
+
+    def __init__(self, crawler, path):
+        self.crawler = crawler
+        self.path = path
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get("INCOMPLETE_MARKER")
+        if not path:
+            raise NotConfigured
+        extension = cls(crawler, path)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def spider_closed(self, spider, reason):
+        reasons = missing_pages(self.crawler, spider, reason)
+        if not reasons:
+            return
+        logger.error(f"The crawl is incomplete: {reasons}")
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(reasons, f)
+
+
+def missing_pages(crawler, spider, reason):
+    """Why pages are missing from the output of a crawl.
+
+    Args:
+        crawler (scrapy.crawler.Crawler): the crawler of the spider.
+        spider (scrapy.Spider): the spider of the crawl.
+        reason (str): the reason why the spider was closed.
+
+    Returns:
+        dict: the reasons and their counts, empty when the crawl is complete.
+    """
+    reasons = {}
+    if reason != "finished":
+        reasons["close_reason"] = reason
+    for key in GIVEN_UP_STATS:
+        count = crawler.stats.get_value(key, 0)
+        if count:
+            reasons[key] = count
+    frontier = getattr(spider, "frontier", None)
+    if frontier is not None and frontier.failures:
+        reasons["pagination/failures"] = frontier.failures
+    if getattr(spider, "incomplete", False):
+        reasons["incomplete"] = True
+    return reasons
@@ -0,0 +1,234 @@
+# Single-pass extraction of the tables of the EU ETS registry
+#
+# The spiders used to run one CSS query per cell (row.css("td:nth-child(k) span::text")), each query walking the row
+# again and creating new Selector objects. Here the CSS selectors of the rows are compiled once to lxml XPath objects,
+# and each row is walked a single time, its cells being mapped to the fields of a column specification.
+
+import functools
+
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
+
+_translator = HTMLTranslator()
+
+
+def compile_css(css):
+    """Compile a CSS selector (without ::text or ::attr) to an lxml XPath, evaluated on lxml elements.
+
+    Args:
+        css (str): the CSS selector, e.g. 'table#tblAccountSearchResult tr:nth-child(n+3)'.
+
+    Returns:
+        lxml.etree.XPath: the compiled selector.
+    """
+    return etree.XPath(_translator.css_to_xpath(css))
+
+
+def cell_text(cell):
+    """Text of the first span of a cell, like cell.css("span::text").get(default="").strip().
+
+    Args:
+        cell (lxml.etree._Element): the <td> element.
+
+    Returns:
+        str: the stripped text, '' if the cell has no text in a span.
+    """
+    for span in cell.iter("span"):
+        if span.text is not None:
+            return span.text.strip()
+        for child in span:
+            if child.tail is not None:
+                return child.tail.strip()
+    return ""
+
+
+def row_cells(row):
+    """The child elements of a row, the comments being left out (as nth-child does)."""
+    return [cell for cell in row if isinstance(cell.tag, str)]
+
+
+class TableExtractor:
+    """
+        Extract the rows of a table of the registry in a single walk of each row.
+
+        An extractor is pickled as its CSS selector and its columns (e.g. to be sent to the processes of
+        offload.ParsePool), and compiled once per process.
+
+    Attributes:
+
+        rows_css (str): the CSS selector of the rows of the table.
+        rows (lxml.etree.XPath): the compiled selector of the rows of the table.
+        columns (tuple): the (field name, number of the column starting at 1) of the extracted cells.
+    """
+
+    def __init__(self, rows_css, columns):
+        self.rows_css = rows_css
+        self.rows = compile_css(rows_css)
+        self.columns = tuple(columns)
+
+    def __reduce__(self):
+        return table_extractor, (self.rows_css, self.columns)
+
+    @property
+    def fields(self):
+        """The names of the fields, in the order of the columns."""
+        return tuple(field for field, _ in self.columns)
+
+    def extract_row(self, row):
+        """Map the cells of a row to the fields of the columns.
+
+        Args:
+            row (lxml.etree._Element): the <tr> element.
+
+        Returns:
+            dict: the text of each field, '' for the missing cells.
+        """
+        cells = row_cells(row)
+        data = {}
+        for field, column in self.columns:
+            if column <= len(cells) and cells[column - 1].tag == "td":
+                data[field] = cell_text(cells[column - 1])
+            else:
+                data[field] = ""
+        return data
+
+    def extract(self, root):
+        """Extract every row of the table.
+
+        Args:
+            root (lxml.etree._Element): the root of the page, e.g. response.selector.root.
+
+        Yields:
+            tuple: the <tr> element and the dictionary of its fields.
+        """
+        for row in self.rows(root):
+            yield row, self.extract_row(row)
+
+
+class ComplianceExtractor:
+    """
+        Extract a compliance page of the registry from a declarative schema.
+
+        The page is made of header blocks (a row of a table holding one field per column) and of compliance tables
+        (one row per year, one metric per column). The tables of the page depend on its layout, e.g. a single EU
+        table, or an EU table and a CH table, so new schemes or layouts only need new entries in the schema.
+
+    Attributes:
+
+        header (tuple): the (compiled selector of the row, columns) of each header block, the columns being
+            (field name, number of the column) pairs.
+        year_column (int): the number of the column holding the year in the compliance tables.
+        metrics (tuple): the (metric name, number of the column) of the compliance tables.
+        layouts (tuple): the (compiled selector, tables) of each layout, the first layout whose selector matches the
+            page is used (a None selector always matches), the tables being (scheme, compiled selector of the rows).
+        schema (tuple): the arguments the extractor was built from (tuples of CSS selectors), with which it is
+            pickled like a TableExtractor.
+    """
+
+    def __init__(self, header, year_column, metrics, layouts):
+        self.schema = (header, year_column, metrics, layouts)
+        self.header = tuple((compile_css(css), tuple(columns)) for css, columns in header)
+        self.year_column = year_column
+        self.metrics = tuple(metrics)
+        self.layouts = tuple(
+            (
+                compile_css(css) if css is not None else None,
+                tuple((scheme, compile_css(rows)) for scheme, rows in tables),
+            )
+            for css, tables in layouts
+        )
+
+    def __reduce__(self):
+        return compliance_extractor, self.schema
+
+    @property
+    def metric_names(self):
+        """The names of the metrics, in the order of the columns."""
+        return tuple(metric for metric, _ in self.metrics)
+
+    def extract_header(self, root):
+        """Extract the fields of the header blocks.
+
+        Args:
+            root (lxml.etree._Element): the root of the page, e.g. response.selector.root.
+
+        Returns:
+            dict: the text of each field, '' for the missing cells.
+        """
+        data = {}
+        for rows, columns in self.header:
+            found = rows(root)
+            cells = row_cells(found[0]) if found else []
+            for field, column in columns:
+                if column <= len(cells) and cells[column - 1].tag == "td":
+                    data[field] = cell_text(cells[column - 1])
+                else:
+                    data[field] = ""
+        return data
+
+    def extract_years(self, root):
+        """Extract the rows of the compliance tables of the layout of the page.
+
+        Args:
+            root (lxml.etree._Element): the root of the page, e.g. response.selector.root.
+
+        Yields:
+            tuple: the scheme (e.g. 'EU'), the year (str) and the dictionary of the metrics of each row.
+        """
+        for layout, tables in self.layouts:
+            if layout is None or layout(root):
+                break
+        else:
+            return
+        for scheme, rows in tables:
+            for row in rows(root):
+                cells = row_cells(row)
+                if self.year_column > len(cells):
+                    continue
+                year = cell_text(cells[self.year_column - 1])
+                # the tables end with rows that are not years (totals, notes)
+                if len(year) != 4:
+                    continue
+                yield scheme, year, {
+                    metric: cell_text(cells[column - 1]) if column <= len(cells) else ""
+                    for metric, column in self.metrics
+                }
+
+    def extract(self, root):
+        """Extract the whole page as a single row, a column being created for each scheme, year and metric.
+
+        Args:
+            root (lxml.etree._Element): the root of the page, e.g. response.selector.root.
+
+        Returns:
+            dict: the header fields, then the '<scheme>_Compliance_<year>_<metric>' fields.
+        """
+        return self.to_row(self.extract_header(root), self.extract_years(root))
+
+    @staticmethod
+    def to_row(header, years):
+        """Build the row of a page from its header fields and its compliance years (see extract).
+
+        Args:
+            header (dict): the header fields, see extract_header.
+            years (iterable): the (scheme, year, metrics) of the compliance tables, see extract_years.
+
+        Returns:
+            dict: the header fields, then the '<scheme>_Compliance_<year>_<metric>' fields.
+        """
+        data = dict(header)
+        for scheme, year, metrics in years:
+            for metric, value in metrics.items():
+                data[f"{scheme}_Compliance_{year}_{metric}"] = value
+        return data
+
+
+# the extractors are rebuilt from their schema when they are unpickled, once per process
+@functools.lru_cache(maxsize=None)
+def table_extractor(rows_css, columns):
+    return TableExtractor(rows_css, columns)
+
+
+@functools.lru_cache(maxsize=None)
+def compliance_extractor(header, year_column, metrics, layouts):
+    return ComplianceExtractor(header, year_column, metrics, layouts)
@@ -3,6 +3,9 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
 
+import re
+from datetime import date, datetime
+
 import scrapy
 
 
@@ -10,3 +13,153 @@ class ScrapyScraperItem(scrapy.Item):
     # define the fields for your item here like:
     # name = scrapy.Field()
     pass
+
+
+# The fields are declared with the type of their values (str by default), the values scraped from the registry being
+# converted by TypeCoercionPipeline: int for the quantities, datetime for the timestamps, date for the dates. The text
+# fields taking few distinct values (registries, types, holders, ...) are marked with dictionary=True, they are
+# dictionary-encoded by the columnar feeds (see exporters.py).
+
+
+class TransactionItem(scrapy.Item):
+    """A transaction of the registry (one item per row of the table of transactions)."""
+    Transaction_ID = scrapy.Field()
+    Transaction_Type = scrapy.Field(dictionary=True)
+    Transaction_Date = scrapy.Field(type=datetime)
+    Transaction_Status = scrapy.Field(dictionary=True)
+    Transferring_Registry = scrapy.Field(dictionary=True)
+    Transferring_Account_Type = scrapy.Field(dictionary=True)
+    Transferring_Account_Name = scrapy.Field()
+    Transferring_Account_Identifier = scrapy.Field()
+    Transferring_Account_Holder = scrapy.Field(dictionary=True)
+    Acquiring_Registry = scrapy.Field(dictionary=True)
+    Acquiring_Account_Type = scrapy.Field(dictionary=True)
+    Acquiring_Account_Name = scrapy.Field()
+    Acquiring_Account_Identifier = scrapy.Field()
+    Acquiring_Account_Holder = scrapy.Field(dictionary=True)
+    Nb_of_Units = scrapy.Field(type=int)
+
+
+# fields of an Operator Holding account in the long output of europa_spider (-a output=long): the columns of the
+# table of accounts, then the header blocks of the compliance page
+HOLDING_ACCOUNT_FIELDS = (
+    "Account_ID",
+    "National_Administrator",
+    "Account_Type",
+    "Account_Holder_Name",
+    "Installation/Aircraft_ID",
+    "Installation_Name/Aircraft_Operator_Code",
+    "Company_Regustration_No",
+    "Permit/Plan_ID",
+    "Permit/Plan_Date",
+    "Main_Activity_Type",
+    "Latest_Compliance_Code",
+    "Account_Status",
+    "Type",
+    "Legal_Entity_Identifier",
+    "Main_Adress_Line",
+    "Secondary_Adress_Line",
+    "Postal_Code",
+    "City",
+    "Country",
+    "Telephone_1",
+    "Telephone_2",
+    "E-Mail_Adress",
+    "Monitoring_plan—year_of_expiry",
+    "Name_of_Subsidiary_undertaking",
+    "Name_of_Parent_undertaking",
+    "E-PRTR_identification",
+    "Call_Sign_(ICAO_designator)",
+    "First_Year_of_Emissions",
+    "Last_Year_of_Emissions",
+)
+
+# types of the fields of an account which are not strings
+HOLDING_ACCOUNT_TYPES = {
+    "Permit/Plan_Date": date,
+    "Monitoring_plan—year_of_expiry": int,
+    "First_Year_of_Emissions": int,
+    "Last_Year_of_Emissions": int,
+}
+
+# text fields of an account taking few distinct values
+HOLDING_ACCOUNT_DICTIONARY = (
+    "National_Administrator",
+    "Account_Type",
+    "Account_Holder_Name",
+    "Main_Activity_Type",
+    "Latest_Compliance_Code",
+    "Account_Status",
+    "Type",
+    "Country",
+)
+
+# some names of the registry are not valid Python identifiers (e.g. 'Installation/Aircraft_ID'), so the fields are
+# declared from the list above
+HoldingAccountItem = type(
+    "HoldingAccountItem",
+    (scrapy.Item,),
+    dict(
+        {
+            name: scrapy.Field(
+                type=HOLDING_ACCOUNT_TYPES.get(name, str),
+                dictionary=name in HOLDING_ACCOUNT_DICTIONARY,
+            )
+            for name in HOLDING_ACCOUNT_FIELDS
+        },
+        __doc__="An Operator Holding account, without its compliances (one item per account).",
+        # else the module of the metaclass, and the items can't be pickled (e.g. by 'scrapy reparse_archive')
+        __module__=__name__,
+    ),
+)
+
+
+class ComplianceYearItem(scrapy.Item):
+    """
+        The compliance of an Operator Holding account for a year of an emission trading scheme (one item per account,
+        scheme and year), linked to its HoldingAccountItem by Account_ID.
+
+        The quantities are integers, None when the registry gives no number for the year.
+    """
+    Account_ID = scrapy.Field()
+    Scheme = scrapy.Field(dictionary=True)  # 'EU' or 'CH'
+    Year = scrapy.Field(type=int)
+    Allowances_in_Allocation = scrapy.Field(type=int)
+    Verified_Emissions = scrapy.Field(type=int)
+    Units_Surrendered = scrapy.Field(type=int)
+    Cumulative_Surrendered_Units = scrapy.Field(type=int)
+    Cumulative_Verified_Emissions = scrapy.Field(type=int)
+    Compliance_Code = scrapy.Field(dictionary=True)
+
+
+# column of a compliance metric in the wide output of europa_spider, e.g. 'EU_Compliance_2021_Verified_Emissions'
+COMPLIANCE_COLUMN = re.compile(r"([A-Z]+)_Compliance_(\d{4})_(\w+)")
+
+
+def field_metadata(item, name):
+    """Declaration of a field of an item (its type, see above, and whether it is dictionary-encoded).
+
+    The rows of the wide output of europa_spider are dicts, their columns get the declarations of the fields of
+    HoldingAccountItem and ComplianceYearItem.
+
+    Args:
+        item (scrapy.Item or dict): the item.
+        name (str): the name of the field.
+
+    Returns:
+        scrapy.Field: the declaration of the field, None for the fields of a dict which are not known.
+    """
+    if isinstance(item, scrapy.Item):
+        return item.fields[name]
+    if name in HoldingAccountItem.fields:
+        return HoldingAccountItem.fields[name]
+    match = COMPLIANCE_COLUMN.fullmatch(name)
+    if match:
+        return ComplianceYearItem.fields.get(match.group(3))
+    return None
+
+
+def field_type(item, name):
+    """Type of the values of a field of an item: str, int, date or datetime, None for the unknown fields of a dict."""
+    metadata = field_metadata(item, name)
+    return metadata.get("type", str) if metadata is not None else None
@@ -0,0 +1,236 @@
+# Helpers to run several spiders in parallel processes and to merge their outputs
+
+import csv
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.request import Request as UrlRequest, urlopen
+
+from parsel import Selector
+from scrapy.utils.conf import closest_scrapy_cfg
+
+from scrapy_scraper.exporters import sorted_columns
+from scrapy_scraper.state import TransactionIdSet
+from scrapy_scraper.utils import parse_registry_date
+
+logger = logging.getLogger(__name__)
+
+
+def crawl_command(spider, output, arguments=None, settings=None):
+    """Build the command line running a spider in a separate process.
+
+    Args:
+        spider (str): the name of the spider.
+        output (str): the file where the items are exported (overwritten).
+        arguments (dict): the arguments of the spider (-a name=value).
+        settings (dict): the settings overridden for this process (-s NAME=VALUE).
+
+    Returns:
+        list: the command line.
+    """
+    command = [sys.executable, "-m", "scrapy", "crawl", spider, "-O", output]
+    for name, value in (arguments or {}).items():
+        command += ["-a", f"{name}={value}"]
+    for name, value in (settings or {}).items():
+        command += ["-s", f"{name}={value}"]
+    return command
+
+
+def process_environment():
+    """The environment of the processes started from a scrapy command.
+
+    The scrapy command exports SCRAPY_SETTINGS_MODULE, with which 'scrapy crawl' no longer looks for scrapy.cfg to add
+    the directory of the project to sys.path, so the directory is given with PYTHONPATH.
+
+    Returns:
+        dict: the environment variables.
+    """
+    environment = dict(os.environ)
+    closest = closest_scrapy_cfg()
+    if closest:
+        paths = [os.path.dirname(closest)] + [path for path in environment.get("PYTHONPATH", "").split(os.pathsep) if path]
+        environment["PYTHONPATH"] = os.pathsep.join(paths)
+    return environment
+
+
+def run_workers(commands, workers):
+    """Run commands in separate processes, at most `workers` of them at the same time.
+
+    Args:
+        commands (list): the command lines to run.
+        workers (int): the number of processes running in parallel.
+
+    Returns:
+        list: the return code of each command, in the order of the commands.
+    """
+
+    def run(command):
+        logger.info("Starting %s", " ".join(command))
+        return subprocess.run(command, env=process_environment()).returncode
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, commands))
+
+
+def merge_csv(paths, output, sort_key=None, unique_field=None):
+    """Concatenate CSV files in a deterministic order.
+
+    The files are concatenated in the given order. The rows of each file are sorted with sort_key, since the rows of a
+    chunk are exported in the order the pages were downloaded, and the duplicated rows are dropped (e.g. a row of two
+    overlapping pages). The header holds the columns of all the files (see exporters.sorted_columns), the wide files of
+    europa_spider having the compliance columns of their own accounts.
+
+    The rows are streamed from the files, only the rows of the file being sorted are held in memory, and the values
+    of unique_field already written are kept in a state.TransactionIdSet (a few bytes per row).
+
+    Args:
+        paths (list): the CSV files to merge.
+        output (str): the merged CSV file.
+        sort_key (callable): key sorting the rows (dict) of each file, the rows are kept in order if None.
+        unique_field (str): the field identifying a row, the rows seen before are dropped.
+
+    Returns:
+        int: the number of rows written.
+    """
+    existing = []
+    for path in paths:
+        if os.path.exists(path):
+            existing.append(path)
+        else:
+            logger.warning("Missing chunk %s, skipped", path)
+
+    columns = {}
+    for path in existing:
+        with open(path, newline="", encoding="utf-8") as f:
+            columns.update(dict.fromkeys(next(csv.reader(f), [])))
+
+    written = 0
+    seen = TransactionIdSet()
+    with open(output, "w", newline="", encoding="utf-8") as out:
+        writer = csv.DictWriter(out, fieldnames=sorted_columns(columns))
+        writer.writeheader()
+        for path in existing:
+            with open(path, newline="", encoding="utf-8") as f:
+                rows = csv.DictReader(f)
+                if sort_key is not None:
+                    rows = sorted(rows, key=sort_key)
+                for row in rows:
+                    if unique_field is not None and not seen.add(row[unique_field]):
+                        continue
+                    writer.writerow(row)
+                    written += 1
+    return written
+
+
+def split_pages(pages, chunks):
+    """Split the pages of a pagination into contiguous ranges of about the same size.
+
+    Args:
+        pages (int): the number of pages.
+        chunks (int): the number of ranges.
+
+    Returns:
+        list: the (first, last) pages of each range, numbered from 1 and included.
+    """
+    chunks = max(1, min(chunks, pages))
+    bounds = [pages * k // chunks for k in range(chunks + 1)]
+    return [(bounds[k] + 1, bounds[k + 1]) for k in range(chunks)]
+
+
+def fetch_page_count(url, user_agent, attempts=5, timeout=60):
+    """Read the number of pages of a listing of the registry from its first page.
+
+    The error pages of the overloaded registry (without the pagination) are requested again with an exponential
+    backoff.
+
+    Args:
+        url (str): the URL of the first page of the listing.
+        user_agent (str): the User-Agent header of the request.
+        attempts (int): the number of requests before giving up.
+        timeout (float): the timeout of a request in seconds.
+
+    Returns:
+        int: the number of pages, None if it could not be read.
+    """
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(2 ** attempt)
+        try:
+            with urlopen(UrlRequest(url, headers={"User-Agent": user_agent}), timeout=timeout) as response:
+                body = response.read()
+        except OSError as error:
+            logger.warning("Request of %s failed: %r", url, error)
+            continue
+        pages = Selector(text=body.decode("utf-8", "replace")).xpath(
+            "//input[@name='resultList.lastPageNumber']/@value"
+        ).get()
+        if pages is not None:
+            return int(pages)
+        logger.warning("Error page of the registry for %s", url)
+    return None
+
+
+def load_shards(path):
+    """Read the shards exported by transaction_shard_spider, sorted by date.
+
+    Args:
+        path (str): the JSON file exported with 'scrapy crawl transaction_shard_spider -O shards.json'.
+
+    Returns:
+        list: the shards (dict with Start_Date, End_Date and Pages, 0 for a window without any transaction, None
+            when the spider could not read it).
+    """
+    with open(path, "r") as f:
+        shards = json.load(f)
+    return sorted(shards, key=lambda shard: shard["Start_Date"])
+
+
+def shard_output(directory, shard):
+    """Name of the CSV file holding the transactions of a shard."""
+    return os.path.join(directory, f"shard_{shard['Start_Date']}_{shard['End_Date']}.csv")
+
+
+def incomplete_marker(output):
+    """Location of the file written by a crawl whose output is missing pages (see extensions.IncompleteCrawlMarker)."""
+    return output + ".incomplete"
+
+
+def crawl_succeeded(returncode, output):
+    """Tell whether a process started with crawl_command scraped all its pages into its output.
+
+    Args:
+        returncode (int): the return code of the process.
+        output (str): the file where the items were exported, the process being given
+            INCOMPLETE_MARKER=incomplete_marker(output).
+
+    Returns:
+        bool: True if the output exists and no page was given up.
+    """
+    return returncode == 0 and os.path.exists(output) and not os.path.exists(incomplete_marker(output))
+
+
+def has_rows(path):
+    """Tell whether a CSV file holds at least one row after its header (a crawl without items leaves it empty)."""
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return next(reader, None) is not None
+
+
+def transaction_sort_key(row):
+    """Sort the transactions by date, then by ID."""
+    return (
+        parse_registry_date(row["Transaction_Date"]) or datetime.min,
+        row["Transaction_ID"],
+    )
+
+
+def account_sort_key(row):
+    """Sort the accounts of europa_spider by the ID of their installation or aircraft."""
+    identifier = row.get("Installation/Aircraft_ID", "")
+    return (int(identifier) if identifier.isdigit() else float("inf"), identifier)
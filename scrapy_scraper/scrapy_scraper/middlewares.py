@@ -3,11 +3,33 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import time
+from collections import Counter
+
 from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest, NotConfigured
+from scrapy.http import Request, TextResponse
+from scrapy.utils.misc import load_object
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from twisted.internet import reactor
+
+from scrapy_scraper.exporters import writes_on_close
+from scrapy_scraper.extensions import run_name
+from scrapy_scraper.pagestore import DeadLetterStore, PageArchive, callback_name
+from scrapy_scraper.state import Checkpoint
+from scrapy_scraper.utils import mirror_url
+
+logger = logging.getLogger(__name__)
+
 
 class ScrapyScraperSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +123,723 @@ class ScrapyScraperDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class CheckpointMiddleware:
+    """
+        Spider middleware recording the pages completed by the spider, to resume an interrupted crawl.
+
+        The requests of the spiders carry a key in meta["checkpoint"], e.g. ["page", 12]. A page is completed once its
+        response was parsed, all its items went through the pipelines and were flushed to the feeds, and the pages it
+        led to (e.g. the compliance pages of a listing page) are completed too. The pages of a pagination are not
+        waited for by the page that requested them: their requests carry meta["checkpoint_root"] (see PageFrontier).
+        On restart, the requests of the completed pages are dropped, so only the missing pages are scheduled again.
+
+        Enabled with CHECKPOINT_ENABLED, the manifest is kept in CHECKPOINT_DIR (one file per spider) and deleted once
+        the crawl went through every page. The feeds whose items are only written once the feed is closed (Parquet
+        and Arrow, see exporters.writes_on_close) can't be used with a checkpoint. The CSV feeds without fields to
+        export (the wide output of europa_spider) spill their rows to a file flushed before a page is recorded, which
+        a resumed crawl continues (see exporters.UnionCsvItemExporter).
+    """
+
+    def __init__(self, crawler, directory):
+        self.crawler = crawler
+        self.directory = directory
+        self.checkpoint = None
+        # the exporters of the feeds spilling their rows to a file (see exporters.UnionCsvItemExporter)
+        self.spilling = []
+        # number of requests, items and child pages still running for each started page
+        self.pending = Counter()
+        # page that led to each started page
+        self.parents = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("CHECKPOINT_ENABLED"):
+            raise NotConfigured
+        feeds = list(cls.feeds_written_on_close(crawler.settings))
+        if feeds:
+            raise ValueError(
+                f"The items of the feed {feeds[0]} are only written once the crawl is over, the checkpoint can't be "
+                "used with it: export CSV or JSON lines (-o items.jl)"
+            )
+        s = cls(crawler, crawler.settings.get("CHECKPOINT_DIR", "checkpoints"))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.item_done, signal=signals.item_scraped)
+        crawler.signals.connect(s.item_done, signal=signals.item_dropped)
+        return s
+
+    @staticmethod
+    def feeds_written_on_close(settings):
+        """The URIs of the feeds (FEEDS, -o/-O) whose items are only written once the feed is closed."""
+        exporters = settings.getwithbase("FEED_EXPORTERS")
+        for uri, options in settings.getdict("FEEDS").items():
+            exporter = exporters.get(options.get("format"))
+            if exporter and writes_on_close(load_object(exporter)):
+                yield uri
+
+    def spider_opened(self, spider):
+        # a spider scraping a part of the pages (e.g. a shard) has its own manifest
+        name = "_".join([spider.name] + list(getattr(spider, "checkpoint_id", ())))
+        self.checkpoint = Checkpoint(os.path.join(self.directory, name + ".jsonl"))
+        spider.checkpoint = self.checkpoint
+        # the requests sent to the engine outside of the callbacks (see PageFrontier.spider_idle)
+        spider.checkpoint_schedule = self.schedule
+        if self.checkpoint:
+            logger.info(f"Resuming the crawl, {len(self.checkpoint)} pages already completed")
+        # the rows of the completed pages spilled by the feeds, kept until the crawl went through every page (the
+        # feeds are opened before this handler, and closed before spider_closed)
+        slots = [slot for slot in self._feed_slots() if hasattr(slot.exporter, "resume")]
+        self.spilling = [slot.exporter for slot in slots]
+        for slot in slots:
+            slot.exporter.keep_spill = True
+            rows = slot.exporter.resume() if self.checkpoint else 0
+            if rows:
+                # the feed is written when the spider is closed even if no item comes
+                slot.start_exporting()
+                slot.itemcount += rows
+
+    def spider_closed(self, spider, reason):
+        self.checkpoint.close(clear=reason == "finished")
+        if reason == "finished":
+            for exporter in self.spilling:
+                if exporter.spill is not None and os.path.exists(exporter.spill):
+                    os.remove(exporter.spill)
+
+    def process_start_requests(self, start_requests, spider):
+        for r in start_requests:
+            if self._schedule(r, None):
+                yield r
+
+    def process_spider_output(self, response, result, spider):
+        key = self._key(response.meta)
+        for i in result:
+            if self._track(i, key):
+                yield i
+        self._finish(key)
+
+    async def process_spider_output_async(self, response, result, spider):
+        key = self._key(response.meta)
+        async for i in result:
+            if self._track(i, key):
+                yield i
+        self._finish(key)
+
+    def item_done(self, item, response, spider):
+        key = self._key(response.meta)
+        if key is not None:
+            self._release(key)
+
+    def schedule(self, request):
+        """Record a request sent to the engine by the spider outside of its callbacks, as a start request.
+
+        Returns:
+            bool: False when the request is the one of a page already completed, and must be dropped.
+        """
+        return self._schedule(request, None)
+
+    @staticmethod
+    def _key(meta):
+        key = meta.get("checkpoint")
+        return tuple(key) if key is not None else None
+
+    def _track(self, output, key):
+        # returns False when the output is the request of a page already completed
+        if isinstance(output, Request):
+            return self._schedule(output, key)
+        if key is not None and is_item(output):
+            self.pending[key] += 1
+        return True
+
+    def _schedule(self, request, parent):
+        key = self._key(request.meta)
+        if key is None:
+            return True
+        if key in self.checkpoint:
+            return False
+        if request.meta.get("checkpoint_root"):
+            # a page of a pagination, recorded on its own
+            parent = None
+        if key != parent and key not in self.pending:
+            # first request of a page, the parent waits for it (a retry of a page keeps its key)
+            self.parents[key] = parent
+            if parent is not None:
+                self.pending[parent] += 1
+        self.pending[key] += 1
+        return True
+
+    def _finish(self, key):
+        # the response of the page was parsed
+        if key is not None:
+            self._release(key)
+
+    def _release(self, key):
+        if key not in self.pending:
+            return
+        self.pending[key] -= 1
+        if self.pending[key] > 0:
+            return
+        del self.pending[key]
+        self._flush_feeds()
+        self.checkpoint.add(key)
+        parent = self.parents.pop(key, None)
+        if parent is not None:
+            self._release(parent)
+
+    def _flush_feeds(self):
+        # the items of a page must be written to the feeds before the page is recorded as completed
+        for slot in self._feed_slots():
+            if hasattr(slot.exporter, "flush"):
+                slot.exporter.flush()
+            if hasattr(slot.file, "flush"):
+                slot.file.flush()
+
+    def _feed_slots(self):
+        for extension in self.crawler.extensions.middlewares:
+            yield from getattr(extension, "slots", ())
+
+
+class AdaptiveConcurrencyMiddleware:
+    """
+        Downloader middleware adapting the concurrency and the delay of the downloads to the load of the registry.
+
+        The registry answers overload with "soft" error pages (a page without its table, see the is_soft_error method
+        of the spiders) rather than with HTTP errors. The responses are observed by windows of
+        ADAPTIVE_CONCURRENCY_WINDOW responses, and the download slot is tuned at the end of each window, AIMD style:
+        - when the rate of soft errors (HTTP errors and timeouts included) is above ADAPTIVE_CONCURRENCY_ERROR_RATE,
+          or when the mean latency is above ADAPTIVE_CONCURRENCY_LATENCY_FACTOR times the lowest mean latency seen so
+          far, the concurrency is halved (and the delay doubled once the concurrency is at its minimum)
+        - otherwise the delay is halved, then the concurrency increased by one once there is no delay
+
+        Enabled with ADAPTIVE_CONCURRENCY_ENABLED, the concurrency starts at ADAPTIVE_CONCURRENCY_START and stays
+        between ADAPTIVE_CONCURRENCY_MIN and ADAPTIVE_CONCURRENCY_MAX (CONCURRENT_REQUESTS by default). Each change is
+        logged, and the current values are kept in the stats (adaptive_concurrency/*).
+    """
+
+    def __init__(self, crawler, settings):
+        self.crawler = crawler
+        self.start = settings.getint("ADAPTIVE_CONCURRENCY_START", 8)
+        self.min = settings.getint("ADAPTIVE_CONCURRENCY_MIN", 1)
+        self.max = settings.getint("ADAPTIVE_CONCURRENCY_MAX") or settings.getint("CONCURRENT_REQUESTS")
+        self.window = settings.getint("ADAPTIVE_CONCURRENCY_WINDOW", 50)
+        self.error_rate = settings.getfloat("ADAPTIVE_CONCURRENCY_ERROR_RATE", 0.02)
+        self.latency_factor = settings.getfloat("ADAPTIVE_CONCURRENCY_LATENCY_FACTOR", 3.0)
+        self.max_delay = settings.getfloat("ADAPTIVE_CONCURRENCY_MAX_DELAY", 10.0)
+        # responses, errors and total latency of the current window, and lowest mean latency, of each download slot
+        self.windows = {}
+        self.best_latency = {}
+        # responses not observed after a decrease: the requests sent before it are still running
+        self.ignored = Counter()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("ADAPTIVE_CONCURRENCY_ENABLED"):
+            raise NotConfigured
+        return cls(crawler, crawler.settings)
+
+    def process_response(self, request, response, spider):
+        is_soft_error = getattr(spider, "is_soft_error", None)
+        error = response.status >= 500 or response.status == 429 or (
+            is_soft_error is not None and isinstance(response, TextResponse) and is_soft_error(request, response)
+        )
+        self._observe(request, error, request.meta.get("download_latency"))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        # timeouts and refused connections are the hard form of the overload
+        self._observe(request, True, None)
+
+    def _observe(self, request, error, latency):
+        key = request.meta.get("download_slot")
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+        if key not in self.windows:
+            slot.concurrency = max(self.min, min(self.start, self.max))
+            self.windows[key] = [0, 0, 0.0, 0]
+        if self.ignored[key] > 0:
+            self.ignored[key] -= 1
+            return
+        window = self.windows[key]
+        window[0] += 1
+        window[1] += bool(error)
+        if latency is not None:
+            window[2] += latency
+            window[3] += 1
+        if window[0] >= self.window:
+            self._adjust(key, slot, *window)
+            self.windows[key] = [0, 0, 0.0, 0]
+
+    def _adjust(self, key, slot, responses, errors, total_latency, timed):
+        error_rate = errors / responses
+        latency = total_latency / timed if timed else None
+        if latency is not None and errors == 0:
+            self.best_latency[key] = min(self.best_latency.get(key, latency), latency)
+        slow = latency is not None and latency > self.latency_factor * self.best_latency.get(key, latency)
+
+        concurrency, delay = slot.concurrency, slot.delay
+        if error_rate > self.error_rate or slow:
+            # multiplicative decrease
+            self.ignored[key] = len(slot.active)
+            if concurrency > self.min:
+                concurrency = max(self.min, concurrency // 2)
+            else:
+                delay = min(self.max_delay, max(delay * 2, 0.25))
+        elif delay > 0:
+            delay = delay / 2 if delay > 0.25 else 0.0
+        else:
+            # additive increase
+            concurrency = min(self.max, concurrency + 1)
+
+        if (concurrency, delay) != (slot.concurrency, slot.delay):
+            logger.info(
+                f"Concurrency {slot.concurrency} -> {concurrency}, delay {slot.delay:.2f}s -> {delay:.2f}s "
+                f"(soft errors {error_rate:.1%}, latency {latency or 0:.2f}s over {responses} responses)"
+            )
+            slot.concurrency, slot.delay = concurrency, delay
+        stats = self.crawler.stats
+        stats.set_value("adaptive_concurrency/concurrency", concurrency)
+        stats.set_value("adaptive_concurrency/delay", delay)
+        stats.max_value("adaptive_concurrency/max_concurrency", concurrency)
+        stats.inc_value("adaptive_concurrency/soft_errors", errors)
+
+
+class SoftErrorRetryMiddleware:
+    """
+        Downloader middleware retrying the "soft" error pages of the registry (see the is_soft_error method of the
+        spiders), with an exponential backoff.
+
+        The n-th retry of a page is sent back to the scheduler after a random delay between d/2 and d, where
+        d = min(SOFT_RETRY_BACKOFF_BASE * 2 ** (n - 1), SOFT_RETRY_BACKOFF_MAX), with a priority lowered by
+        SOFT_RETRY_PRIORITY_ADJUST so that the fresh pages go first. The retry is a copy of the request, so it keeps its
+        meta (page, dico_table_data, checkpoint, ...) and its callbacks. A page is retried at most SOFT_RETRY_TIMES
+        times (or meta["max_soft_retry_times"]), and at most SOFT_RETRY_BUDGET retries are made during the crawl (0 for
+        no limit), after which the error page is given to the spider, which gives up the page.
+
+        The spider is kept open while retries are waiting for their delay. Their number is kept in the stats
+        ('soft_retry/waiting'), so that the PageFrontier of the spider does not request new pages while the pages
+        already requested are waiting to be downloaded again.
+    """
+
+    def __init__(self, crawler, settings):
+        self.crawler = crawler
+        self.max_retry_times = settings.getint("SOFT_RETRY_TIMES", 10)
+        self.budget = settings.getint("SOFT_RETRY_BUDGET", 5000)
+        self.backoff_base = settings.getfloat("SOFT_RETRY_BACKOFF_BASE", 1.0)
+        self.backoff_max = settings.getfloat("SOFT_RETRY_BACKOFF_MAX", 60.0)
+        self.priority_adjust = settings.getint("SOFT_RETRY_PRIORITY_ADJUST", -1)
+        self.retries = 0
+        # retries waiting for their delay
+        self.delayed = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("SOFT_RETRY_ENABLED"):
+            raise NotConfigured
+        s = cls(crawler, crawler.settings)
+        crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_response(self, request, response, spider):
+        is_soft_error = getattr(spider, "is_soft_error", None)
+        if is_soft_error is None or not isinstance(response, TextResponse) or not is_soft_error(request, response):
+            return response
+
+        stats = self.crawler.stats
+        retry_times = request.meta.get("soft_retry_times", 0) + 1
+        if retry_times > request.meta.get("max_soft_retry_times", self.max_retry_times):
+            logger.error(f"Gave up retrying {request.url} (failed {retry_times} times): error page of the registry")
+            stats.inc_value("soft_retry/max_reached")
+            return response
+        if self.budget and self.retries >= self.budget:
+            logger.error(f"Gave up retrying {request.url}: the budget of {self.budget} retries is exhausted")
+            stats.inc_value("soft_retry/budget_exhausted")
+            return response
+
+        self.retries += 1
+        retry = request.replace(
+            priority=request.priority + self.priority_adjust,
+            dont_filter=True,
+        )
+        retry.meta["soft_retry_times"] = retry_times
+        delay = min(self.backoff_base * 2 ** (retry_times - 1), self.backoff_max)
+        delay = random.uniform(delay / 2, delay)
+        logger.debug(f"Retrying {request.url} in {delay:.1f}s (failed {retry_times} times): error page of the registry")
+        stats.inc_value("soft_retry/count")
+
+        call = reactor.callLater(delay, self._schedule, retry)
+        self.delayed.add(call)
+        self._update_waiting()
+        # the retry takes the place of the request, whose callbacks (e.g. the errback of the pagination) are not called
+        request.errback = None
+        raise IgnoreRequest(f"Soft error, retrying in {delay:.1f}s")
+
+    def _schedule(self, retry):
+        self._update_waiting()
+        self.crawler.engine.crawl(retry)
+
+    def _update_waiting(self):
+        self.delayed = {call for call in self.delayed if call.active()}
+        self.crawler.stats.set_value("soft_retry/waiting", len(self.delayed))
+
+    def spider_idle(self, spider):
+        if any(call.active() for call in self.delayed):
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        for call in self.delayed:
+            if call.active():
+                call.cancel()
+        self._update_waiting()
+
+
+class ArchiveMiddleware:
+    """
+        Spider middleware archiving the pages given to the callbacks of the spider (see PageArchive), so that a new
+        version of the parsing can be run on them with 'scrapy reparse_archive <spider>' instead of scraping the
+        registry again.
+
+        The error pages of the registry are not archived, a page downloaded again successfully replaces them.
+    """
+
+    def __init__(self, crawler, directory):
+        self.crawler = crawler
+        self.directory = directory
+        self.archive = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("ARCHIVE_ENABLED"):
+            raise NotConfigured
+        s = cls(crawler, crawler.settings.get("ARCHIVE_DIR", "archive"))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        self.archive = PageArchive(self.directory)
+
+    def spider_closed(self, spider):
+        self.archive.close()
+
+    def process_spider_input(self, response, spider):
+        is_soft_error = getattr(spider, "is_soft_error", None)
+        if is_soft_error is not None and is_soft_error(response.request, response):
+            return
+        try:
+            self.archive.add(spider, response.request, response)
+        except ValueError as e:
+            # e.g. a callback that is not a method of the spider
+            logger.error(f"Can't archive {response.url}: {e}")
+            return
+        self.crawler.stats.inc_value("archive/pages")
+
+
+class DeadLetterMiddleware:
+    """
+        Spider middleware saving the pages that could not be parsed, so that a long crawl never stalls on them.
+
+        A page is saved in the DeadLetterStore of DEAD_LETTER_STORE (URL, request with its meta, compressed body) when
+        it reaches the spider as an error page of the registry (i.e. SoftErrorRetryMiddleware gave it up), or when its
+        callback raises an exception. The saved pages are parsed again with 'scrapy replay_dead_letters <spider>',
+        either offline from their saved body (--offline), or by requesting them again: with DEAD_LETTER_REPLAY, the
+        start requests of the spider are replaced by the saved requests, and the pages parsed successfully are removed
+        from the store.
+    """
+
+    def __init__(self, crawler, path, replay):
+        self.crawler = crawler
+        self.path = path
+        self.replay = replay
+        self.store = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("DEAD_LETTER_ENABLED"):
+            raise NotConfigured
+        s = cls(
+            crawler,
+            crawler.settings.get("DEAD_LETTER_STORE", "dead_letters.sqlite"),
+            crawler.settings.getbool("DEAD_LETTER_REPLAY"),
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        self.store = DeadLetterStore(self.path)
+
+    def spider_closed(self, spider):
+        count = self.store.count(spider.name)
+        if count:
+            logger.warning(f"{count} pages could not be parsed, see 'scrapy replay_dead_letters {spider.name}'")
+        self.store.close()
+
+    def process_start_requests(self, start_requests, spider):
+        if not self.replay:
+            yield from start_requests
+            return
+        logger.info(f"Replaying the {self.store.count(spider.name)} dead letters of {spider.name}")
+        for _, request, _ in self.store.entries(spider):
+            yield request
+
+    def process_spider_input(self, response, spider):
+        is_soft_error = getattr(spider, "is_soft_error", None)
+        if is_soft_error is not None and is_soft_error(response.request, response):
+            self._save(response, spider, "error page of the registry")
+
+    def process_spider_output(self, response, result, spider):
+        yield from result
+        self._parsed(response)
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for i in result:
+            yield i
+        self._parsed(response)
+
+    def process_spider_exception(self, response, exception, spider):
+        self._save(response, spider, repr(exception))
+
+    def _save(self, response, spider, reason):
+        try:
+            self.store.add(spider, response.request, response, reason)
+        except ValueError as e:
+            # e.g. a callback that is not a method of the spider
+            logger.error(f"Can't save {response.url} in the dead letters: {e}")
+            return
+        self.crawler.stats.inc_value("dead_letters/count")
+
+    def _parsed(self, response):
+        entry_id = response.meta.get("dead_letter_id")
+        is_soft_error = getattr(self.crawler.spider, "is_soft_error", None)
+        if entry_id is not None and not (is_soft_error and is_soft_error(response.request, response)):
+            # a replayed page was parsed successfully
+            self.store.remove(entry_id)
+            self.crawler.stats.inc_value("dead_letters/replayed")
+
+
+class CallbackMetricsMiddleware:
+    """
+        Figures of each callback of the spider, in the stats as 'metrics/<callback>/<name>' (reported by
+        extensions.CrawlMetrics).
+
+        Registered both as a downloader middleware, where it counts the responses, their bytes and the soft error
+        pages, and times the parsing of the page into a tree (the selector, reused afterwards by the soft error checks
+        and the callback), and as the spider middleware closest to the spider, where it times the callback and counts
+        the items and the requests it yields (with PARSE_PROCESSES, the pages are parsed into trees by the processes of
+        offload.ParsePool, whose time is part of the time of the callback). The downloader middleware has to come after
+        the decompression (HttpCompressionMiddleware, 590) and before SoftErrorRetryMiddleware (560).
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("METRICS_ENABLED"):
+            raise NotConfigured
+        return cls(crawler.stats)
+
+    def process_response(self, request, response, spider):
+        prefix = f"metrics/{callback_name(request)}/"
+        self.stats.inc_value(prefix + "responses")
+        self.stats.inc_value(prefix + "bytes", len(response.body))
+        if isinstance(response, TextResponse):
+            parse_pool = getattr(spider, "parse_pool", None)
+            # with PARSE_PROCESSES, the pages are parsed by the pool of processes instead
+            if parse_pool is None or not parse_pool.enabled:
+                start = time.perf_counter()
+                response.selector
+                self.stats.inc_value(prefix + "selector_seconds", time.perf_counter() - start)
+            is_soft_error = getattr(spider, "is_soft_error", None)
+            if is_soft_error is not None and is_soft_error(request, response):
+                self.stats.inc_value(prefix + "soft_errors")
+        return response
+
+    def process_spider_output(self, response, result, spider):
+        prefix = f"metrics/{callback_name(response.request)}/"
+        result = iter(result)
+        while True:
+            start = time.perf_counter()
+            try:
+                element = next(result)
+            except StopIteration:
+                return
+            finally:
+                self.stats.inc_value(prefix + "wall_seconds", time.perf_counter() - start)
+            self._count(prefix, element)
+            yield element
+
+    async def process_spider_output_async(self, response, result, spider):
+        prefix = f"metrics/{callback_name(response.request)}/"
+        result = result.__aiter__()
+        while True:
+            start = time.perf_counter()
+            try:
+                element = await result.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                self.stats.inc_value(prefix + "wall_seconds", time.perf_counter() - start)
+            self._count(prefix, element)
+            yield element
+
+    def _count(self, prefix, element):
+        self.stats.inc_value(prefix + ("requests" if isinstance(element, Request) else "items"))
+
+
+class CallbackProfilerMiddleware:
+    """
+        Spider middleware profiling the callbacks of PROFILE_CALLBACKS (e.g. parse_compliances) with cProfile, one
+        response out of PROFILE_EVERY, so that a crawl is profiled without changing the spider and without the cost
+        of profiling every response.
+
+        The profiles of each callback are added together and written to PROFILE_DIR when the spider is closed: a
+        <run>.<callback>.pstats file (read with pstats, snakeviz, ...) and the functions taking the most time in
+        <run>.callbacks.json (see extensions.run_name). Only the code run by the callback itself is profiled (the
+        selectors, the building of the items, ...), not the other components of Scrapy.
+
+    Attributes:
+
+        crawler (scrapy.crawler.Crawler): the crawler of the spider.
+        directory (str): the directory of the results.
+        callbacks (set): the names of the callbacks profiled.
+        every (int): one response out of `every` is profiled.
+        top (int): the number of functions of the summary.
+    """
+
+    def __init__(self, crawler, directory, callbacks, every, top=20):
+        self.crawler = crawler
+        self.directory = directory
+        self.callbacks = set(callbacks)
+        self.every = max(every, 1)
+        self.top = top
+        self.responses = Counter()
+        self.profiled = Counter()
+        self.profiles = {}
+        # a single profiler can be enabled at a time
+        self._active = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        callbacks = crawler.settings.getlist("PROFILE_CALLBACKS")
+        if not callbacks:
+            raise NotConfigured
+        middleware = cls(
+            crawler,
+            crawler.settings.get("PROFILE_DIR"),
+            callbacks,
+            crawler.settings.getint("PROFILE_EVERY", 100),
+            crawler.settings.getint("PROFILE_TOP", 20),
+        )
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_closed(self, spider):
+        if not self.profiles:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, run_name(self.crawler, spider))
+        summary = {}
+        for callback, profile in self.profiles.items():
+            profile.dump_stats(f"{path}.{callback}.pstats")
+            stats = pstats.Stats(profile).sort_stats(pstats.SortKey.CUMULATIVE)
+            functions = []
+            for function in stats.fcn_list[: self.top]:
+                calls, _, own, cumulative, _ = stats.stats[function]
+                functions.append({
+                    "function": pstats.func_std_string(function),
+                    "calls": calls,
+                    "own_seconds": own,
+                    "cumulative_seconds": cumulative,
+                })
+            summary[callback] = {
+                "responses": self.responses[callback],
+                "profiled": self.profiled[callback],
+                "functions": functions,
+            }
+        with open(f"{path}.callbacks.json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        logger.info(f"Profiles of the callbacks {', '.join(sorted(self.profiles))} written to {path}.*")
+
+    def _profile(self, response):
+        """The profile of the response, None if it is not profiled."""
+        callback = callback_name(response.request)
+        if callback not in self.callbacks:
+            return None
+        self.responses[callback] += 1
+        # the first response, then one out of `every`
+        if (self.responses[callback] - 1) % self.every:
+            return None
+        self.profiled[callback] += 1
+        if callback not in self.profiles:
+            self.profiles[callback] = cProfile.Profile()
+        return self.profiles[callback]
+
+    def _enable(self, profile):
+        if profile is None or self._active is not None:
+            return False
+        self._active = profile
+        profile.enable()
+        return True
+
+    def _disable(self, enabled):
+        if enabled:
+            self._active.disable()
+            self._active = None
+
+    def process_spider_output(self, response, result, spider):
+        profile = self._profile(response)
+        result = iter(result)
+        while True:
+            enabled = self._enable(profile)
+            try:
+                element = next(result)
+            except StopIteration:
+                return
+            finally:
+                self._disable(enabled)
+            yield element
+
+    async def process_spider_output_async(self, response, result, spider):
+        profile = self._profile(response)
+        result = result.__aiter__()
+        while True:
+            enabled = self._enable(profile)
+            try:
+                element = await result.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                self._disable(enabled)
+            yield element
+
+
+class RegistryMirrorMiddleware:
+    """
+        Downloader middleware sending the requests of the registry to another server, such as the mock of the registry
+        (python -m scrapy_scraper.mock_registry), enabled by setting REGISTRY_MIRROR to the URL of the server.
+
+    Attributes:
+
+        mirror (str): the URL replacing the one of the registry (utils.REGISTRY_URL) at the start of the URLs.
+    """
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        mirror = crawler.settings.get("REGISTRY_MIRROR")
+        if not mirror:
+            raise NotConfigured
+        logger.info(f"Requests of the registry sent to {mirror}")
+        return cls(mirror)
+
+    def process_request(self, request, spider):
+        url = mirror_url(request.url, self.mirror)
+        if url != request.url:
+            # the new request goes through the downloader middlewares again
+            return request.replace(url=url)
@@ -0,0 +1,427 @@
+# Mock of the EU ETS registry, to run the spiders offline (see the bench_registry command)
+#
+# python -m scrapy_scraper.mock_registry --port 8765 --transactions 100000 --accounts 5000 --latency 0.3
+#
+# An asyncio HTTP server serving the pages read by the spiders: the table of the Operator Holding accounts (oha.do),
+# the compliance page of each account (ohaDetails.do) and the searches of transactions (transaction.do). The pages are
+# generated from templates and a synthetic dataset, the same for a given seed, with the quirks of the registry (page
+# n - 1 served for resultList.currentPageNumber=n). The latency of the pages follows a log-normal distribution, and
+# the error pages of the overloaded registry (a listing without its pagination inputs) are injected at random, and
+# more often when more than --capacity requests are served at the same time. The spiders are sent to the mock with
+# -s REGISTRY_MIRROR=http://127.0.0.1:8765.
+
+import argparse
+import asyncio
+import bisect
+import logging
+import math
+import random
+import signal
+from collections import Counter
+from datetime import datetime, timedelta
+from html import escape
+from string import Template
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+REGISTRIES = ("AT", "BE", "DE", "ES", "FR", "IT", "NL", "PL")
+
+COUNTRIES = ("Austria", "Belgium", "Germany", "Spain", "France", "Italy", "Netherlands", "Poland")
+
+ACTIVITIES = ("Combustion of fuels", "Production of cement clinker", "Refining of mineral oil", "Aircraft operator activities")
+
+ACCOUNT_TYPES = ("Operator Holding Account", "Person Holding Account", "Trading Account", "Aircraft Operator Account")
+
+CELL = Template('<td class="bgtablecell"><span class="classictext">&nbsp;$value&nbsp;</span></td>')
+
+PAGINATION = Template(
+    '<table><tr><td class="bgpagecontent"><input type="hidden" name="form" value="oha"/>'
+    '<input type="hidden" name="languageCode" value="en"/>'
+    '<input type="hidden" name="resultList.currentPageNumber" value="$page"/>'
+    '<input type="submit" value="Next"/>'
+    '<input type="text" name="resultList.lastPageNumber" value="$pages"/></td></tr></table>'
+)
+
+ACCOUNT_LINK = Template(
+    '<td class="bgtablecell"><table><tr><td><span>&nbsp;</span></td><td>'
+    '<a href="/clima/ets/ohaDetails.do?accountID=$account_id&amp;action=all&amp;languageCode=en'
+    '&amp;returnURL=resultList.currentPageNumber%3D$page">Details - All Phases</a></td></tr></table></td>'
+)
+
+ACCOUNTS_PAGE = Template(
+    '<html><body><form>$pagination<table id="tblAccountSearchResult">'
+    '<tr><td colspan="11">Operator Holding Accounts</td></tr><tr>$headers</tr>$rows</table></form></body></html>'
+)
+
+COMPLIANCE_TABLE = Template(
+    '<table><tr><td colspan="8">Compliance information</td></tr><tr>$headers</tr>$notes$rows$footnotes</table>'
+)
+
+ACCOUNT_PAGE = Template(
+    '<html><body>'
+    '<table id="tblAccountGeneralInfo"><tr><td>General Information</td></tr><tr>$general_headers</tr>'
+    '<tr>$general</tr></table>'
+    '<table id="tblAccountContactInfo"><tr><td>Details on Contact Information</td></tr><tr>$contact_headers</tr>'
+    '<tr>$contact</tr></table>'
+    '<table id="tblChildDetails"><tr><td><table><tr><td>Installation</td></tr><tr>$child_headers</tr>'
+    '<tr>$child</tr></table></td></tr><tr><td>$compliances</td></tr></table>'
+    '</body></html>'
+)
+
+TRANSACTIONS_PAGE = Template(
+    '<html><body>$pagination<table id="tblTransactionSearchResult"><tr><th colspan="15">Transactions</th></tr>'
+    '<tr>$headers</tr>$rows</table></body></html>'
+)
+
+# page of the overloaded registry, without the table and its pagination
+ERROR_PAGE = "<html><body><p>The service is temporarily unavailable, please try again later.</p></body></html>"
+
+
+def cells(values):
+    return "".join(CELL.substitute(value=escape(str(value))) for value in values)
+
+
+def headers(count):
+    return "".join(f"<th>Column {i}</th>" for i in range(1, count + 1))
+
+
+def quantity(rng, high):
+    return f"{rng.randint(0, high):,}"
+
+
+class Timeline:
+    """
+        The dates of the synthetic transactions, spread evenly over the period, as a sequence (bisect finds the
+        transactions of a window of dates without building the list).
+
+    Attributes:
+
+        start (datetime): the date of the first transaction.
+        seconds (int): the length of the period.
+        count (int): the number of transactions.
+    """
+
+    def __init__(self, start, end, count):
+        self.start = start
+        self.seconds = int((end - start).total_seconds())
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.start + timedelta(seconds=index * self.seconds // self.count)
+
+
+class MockRegistry:
+    """
+        Synthetic dataset of the registry and the pages built from it, generated on demand from the seed (the
+        content of a page only depends on the seed and the page).
+
+    Attributes:
+
+        transactions (int): the number of transactions.
+        accounts (int): the number of Operator Holding accounts.
+        page_size (int): the number of rows of a page of a table.
+        seed (int): the seed of the dataset.
+        timeline (Timeline): the dates of the transactions, from 2005 to the end of 2023.
+    """
+
+    def __init__(self, transactions=100000, accounts=5000, page_size=10, seed=0):
+        self.transactions = transactions
+        self.accounts = accounts
+        self.page_size = page_size
+        self.seed = seed
+        self.timeline = Timeline(datetime(2005, 1, 1), datetime(2024, 1, 1), transactions)
+
+    def pages(self, rows):
+        return max(1, math.ceil(rows / self.page_size))
+
+    def accounts_page(self, page):
+        """A page of the table of the Operator Holding accounts (numbered from 1)."""
+        first = (page - 1) * self.page_size
+        rows = []
+        for index in range(first, min(first + self.page_size, self.accounts)):
+            account = self.account(index)
+            rows.append(
+                "<tr>" + cells(account["listing"]) + ACCOUNT_LINK.substitute(account_id=account["id"], page=page + 1)
+                + "</tr>"
+            )
+        return ACCOUNTS_PAGE.substitute(
+            pagination=PAGINATION.substitute(page=page, pages=self.pages(self.accounts)),
+            headers=headers(11),
+            rows="".join(rows),
+        )
+
+    def account_page(self, account_id):
+        """The compliance page of an account, None if there is no such account."""
+        index = account_id - 1000
+        if not 0 <= index < self.accounts:
+            return None
+        account = self.account(index)
+        compliances = f"<div>{self.compliance_table(account['EU'], notes=0, footnotes=3)}</div>"
+        if account["CH"]:
+            compliances += f"<div>{self.compliance_table(account['CH'], notes=2, footnotes=4)}</div>"
+        return ACCOUNT_PAGE.substitute(
+            general_headers=headers(8),
+            general=cells(account["general"]),
+            contact_headers=headers(11),
+            contact=cells(account["contact"]),
+            child_headers=headers(11),
+            child=cells(account["child"]),
+            compliances=compliances,
+        )
+
+    def compliance_table(self, years, notes, footnotes):
+        return COMPLIANCE_TABLE.substitute(
+            headers=headers(8),
+            notes='<tr><td colspan="8"><span>Note</span></td></tr>' * notes,
+            rows="".join("<tr>" + cells(row) + "</tr>" for row in years),
+            footnotes='<tr><td colspan="8"><span>* Footnote</span></td></tr>' * footnotes,
+        )
+
+    def account(self, index):
+        """The data of the account of an index."""
+        rng = random.Random(f"{self.seed}-account-{index}")
+        aircraft = index % 3 == 0
+        registry = rng.randrange(len(COUNTRIES))
+        first_year = 2005 + rng.randint(0, 8)
+
+        def years(first, last):
+            return [
+                ("2", year, quantity(rng, 999999), quantity(rng, 999999), quantity(rng, 999999),
+                 quantity(rng, 9999999), quantity(rng, 9999999), rng.choice(("A", "B", "C", "-")))
+                for year in range(first, last + 1)
+            ]
+
+        return {
+            "id": 1000 + index,
+            "listing": (
+                COUNTRIES[registry],
+                "Aircraft Operator Account" if aircraft else "Operator Holding Account",
+                f"Holder {rng.randint(1, 3000)} GmbH",
+                100000 + index,
+                f"Installation {index}",
+                f"RN{rng.randint(1, 99999)}",
+                f"P-{index}",
+                f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/20{rng.randint(5, 20):02d}",
+                ACTIVITIES[3] if aircraft else rng.choice(ACTIVITIES[:3]),
+                rng.choice(("A", "B", "C")),
+            ),
+            "general": ("", index, "", "", "", "OPEN", "", ""),
+            "contact": (
+                "Account holder", f"LEI{index}", f"{index} Main street", "", rng.randint(1000, 99999), "City",
+                REGISTRIES[registry], "+49 1", "", "contact@example.eu", "",
+            ),
+            "child": (
+                "", "", "", "", 2030, "Subsidiary", "Parent", f"E{index}", "ICAO" if aircraft else "", first_year, 2030,
+            ),
+            "EU": years(first_year, 2030),
+            "CH": years(2020, 2030) if aircraft else [],
+        }
+
+    def transactions_window(self, start_date, end_date):
+        """The range of the indexes of the transactions between two dates (included), None for no limit."""
+        first = bisect.bisect_left(self.timeline, start_date) if start_date else 0
+        last = bisect.bisect_left(self.timeline, end_date + timedelta(days=1)) if end_date else self.transactions
+        return range(first, last)
+
+    def transactions_page(self, window, page):
+        """A page of a search of transactions (numbered from 1), window being the indexes of its transactions."""
+        first = (page - 1) * self.page_size
+        rows = "".join(
+            "<tr>" + cells(self.transaction(index)) + "</tr>"
+            for index in window[first:first + self.page_size]
+        )
+        return TRANSACTIONS_PAGE.substitute(
+            pagination=PAGINATION.substitute(page=page, pages=self.pages(len(window))),
+            headers=headers(15),
+            rows=rows,
+        )
+
+    def transaction(self, index):
+        """The cells of the row of a transaction."""
+        rng = random.Random(f"{self.seed}-transaction-{index}")
+        registry = rng.choice(REGISTRIES)
+        transferring, acquiring = rng.randrange(self.accounts or 1), rng.randrange(self.accounts or 1)
+        return (
+            f"{registry}{index + 1}",
+            rng.choice(("10-0", "3-0", "1-0", "4-0")),
+            f"{self.timeline[index]}.0",
+            "Completed",
+            rng.choice(COUNTRIES),
+            rng.choice(ACCOUNT_TYPES),
+            f"Account {transferring}",
+            100000 + transferring,
+            f"Holder {transferring % 3000} GmbH",
+            rng.choice(COUNTRIES),
+            rng.choice(ACCOUNT_TYPES),
+            f"Account {acquiring}",
+            100000 + acquiring,
+            f"Holder {acquiring % 3000} GmbH",
+            quantity(rng, 500000),
+        )
+
+
+class MockRegistryServer:
+    """
+        asyncio HTTP/1.1 server of the pages of a MockRegistry, with keep-alive connections.
+
+    Attributes:
+
+        registry (MockRegistry): the dataset of the pages.
+        latency (float): the median latency of a page in seconds, 0 for none.
+        latency_sigma (float): the sigma of the log-normal distribution of the latency.
+        soft_error_rate (float): the probability that a page of a table is an error page.
+        capacity (int): the number of requests served at the same time beyond which the latency grows and the error
+            pages become more frequent (0 for no limit).
+        counts (collections.Counter): the number of responses of each kind.
+    """
+
+    def __init__(self, registry, latency=0.0, latency_sigma=0.5, soft_error_rate=0.0, capacity=0, seed=0):
+        self.registry = registry
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.soft_error_rate = soft_error_rate
+        self.capacity = capacity
+        self.counts = Counter()
+        self.in_flight = 0
+        self._random = random.Random(seed)
+
+    async def handle(self, reader, writer):
+        """Serve the requests of a connection."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode("latin-1").split()
+                request_headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    request_headers[name.strip().lower()] = value.strip()
+                status, body = await self.respond(target)
+                keep_alive = version == "HTTP/1.1" and request_headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: text/html; charset=utf-8\r\nContent-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, target):
+        """The status and the body of the response to a request."""
+        self.in_flight += 1
+        try:
+            overload = max(0, self.in_flight - self.capacity) / self.capacity if self.capacity else 0
+            if self.latency:
+                delay = self._random.lognormvariate(math.log(self.latency), self.latency_sigma)
+                await asyncio.sleep(delay * (1 + overload))
+            url = urlsplit(target)
+            query = {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+            kind, body = self.page(url.path, query, overload)
+            self.counts[kind] += 1
+            if body is None:
+                return "404 Not Found", b"Not Found"
+            return "200 OK", body.encode("utf-8")
+        finally:
+            self.in_flight -= 1
+
+    def page(self, path, query, overload):
+        """The kind and the HTML of a page, None if it does not exist."""
+        if path.endswith("/ohaDetails.do"):
+            # the compliance pages are never error pages
+            account_id = query.get("accountID", "")
+            return "account", self.registry.account_page(int(account_id)) if account_id.isdigit() else None
+        if not path.endswith(("/oha.do", "/transaction.do")):
+            return "not_found", None
+        # the error pages of the overloaded registry
+        share_served = 1 / (1 + overload)
+        if self._random.random() > (1 - self.soft_error_rate) * share_served:
+            return "soft_error", ERROR_PAGE
+        # the registry serves the page n - 1 for resultList.currentPageNumber=n, the first page without it
+        number = query.get("resultList.currentPageNumber", "")
+        page = max(1, int(number) - 1) if number.isdigit() and "search" not in query else 1
+        if path.endswith("/oha.do"):
+            return "accounts", self.registry.accounts_page(page)
+        window = self.registry.transactions_window(
+            parse_form_date(query.get("startDate", "")), parse_form_date(query.get("endDate", ""))
+        )
+        return "transactions", self.registry.transactions_page(window, page)
+
+    def summary(self):
+        return ", ".join(f"{count} {kind}" for kind, count in sorted(self.counts.items())) or "no request"
+
+
+def parse_form_date(value):
+    """Date of a search form (dd/mm/yyyy), None if empty."""
+    return datetime.strptime(value, "%d/%m/%Y") if value else None
+
+
+def add_arguments(parser):
+    """Add the options of the mock registry to an argument parser (shared with the bench_registry command)."""
+    parser.add_argument("--transactions", type=int, default=100000, help="number of transactions (default: 100000)")
+    parser.add_argument("--accounts", type=int, default=5000, help="number of Operator Holding accounts (default: 5000)")
+    parser.add_argument("--page-size", type=int, default=10, help="number of rows of a page (default: 10)")
+    parser.add_argument("--latency", type=float, default=0.0, help="median latency of a page in seconds (default: 0)")
+    parser.add_argument("--latency-sigma", type=float, default=0.5,
+                        help="sigma of the log-normal distribution of the latency (default: 0.5)")
+    parser.add_argument("--soft-error-rate", type=float, default=0.0,
+                        help="probability that a page of a table is an error page (default: 0)")
+    parser.add_argument("--capacity", type=int, default=0,
+                        help="requests served at the same time before the registry slows down and fails more often "
+                             "(default: no limit)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the dataset and of the random latencies")
+
+
+def arguments_command_line(args):
+    """The command line options of add_arguments for the values of parsed arguments."""
+    return [
+        "--transactions", str(args.transactions), "--accounts", str(args.accounts),
+        "--page-size", str(args.page_size), "--latency", str(args.latency),
+        "--latency-sigma", str(args.latency_sigma), "--soft-error-rate", str(args.soft_error_rate),
+        "--capacity", str(args.capacity), "--seed", str(args.seed),
+    ]
+
+
+async def serve(args):
+    server = MockRegistryServer(
+        MockRegistry(args.transactions, args.accounts, args.page_size, args.seed),
+        args.latency,
+        args.latency_sigma,
+        args.soft_error_rate,
+        args.capacity,
+        args.seed,
+    )
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    listener = await asyncio.start_server(server.handle, args.host, args.port, backlog=1024)
+    logger.info(f"Mock registry listening on http://{args.host}:{args.port}")
+    async with listener:
+        await stopped.wait()
+    logger.info(f"Mock registry stopped: {server.summary()}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a mock of the EU ETS registry")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(name)s] %(levelname)s: %(message)s")
+    asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# Parsing of the pages in a pool of processes (-s PARSE_PROCESSES=4)
+#
+# The callbacks parse the pages on the thread of the event loop, so a crawl uses a single core for the parsing however
+# many pages are downloaded at the same time. With PARSE_PROCESSES, the text of the pages of the tables and of the
+# compliance pages is sent to a pool of processes, which build the tree of the page, run the extractors
+# (extractors.py) and send back plain tuples of values. The callbacks await the result while the downloads go on, and
+# rebuild the rows of the items from the tuples.
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from parsel import Selector
+from scrapy import signals
+
+from scrapy_scraper.extractors import compile_css
+
+logger = logging.getLogger(__name__)
+
+# input holding the number of pages of the tables of the registry, missing from its error pages
+PAGINATION_INPUT = b'name="resultList.lastPageNumber"'
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled(css):
+    return compile_css(css)
+
+
+def row_link(row, link_css):
+    """The href of the link of a row of a table, None if it has none."""
+    found = _compiled(link_css)(row) if link_css else None
+    return found[0].get("href") if found else None
+
+
+def table_rows(root, table, link_css=None):
+    """Extract the rows of a table as tuples (in a process of the pool).
+
+    Args:
+        root (lxml.etree._Element): the root of the page.
+        table (extractors.TableExtractor): the extractor of the table.
+        link_css (str): the CSS selector of a link in each row, None for no link.
+
+    Returns:
+        list: the values of the fields of each row (see TableExtractor.fields) and the href of its link.
+    """
+    return [(tuple(data.values()), row_link(row, link_css)) for row, data in table.extract(root)]
+
+
+def compliance_tuples(root, page):
+    """Extract a compliance page as tuples (in a process of the pool).
+
+    Args:
+        root (lxml.etree._Element): the root of the page.
+        page (extractors.ComplianceExtractor): the extractor of the page.
+
+    Returns:
+        tuple: the (field, value) pairs of the header, and the scheme, the year and the values of the metrics (see
+        ComplianceExtractor.metric_names) of each compliance year.
+    """
+    return (
+        tuple(page.extract_header(root).items()),
+        tuple((scheme, year, tuple(metrics.values())) for scheme, year, metrics in page.extract_years(root)),
+    )
+
+
+def parse_text(function, text, *args):
+    """Build the tree of a page and run an extraction function on it, in a process of the pool."""
+    return function(Selector(text=text).root, *args)
+
+
+def has_pagination(response):
+    """Tell whether a page of a table of the registry has its pagination, from its raw body (without parsing it)."""
+    return PAGINATION_INPUT in response.body
+
+
+class ParsePool:
+    """
+        Run the extractors of the pages in a pool of PARSE_PROCESSES processes, or on the page of the response when
+        the pool is disabled (PARSE_PROCESSES = 0, the default).
+
+        The processes are spawned, so that they don't inherit the threads of the crawl, and each process compiles the
+        extractors once (see extractors.TableExtractor). Outside a crawl (e.g. when a spider is created without its
+        crawler), a spider uses a disabled pool.
+
+    Attributes:
+
+        processes (int): the number of processes, 0 to parse in the process of the crawl.
+        executor (concurrent.futures.ProcessPoolExecutor): the pool, None if disabled.
+    """
+
+    def __init__(self, processes=0):
+        self.processes = processes
+        self.executor = None
+        if processes:
+            self.executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pool = cls(crawler.settings.getint("PARSE_PROCESSES", 0))
+        if pool.enabled:
+            logger.info(f"Pages parsed by a pool of {pool.processes} processes")
+            crawler.signals.connect(pool.close, signal=signals.spider_closed)
+        return pool
+
+    @property
+    def enabled(self):
+        return self.executor is not None
+
+    async def rows(self, table, response, link_css=None):
+        """Extract the rows of a table of a page.
+
+        Args:
+            table (extractors.TableExtractor): the extractor of the table.
+            response (scrapy.http.TextResponse): the page.
+            link_css (str): the CSS selector of a link in each row, None for no link.
+
+        Returns:
+            list: the dictionary of the fields of each row and the href of its link (None if it has none).
+        """
+        if self.executor is None:
+            return [(data, row_link(row, link_css)) for row, data in table.extract(response.selector.root)]
+        rows = await self._submit(table_rows, response, table, link_css)
+        fields = table.fields
+        return [(dict(zip(fields, values)), link) for values, link in rows]
+
+    async def compliance_page(self, page, response):
+        """Extract a compliance page.
+
+        Args:
+            page (extractors.ComplianceExtractor): the extractor of the page.
+            response (scrapy.http.TextResponse): the page.
+
+        Returns:
+            tuple: the header fields (dict), and the (scheme, year, metrics) of the compliance years (list).
+        """
+        if self.executor is None:
+            root = response.selector.root
+            return page.extract_header(root), list(page.extract_years(root))
+        header, years = await self._submit(compliance_tuples, response, page)
+        metrics = page.metric_names
+        return dict(header), [(scheme, year, dict(zip(metrics, values))) for scheme, year, values in years]
+
+    async def _submit(self, function, response, *args):
+        return await asyncio.wrap_future(self.executor.submit(parse_text, function, response.text, *args))
+
+    def close(self, spider):
+        self.executor.shutdown(wait=True, cancel_futures=True)
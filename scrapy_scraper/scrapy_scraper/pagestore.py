@@ -0,0 +1,269 @@
+# Local storage of downloaded pages
+#
+# DeadLetterStore keeps the pages that could not be parsed (error pages given up after their retries, pages raising an
+# exception in their callback), with the request that led to them, so they can be parsed again offline or requested
+# again in a later run (scrapy replay_dead_letters). PageArchive keeps every page parsed during a crawl, so that a change
+# of the parsing can be applied to the pages already downloaded (scrapy reparse_archive).
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import zlib
+from datetime import datetime
+
+from scrapy.http import HtmlResponse
+from scrapy.utils.request import request_from_dict
+
+# keys of the meta that only make sense for the download that failed
+TRANSIENT_META = ("download_slot", "download_latency", "download_timeout", "depth", "soft_retry_times", "retry_times")
+
+
+def request_data(spider, request):
+    """Serialize a request with Request.to_dict, without what only makes sense for its download.
+
+    Args:
+        spider (scrapy.Spider): the spider of the request, its callback has to be a method of the spider.
+        request (scrapy.Request): the request to serialize.
+
+    Returns:
+        bytes: the pickled dictionary, to be loaded with request_from_dict.
+    """
+    # the error callbacks of the pagination are not methods of the spider, and are not needed by a replay
+    data = request.replace(errback=None).to_dict(spider=spider)
+    data["meta"] = {key: value for key, value in data["meta"].items() if key not in TRANSIENT_META}
+    return pickle.dumps(data, protocol=4)
+
+
+class DeadLetterStore:
+    """
+        SQLite store of the pages that failed to be parsed.
+
+        A page is identified by its spider, its URL and its callback, a page failing again replaces its former entry.
+        The request is stored as the dictionary of Request.to_dict (pickled), and the body is compressed with zlib.
+
+    Attributes:
+
+        path (str): location of the SQLite database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY,
+                spider TEXT,
+                url TEXT,
+                callback TEXT,
+                request BLOB,
+                status INTEGER,
+                encoding TEXT,
+                body BLOB,
+                reason TEXT,
+                failed_at TEXT,
+                UNIQUE (spider, url, callback)
+            )
+            """
+        )
+
+    def add(self, spider, request, response, reason):
+        """Record a page that failed to be parsed.
+
+        Args:
+            spider (scrapy.Spider): the spider of the request.
+            request (scrapy.Request): the request of the page, its callback has to be a method of the spider.
+            response (scrapy.http.Response): the downloaded page, None if there is no page.
+            reason (str): why the page failed, e.g. the exception raised by the callback.
+        """
+        data = request_data(spider, request)
+        self._db.execute(
+            "INSERT OR REPLACE INTO dead_letters (spider, url, callback, request, status, encoding, body, reason, "
+            "failed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                spider.name,
+                request.url,
+                callback_name(request),
+                data,
+                response.status if response is not None else None,
+                getattr(response, "encoding", None),
+                zlib.compress(response.body) if response is not None else None,
+                reason,
+                datetime.now().isoformat(),
+            ),
+        )
+        self._db.commit()
+
+    def entries(self, spider):
+        """The pages that failed for a spider.
+
+        Args:
+            spider (scrapy.Spider): the spider, whose methods are the callbacks of the stored requests.
+
+        Yields:
+            tuple: the id of the entry, the request, and the stored page as an HtmlResponse (None without a page).
+        """
+        rows = self._db.execute(
+            "SELECT id, request, status, encoding, body FROM dead_letters WHERE spider = ? ORDER BY id",
+            (spider.name,),
+        ).fetchall()
+        for entry_id, data, status, encoding, body in rows:
+            request = request_from_dict(pickle.loads(data), spider=spider)
+            request.meta["dead_letter_id"] = entry_id
+            response = None
+            if body is not None:
+                response = HtmlResponse(
+                    request.url,
+                    status=status,
+                    body=zlib.decompress(body),
+                    encoding=encoding or "utf-8",
+                    request=request,
+                )
+            yield entry_id, request, response
+
+    def remove(self, entry_id):
+        """Delete an entry, once its page was parsed successfully."""
+        self._db.execute("DELETE FROM dead_letters WHERE id = ?", (entry_id,))
+        self._db.commit()
+
+    def count(self, spider_name=None):
+        """Number of entries, of a spider or of every spider."""
+        if spider_name is None:
+            return self._db.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+        return self._db.execute("SELECT COUNT(*) FROM dead_letters WHERE spider = ?", (spider_name,)).fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+class PageArchive:
+    """
+        Archive of the pages downloaded by a spider, content-addressed.
+
+        The bodies are stored once per content, compressed with zlib, in objects/<2 first characters of the SHA-1>/<SHA-1>
+        under the directory of the archive, the identical pages (e.g. the same page downloaded twice) sharing their file.
+        The index (index.sqlite) maps each page, identified by its spider, URL and callback, to its request (serialized
+        like in DeadLetterStore), its status, its encoding and the SHA-1 of its body. A page downloaded again replaces
+        its former entry.
+
+    Attributes:
+
+        directory (str): location of the archive.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite"))
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY,
+                spider TEXT,
+                url TEXT,
+                callback TEXT,
+                request BLOB,
+                status INTEGER,
+                encoding TEXT,
+                digest TEXT,
+                fetched_at TEXT,
+                UNIQUE (spider, url, callback)
+            )
+            """
+        )
+        self._pending = 0
+
+    def add(self, spider, request, response):
+        """Archive a downloaded page.
+
+        Args:
+            spider (scrapy.Spider): the spider of the request.
+            request (scrapy.Request): the request of the page, its callback has to be a method of the spider.
+            response (scrapy.http.Response): the downloaded page.
+        """
+        digest = hashlib.sha1(response.body).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written under another name first, an interrupted crawl never leaves a truncated body
+            with open(path + ".tmp", "wb") as f:
+                f.write(zlib.compress(response.body))
+            os.replace(path + ".tmp", path)
+        self._db.execute(
+            "INSERT OR REPLACE INTO pages (spider, url, callback, request, status, encoding, digest, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                spider.name,
+                request.url,
+                callback_name(request),
+                request_data(spider, request),
+                response.status,
+                getattr(response, "encoding", None),
+                digest,
+                datetime.now().isoformat(),
+            ),
+        )
+        self._pending += 1
+        if self._pending >= 100:
+            self.commit()
+
+    def pages(self, spider_name, callbacks=None):
+        """The archived pages of a spider, in the order they were downloaded.
+
+        Args:
+            spider_name (str): the name of the spider.
+            callbacks (list): only the pages of these callbacks (names of methods of the spider), every page if None.
+
+        Yields:
+            tuple: the serialized request, the status, the encoding and the SHA-1 of the body of a page (see response()).
+        """
+        query = "SELECT request, status, encoding, digest FROM pages WHERE spider = ?"
+        parameters = [spider_name]
+        if callbacks:
+            query += f" AND callback IN ({', '.join('?' * len(callbacks))})"
+            parameters += callbacks
+        yield from self._db.execute(query + " ORDER BY id", parameters)
+
+    def callbacks(self, spider_name):
+        """Names of the callbacks of the archived pages of a spider, in the order of their first page."""
+        rows = self._db.execute(
+            "SELECT callback FROM pages WHERE spider = ? GROUP BY callback ORDER BY MIN(id)", (spider_name,)
+        )
+        return [callback for callback, in rows]
+
+    def response(self, spider, page):
+        """Rebuild the response of an archived page.
+
+        Args:
+            spider (scrapy.Spider): the spider, whose methods are the callbacks of the archived requests.
+            page (tuple): an archived page, as yielded by pages().
+
+        Returns:
+            scrapy.http.HtmlResponse: the page, with its request.
+        """
+        data, status, encoding, digest = page
+        request = request_from_dict(pickle.loads(data), spider=spider)
+        with open(self.object_path(digest), "rb") as f:
+            body = zlib.decompress(f.read())
+        return HtmlResponse(request.url, status=status, body=body, encoding=encoding or "utf-8", request=request)
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def count(self, spider_name):
+        """Number of pages archived for a spider."""
+        return self._db.execute("SELECT COUNT(*) FROM pages WHERE spider = ?", (spider_name,)).fetchone()[0]
+
+    def commit(self):
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+
+def callback_name(request):
+    """Name of the method of the spider handling a request ("parse" by default)."""
+    return getattr(request.callback, "__name__", None) or "parse"
@@ -0,0 +1,159 @@
+# Bounded frontier of the listing pages of the spiders
+#
+# The spiders used to yield the request of every page as soon as the number of pages was known, i.e. tens of thousands
+# of requests waiting in the scheduler for the transactions. A PageFrontier only keeps a window of pages requested and
+# not parsed yet, and requests the next pages as the pages of the window are parsed.
+
+import logging
+
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+
+logger = logging.getLogger(__name__)
+
+
+class PageFrontier:
+    """
+        Request the pages of a pagination lazily, at most `window` of them being downloaded or queued at a time.
+
+        The spider yields the requests of start() once the number of pages is known, and the requests of
+        done(request) each time a page was parsed (the error callback of the requests does it for the failed pages).
+        A retry of a page has to keep the "frontier_page" key of the meta of its request, the page staying in the
+        window until it is done.
+
+        The pages already recorded in the checkpoint of the spider (see CheckpointMiddleware) are skipped, and the
+        requests of the pages are marked as roots of the checkpoint (meta["checkpoint_root"]): a page is recorded once
+        its own items are exported, without waiting for the pages released after it. If the spider becomes idle while
+        pages are left, e.g. because a request of the window was dropped, the window is filled again, the requests
+        going through the checkpoint of the spider (spider.checkpoint_schedule) as if they were yielded by a callback.
+        The window is not filled while retries of pages are waiting for their delay (the 'soft_retry/waiting' stat of
+        SoftErrorRetryMiddleware), and the pages of the window which are neither running nor waiting are counted as
+        failures.
+
+    Attributes:
+
+        spider (scrapy.Spider): the spider paginating.
+        make_request (callable): builds the request of a page from its number.
+        window (int): the maximum number of pages requested and not done yet.
+        in_flight (set): the numbers of the pages requested and not done yet.
+        total (int): the number of pages, None if `pages` has no length.
+        completed (int): the number of pages done.
+        failures (int): the number of pages given up by the error callback (e.g. after the retries of an HTTP error),
+            or lost while the spider was idle.
+        skipped (int): the number of pages skipped because they are in the checkpoint.
+    """
+
+    def __init__(self, spider, pages, make_request, window):
+        self.spider = spider
+        self.make_request = make_request
+        self.window = max(1, window)
+        self.in_flight = set()
+        self.total = len(pages) if hasattr(pages, "__len__") else None
+        self.completed = 0
+        self.skipped = 0
+        self.failures = 0
+        self._pages = iter(pages)
+        self._exhausted = False
+        spider.crawler.signals.connect(self.spider_idle, signal=signals.spider_idle)
+
+    def start(self):
+        """Requests of the first pages of the window.
+
+        Returns:
+            list: the requests to yield from the callback.
+        """
+        return self._fill()
+
+    def done(self, request):
+        """Mark a page as done (parsed, or failed) and request the next pages.
+
+        Args:
+            request (scrapy.Request): the request of the page, e.g. response.request.
+
+        Returns:
+            list: the requests to yield from the callback.
+        """
+        page = request.meta.get("frontier_page")
+        if page in self.in_flight:
+            self.in_flight.remove(page)
+            self.completed += 1
+        return self._fill()
+
+    def failed(self, failure):
+        """Error callback of the requests of the pages: the page is given up and replaced by the next one."""
+        logger.error(f"Page {failure.request.meta.get('frontier_page')} failed: {failure.value!r}")
+        self.failures += 1
+        return self.done(failure.request)
+
+    def spider_idle(self, spider):
+        if spider is not self.spider or self._exhausted and not self.in_flight:
+            return
+        if spider.crawler.stats.get_value("soft_retry/waiting", 0):
+            # the retries of pages of the window are waiting for their delay (see SoftErrorRetryMiddleware), which
+            # keeps the spider open
+            return
+        if self.in_flight:
+            # nothing is running or waiting anymore, the pages still in the window will never be done
+            lost = sorted(self.in_flight)
+            logger.error(f"{len(lost)} pages lost without being parsed nor failed: {lost[:10]}")
+            self.failures += len(lost)
+            self.in_flight.clear()
+        schedule = getattr(spider, "checkpoint_schedule", None)
+        requests = [request for request in self._fill() if schedule is None or schedule(request)]
+        for request in requests:
+            spider.crawler.engine.crawl(request)
+        if requests:
+            raise DontCloseSpider
+
+    def _fill(self):
+        checkpoint = getattr(self.spider, "checkpoint", None)
+        requests = []
+        while not self._exhausted and len(self.in_flight) < self.window:
+            page = next(self._pages, None)
+            if page is None:
+                self._exhausted = True
+                break
+            request = self.make_request(page)
+            key = request.meta.get("checkpoint")
+            if checkpoint is not None and key is not None and key in checkpoint:
+                self.skipped += 1
+                continue
+            request.meta["frontier_page"] = page
+            request.meta["checkpoint_root"] = True
+            if request.errback is None:
+                request.errback = self.failed
+            self.in_flight.add(page)
+            requests.append(request)
+        return requests
+
+
+def next_pages(spider, request):
+    """Mark the page of a request as done in the frontier of the spider, if any, and get the next pages to request.
+
+    A page can be parsed without a frontier, e.g. when it is replayed from the dead letters (scrapy replay_dead_letters).
+
+    Args:
+        spider (scrapy.Spider): the spider paginating.
+        request (scrapy.Request): the request of the page, e.g. response.request.
+
+    Returns:
+        list: the requests to yield from the callback.
+    """
+    frontier = getattr(spider, "frontier", None)
+    if frontier is None:
+        return []
+    return frontier.done(request)
+
+
+def page_range(pages, first_page=None, last_page=None):
+    """The pages of a pagination scraped by a spider, restricted to the range given with -a first_page/-a last_page.
+
+    Args:
+        pages (int): the number of pages of the pagination.
+        first_page (int): the first page to scrape (numbered from 1), None to start at the first one.
+        last_page (int): the last page to scrape (included), None to stop at the last one.
+
+    Returns:
+        range: the numbers of the pages.
+    """
+    return range(max(first_page or 1, 1), min(last_page or pages, pages) + 1)
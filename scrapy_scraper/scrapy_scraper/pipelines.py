@@ -3,11 +3,356 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from datetime import date, datetime
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
+from scrapy.exceptions import DropItem, NotConfigured
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
+
+from scrapy_scraper.database import ACCOUNT_KEY, COMPLIANCE_YEARS, HOLDING_ACCOUNTS, TRANSACTIONS, Database
+from scrapy_scraper.items import (
+    COMPLIANCE_COLUMN,
+    ComplianceYearItem,
+    HoldingAccountItem,
+    TransactionItem,
+    field_type,
+)
+from scrapy_scraper.state import TransactionIdSet
+from scrapy_scraper.utils import parse_int, parse_registry_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# text of the registry for a missing value
+MISSING_VALUES = ("", "-")
 
 
 class ScrapyScraperPipeline:
     def process_item(self, item, spider):
         return item
+
+
+def to_date(value):
+    timestamp = parse_registry_date(value)
+    return timestamp.date() if timestamp is not None else None
+
+
+# conversion of the text of a cell to each type of field
+CONVERTERS = {
+    int: parse_int,
+    datetime: parse_registry_date,
+    date: to_date,
+    str: str.strip,
+}
+
+
+def coerce_value(value, value_type):
+    """Convert a value scraped from the registry to the type of its field.
+
+    Args:
+        value: the value, converted only if it is a string.
+        value_type (type): the type of the field (see items.field_type), None to keep the value.
+
+    Returns:
+        the converted value, None if the value is missing or can't be converted.
+    """
+    if not isinstance(value, str) or value_type is None:
+        return value
+    value = value.strip()
+    if value in MISSING_VALUES:
+        return None
+    return CONVERTERS[value_type](value)
+
+
+class TypeCoercionPipeline:
+    """
+        Convert the values of the items to the types of their fields (see items.py), once, as the items are scraped.
+
+        The quantities become int (thousand separators removed), the timestamps of the registry datetime and its dates
+        date. The missing values ('', '-') become None, as well as the values which can't be converted (counted in the
+        stats, 'coercion/invalid/<field>'). The values already converted, e.g. by the spider, are kept as is.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("ITEM_COERCION_ENABLED"):
+            raise NotConfigured
+        return cls(crawler.stats)
+
+    def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        for name, value in adapter.items():
+            if not isinstance(value, str):
+                continue
+            converted = coerce_value(value, field_type(item, name))
+            if converted is None and value.strip() not in MISSING_VALUES:
+                self.stats.inc_value(f"coercion/invalid/{name}", spider=spider)
+            adapter[name] = converted
+        return item
+
+
+class DuplicateTransactionPipeline:
+    """
+        Drop the transactions whose Transaction_ID was already scraped, e.g. a row of a page requested twice, or of two
+        overlapping pages when the order of the table changed during the crawl.
+
+        The IDs are kept in a TransactionIdSet (8 bytes per ID). For the incremental runs of transaction_spider, the
+        set is loaded from DEDUP_FILE and saved back at the end of the run, so that a transaction scraped by a previous
+        incremental run is not written again.
+    """
+
+    def __init__(self, stats, path):
+        self.stats = stats
+        self.path = path
+        self.seen = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("DEDUP_ENABLED"):
+            raise NotConfigured
+        return cls(crawler.stats, crawler.settings.get("DEDUP_FILE"))
+
+    def open_spider(self, spider):
+        self.seen = TransactionIdSet(self.path if getattr(spider, "incremental", False) else None)
+
+    def close_spider(self, spider):
+        if self.seen.path is not None:
+            self.seen.save()
+
+    def process_item(self, item, spider):
+        if not isinstance(item, TransactionItem):
+            return item
+        if not self.seen.add(item["Transaction_ID"]):
+            self.stats.inc_value("dedup/dropped", spider=spider)
+            raise DropItem(f"Duplicate transaction {item['Transaction_ID']}")
+        return item
+
+
+class DatabasePipeline:
+    """
+        Store the items in the SQLite database of DATABASE_FILE (see database.py), in addition to the feeds.
+
+        The transactions are keyed on their Transaction_ID, the holding accounts on their registry and their
+        installation, and the compliances on their account, scheme and year. The rows of the wide output of
+        europa_spider are split into the account and its compliances. A ComplianceYearItem of the long output only
+        holds the Account_ID of its account, whose HoldingAccountItem is yielded before it.
+    """
+
+    def __init__(self, path, batch_size):
+        self.path = path
+        self.batch_size = batch_size
+        self.db = None
+        # the key of the accounts stored during the crawl, by Account_ID
+        self.accounts = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("DATABASE_ENABLED"):
+            raise NotConfigured
+        return cls(crawler.settings.get("DATABASE_FILE"), crawler.settings.getint("DATABASE_BATCH_SIZE", 1000))
+
+    def open_spider(self, spider):
+        self.db = Database(self.path, self.batch_size)
+
+    def close_spider(self, spider):
+        self.db.close()
+
+    def process_item(self, item, spider):
+        if isinstance(item, TransactionItem):
+            self.db.add(TRANSACTIONS, item)
+        elif isinstance(item, HoldingAccountItem):
+            self.db.add(HOLDING_ACCOUNTS, item)
+            self.accounts[item.get("Account_ID")] = {name: item.get(name) for name in ACCOUNT_KEY}
+        elif isinstance(item, ComplianceYearItem):
+            key = self.accounts.get(item.get("Account_ID")) or self.db.account_key(item.get("Account_ID"))
+            if key is None:
+                logger.warning(f"The account {item.get('Account_ID')} of a compliance is unknown, it is not stored")
+            else:
+                self.db.add(COMPLIANCE_YEARS, dict(key, **item))
+        elif isinstance(item, dict) and "Installation/Aircraft_ID" in item:
+            self.add_wide_row(item)
+        return item
+
+    def add_wide_row(self, row):
+        """Store a row of the wide output of europa_spider: the account, then a row per scheme and year."""
+        self.db.add(HOLDING_ACCOUNTS, row)
+        key = {name: row.get(name) for name in ACCOUNT_KEY}
+        compliances = {}
+        for name, value in row.items():
+            match = COMPLIANCE_COLUMN.fullmatch(name)
+            if match:
+                scheme, year, metric = match.groups()
+                compliances.setdefault((scheme, int(year)), {})[metric] = value
+        for (scheme, year), metrics in compliances.items():
+            self.db.add(COMPLIANCE_YEARS, dict(key, Scheme=scheme, Year=year, **metrics))
+
+
+class QueuedWriterPipeline:
+    """
+        Write the items as JSON lines from a background thread, so that the crawl does not wait for the disk.
+
+        The items are put on a queue of WRITER_QUEUE_SIZE items, and a thread writes them to WRITER_FILE by batches
+        of at most WRITER_BATCH_SIZE items (a single write per batch), serialized with orjson when it is installed.
+        When the queue is full, the items wait in a backlog of the reactor (a Deferred each, without blocking the
+        reactor nor a thread), moved to the queue by the writer as it takes batches off it, and Scrapy stops
+        processing new responses until the writer caught up (see SCRAPER_SLOT_MAX_ACTIVE_SIZE). With '{item}' in
+        WRITER_FILE, each class of item gets its own file, e.g. 'europa_{item}.jsonl' for the long output of
+        europa_spider.
+
+        The depth of the queue and the time spent writing are in the stats ('writer/*'), and summed up at the end.
+    """
+
+    def __init__(self, stats, path, queue_size, batch_size):
+        self.stats = stats
+        self.path = path
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        # the items waiting for a place in the queue, with the Deferred returned by process_item
+        self.backlog = deque()
+        self.files = {}
+        self.error = None
+        self.thread = None
+        self.reactor = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("WRITER_ENABLED"):
+            raise NotConfigured
+        return cls(
+            crawler.stats,
+            crawler.settings.get("WRITER_FILE"),
+            crawler.settings.getint("WRITER_QUEUE_SIZE", 10000),
+            crawler.settings.getint("WRITER_BATCH_SIZE", 1000),
+        )
+
+    def open_spider(self, spider):
+        # imported here, the reactor being installed by the crawler process
+        from twisted.internet import reactor
+
+        self.reactor = reactor
+        self.thread = threading.Thread(target=self.write_batches, name="item-writer", daemon=True)
+        self.thread.start()
+
+    def close_spider(self, spider):
+        return deferToThread(self.stop).addCallback(lambda _: self.closed())
+
+    def stop(self):
+        """End the writer once the queue is written (in a thread of the reactor, the queue can be full)."""
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                break
+            except queue.Full:
+                # the writer could have stopped on an error meanwhile
+                continue
+        self.thread.join()
+
+    def process_item(self, item, spider):
+        if self.error is not None:
+            raise self.error
+        if not self.backlog:
+            try:
+                self.queue.put_nowait(item)
+                self.stats.max_value("writer/queue_max", self.queue.qsize())
+                return item
+            except queue.Full:
+                self.stats.inc_value("writer/queue_full")
+                self.stats.max_value("writer/queue_max", self.queue.maxsize)
+        d = Deferred()
+        self.backlog.append((item, d))
+        # the writer could have made room before the item was added to the backlog
+        self.drain_backlog()
+        return d
+
+    def drain_backlog(self):
+        """Move the items of the backlog to the queue while it has room (in the reactor thread)."""
+        while self.backlog:
+            item, d = self.backlog[0]
+            if self.error is not None:
+                self.backlog.popleft()
+                d.errback(self.error)
+                continue
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                return
+            self.backlog.popleft()
+            d.callback(item)
+
+    def write_batches(self):
+        """Loop of the writer thread, until the None put by close_spider."""
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if self.backlog:
+                self.reactor.callFromThread(self.drain_backlog)
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.error(f"The writer of {self.path} stopped: {e!r}")
+                self.error = e
+                # the items of the backlog fail too
+                self.reactor.callFromThread(self.drain_backlog)
+                return
+
+    def write(self, batch):
+        start = time.perf_counter()
+        lines = {}
+        for item in batch:
+            lines.setdefault(type(item).__name__, []).append(dumps(ItemAdapter(item).asdict()))
+        for item_class, item_lines in lines.items():
+            self.file(item_class).write(b"".join(item_lines))
+        elapsed = time.perf_counter() - start
+        self.stats.inc_value("writer/items", len(batch))
+        self.stats.inc_value("writer/batches")
+        self.stats.inc_value("writer/write_seconds", elapsed)
+        self.stats.max_value("writer/batch_seconds_max", elapsed)
+
+    def file(self, item_class):
+        path = self.path.replace("{item}", item_class)
+        if path not in self.files:
+            self.files[path] = open(path, "wb")
+        return self.files[path]
+
+    def closed(self):
+        for f in self.files.values():
+            f.close()
+        batches = self.stats.get_value("writer/batches", 0)
+        if batches:
+            latency = self.stats.get_value("writer/write_seconds") / batches
+            logger.info(
+                f"Writer: {self.stats.get_value('writer/items')} items in {batches} batches, "
+                f"{latency * 1000:.1f} ms per batch, at most {self.stats.get_value('writer/queue_max')} items queued"
+            )
+        if self.error is not None:
+            raise self.error
+
+
+def dumps(data):
+    """Serialize an item as a line of JSON (bytes), the dates in ISO format."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(data, ensure_ascii=False, default=lambda value: value.isoformat()) + "\n").encode("utf-8")
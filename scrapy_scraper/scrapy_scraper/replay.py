@@ -0,0 +1,176 @@
+# Helpers to run the callbacks of a spider on saved pages, without a crawl
+#
+# Used by 'scrapy replay_dead_letters --offline' and 'scrapy reparse_archive': the spider is created from the project
+# settings, its callbacks are called on the saved responses, and the items go through the item pipelines to the feeds
+# given with -o / -O.
+
+import asyncio
+import inspect
+
+from scrapy.crawler import Crawler
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.http import Request
+from scrapy.settings import Settings
+from scrapy.spiderloader import SpiderLoader
+from scrapy.utils.conf import build_component_list
+from scrapy.utils.misc import create_instance, load_object
+
+from scrapy_scraper.pagestore import PageArchive, callback_name
+from scrapy_scraper.utils import mirror_url
+
+
+def collect(callback, response):
+    """Call a callback of a spider and gather its output, the callback being a function, a generator or an async
+    generator."""
+    result = callback(response)
+    if inspect.isasyncgen(result):
+
+        async def gather():
+            return [i async for i in result]
+
+        return asyncio.new_event_loop().run_until_complete(gather())
+    if inspect.iscoroutine(result):
+        result = asyncio.new_event_loop().run_until_complete(result)
+    return list(result or ())
+
+
+class ItemWriter:
+    """
+        Write the items of a replay like a crawl would: through the ITEM_PIPELINES of the project, then to the files
+        given with -o / -O (local files only, with their 'fields' and 'item_classes' options).
+
+        Only the synchronous pipelines are supported, i.e. the process_item methods returning the item.
+
+    Attributes:
+
+        spider (scrapy.Spider): the spider whose items are written.
+        pipelines (list): the enabled pipelines, in the order of ITEM_PIPELINES.
+        exporters (list): the (exporter, file, item classes) of each feed.
+    """
+
+    def __init__(self, crawler, spider):
+        self.spider = spider
+        self.pipelines = []
+        for path in build_component_list(crawler.settings.getwithbase("ITEM_PIPELINES")):
+            try:
+                self.pipelines.append(create_instance(load_object(path), crawler.settings, crawler))
+            except NotConfigured:
+                continue
+        self.exporters = []
+        exporter_classes = crawler.settings.getwithbase("FEED_EXPORTERS")
+        for uri, options in crawler.settings.getdict("FEEDS").items():
+            f = open(uri, "wb" if options.get("overwrite") else "ab")
+            # created as by the FeedExporter of Scrapy, from_crawler reading the settings of the exporter
+            exporter = create_instance(
+                load_object(exporter_classes[options["format"]]),
+                crawler.settings,
+                crawler,
+                f,
+                encoding=options.get("encoding") or crawler.settings.get("FEED_EXPORT_ENCODING"),
+                fields_to_export=options.get("fields") or crawler.settings.getlist("FEED_EXPORT_FIELDS") or None,
+                **options.get("item_export_kwargs", {}),
+            )
+            item_classes = tuple(load_object(c) for c in options.get("item_classes") or ())
+            self.exporters.append((exporter, f, item_classes))
+
+    def open(self):
+        for pipeline in self.pipelines:
+            if hasattr(pipeline, "open_spider"):
+                pipeline.open_spider(self.spider)
+        for exporter, _, _ in self.exporters:
+            exporter.start_exporting()
+
+    def write(self, item):
+        """Process an item with the pipelines and export it.
+
+        Returns:
+            bool: False if the item was dropped by a pipeline.
+        """
+        try:
+            for pipeline in self.pipelines:
+                item = pipeline.process_item(item, self.spider)
+        except DropItem:
+            return False
+        for exporter, _, item_classes in self.exporters:
+            if not item_classes or isinstance(item, item_classes):
+                exporter.export_item(item)
+        return True
+
+    def close(self):
+        for exporter, f, _ in self.exporters:
+            exporter.finish_exporting()
+            f.close()
+        for pipeline in self.pipelines:
+            if hasattr(pipeline, "close_spider"):
+                pipeline.close_spider(self.spider)
+
+
+# state of a process of 'scrapy reparse_archive', set by init_worker
+_spider = None
+_archive = None
+_metas = {}
+_mirror = ""
+
+
+def init_worker(spider_name, spider_arguments, settings, directory, metas=None):
+    """Initializer of the processes parsing the archived pages: create the spider and open the archive.
+
+    Args:
+        spider_name (str): the name of the spider.
+        spider_arguments (dict): the arguments of the spider (-a name=value).
+        settings (dict): the settings of the command.
+        directory (str): the location of the PageArchive.
+        metas (dict): the meta replacing the archived one in the requests of the pages, by URL (see parse_pages).
+    """
+    global _spider, _archive, _metas, _mirror
+    _metas = metas or {}
+    settings = Settings(settings)
+    _mirror = settings.get("REGISTRY_MIRROR")
+    # nothing is downloaded, the process does not need the reactor of the crawls
+    settings.set("TWISTED_REACTOR", None)
+    spidercls = SpiderLoader.from_settings(settings).load(spider_name)
+    _spider = spidercls.from_crawler(Crawler(spidercls, settings), **spider_arguments)
+    _archive = PageArchive(directory)
+
+
+def parse_pages(pages, export=None):
+    """Run the callbacks of the spider of the process on archived pages.
+
+    The requests yielded by the callbacks are not downloaded, the pages they lead to are archived as well. Only the
+    meta they get from their page is kept, for the callbacks in the derived_meta of the spider (e.g. the data of an
+    account given to parse_compliances by parse), to be given to the archived pages of these requests.
+
+    Args:
+        pages (list): archived pages, as yielded by PageArchive.pages().
+        export (list): the names of the callbacks whose items are kept, None for every callback (the other pages are
+            only parsed for the meta of their requests).
+
+    Returns:
+        tuple: the items extracted from the pages, the URL and the exception of each page whose callback failed, and
+        the derived meta of the requests yielded by the pages, by URL.
+    """
+    is_soft_error = getattr(_spider, "is_soft_error", lambda request, response: False)
+    derived = getattr(_spider, "derived_meta", {})
+    items, failures, metas = [], [], {}
+    for page in pages:
+        response = _archive.response(_spider, page)
+        # response.meta is the meta of its request
+        response.request.meta.update(_metas.get(response.url, {}))
+        if is_soft_error(response.request, response):
+            continue
+        try:
+            output = collect(response.request.callback or _spider.parse, response)
+        except Exception as e:
+            failures.append((response.url, repr(e)))
+            continue
+        keep = export is None or callback_name(response.request) in export
+        for i in output:
+            if not isinstance(i, Request):
+                if keep:
+                    items.append(i)
+                continue
+            keys = derived.get(callback_name(i), ())
+            if keys:
+                # archived with the URL it was downloaded from
+                metas[mirror_url(i.url, _mirror)] = {key: i.meta[key] for key in keys if key in i.meta}
+    return items, failures, metas
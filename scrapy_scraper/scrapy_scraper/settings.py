@@ -8,10 +8,29 @@
 #     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 BOT_NAME = 'scrapy_scraper'
-DUPEFILTER_CLASS = 'scrapy.dupefilters.BaseDupeFilter'
+DUPEFILTER_CLASS = 'scrapy.dupefilters.BaseDupeFilter' # the same listing pages are requested twice (first page, binary search)
 SPIDER_MODULES = ['scrapy_scraper.spiders']
 NEWSPIDER_MODULE = 'scrapy_scraper.spiders'
+COMMANDS_MODULE = 'scrapy_scraper.commands' # crawl_shards, merge_shards, ...
 FEED_EXPORT_ENCODING = 'utf-8' #To avoid problems related to special characters
+# CSV whose header holds the fields of all the items, columnar formats (-O data.parquet, -O data.arrow), pyarrow is
+# needed to use them, and compressed chunks of JSON lines or CSV (-O data.json:csv-chunks, the feed file being the
+# manifest of the chunks)
+FEED_EXPORTERS = {
+    'csv': 'scrapy_scraper.exporters.UnionCsvItemExporter',
+    'parquet': 'scrapy_scraper.exporters.ParquetItemExporter',
+    'arrow': 'scrapy_scraper.exporters.ArrowItemExporter',
+    'jsonl-chunks': 'scrapy_scraper.exporters.ChunkedJsonLinesItemExporter',
+    'csv-chunks': 'scrapy_scraper.exporters.ChunkedCsvItemExporter',
+}
+# Chunks of the jsonl-chunks and csv-chunks feeds: compression ('zstd' needs zstandard, 'gzip' or ''), number of items
+# or compressed bytes after which a chunk is closed (0 for no limit), date field whose month partitions the chunks
+# (e.g. Transaction_Date) and number of chunks open at a time
+FEED_CHUNK_COMPRESSION = 'gzip'
+FEED_CHUNK_MAX_ITEMS = 0
+FEED_CHUNK_MAX_BYTES = 64 * 1024 * 1024
+FEED_CHUNK_PARTITION_BY = ''
+FEED_CHUNK_MAX_OPEN = 16
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'scrapy_scraper (+http://www.yourdomain.com)'
@@ -46,27 +65,142 @@ RETRY_TIMES = 10
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
+SPIDER_MIDDLEWARES = {
 #    'scrapy_scraper.middlewares.ScrapyScraperSpiderMiddleware': 543,
-#}
+    'scrapy_scraper.middlewares.ArchiveMiddleware': 530,
+    'scrapy_scraper.middlewares.DeadLetterMiddleware': 540,
+    'scrapy_scraper.middlewares.CheckpointMiddleware': 550,
+    'scrapy_scraper.middlewares.CallbackMetricsMiddleware': 950,
+    'scrapy_scraper.middlewares.CallbackProfilerMiddleware': 960,
+}
+
+# Keep every parsed page, to parse them again with 'scrapy reparse_archive' (-s ARCHIVE_ENABLED=True)
+ARCHIVE_ENABLED = False
+ARCHIVE_DIR = 'archive'
+
+# Save the pages that could not be parsed (error pages given up, exceptions) to replay them later
+# (scrapy replay_dead_letters <spider>)
+DEAD_LETTER_ENABLED = True
+DEAD_LETTER_STORE = 'dead_letters.sqlite'
+# set by 'scrapy replay_dead_letters': the spider only requests the saved pages
+DEAD_LETTER_REPLAY = False
+
+# Resume an interrupted crawl without downloading again the completed pages (-s CHECKPOINT_ENABLED=True)
+CHECKPOINT_ENABLED = False
+CHECKPOINT_DIR = 'checkpoints'
+
+# Parse the pages in a pool of processes (-s PARSE_PROCESSES=4) while the downloads go on, instead of the thread of the
+# crawl, so that a single crawl uses several cores (0 to parse in the process of the crawl)
+PARSE_PROCESSES = 0
+
+# Number of listing pages queued or downloaded at the same time, the next pages are requested as these ones are parsed
+PAGINATION_WINDOW = 64
+
+# Refresh mode of europa_spider (-a refresh=1): age after which a compliance page is downloaded again even if the row of
+# its account did not change
+REFRESH_MAX_AGE_DAYS = 30
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
+DOWNLOADER_MIDDLEWARES = {
 #    'scrapy_scraper.middlewares.ScrapyScraperDownloaderMiddleware': 543,
-#}
+    'scrapy_scraper.middlewares.RegistryMirrorMiddleware': 50,
+    'scrapy_scraper.middlewares.SoftErrorRetryMiddleware': 560,
+    'scrapy_scraper.middlewares.CallbackMetricsMiddleware': 580,
+    'scrapy_scraper.middlewares.AdaptiveConcurrencyMiddleware': 950,
+}
+
+# Send the requests of the registry to another server, e.g. -s REGISTRY_MIRROR=http://127.0.0.1:8765 for the mock of
+# the registry (python -m scrapy_scraper.mock_registry, see scrapy bench_registry)
+REGISTRY_MIRROR = ''
+
+# Retry the error pages of the overloaded registry with an exponential backoff (the spiders give up the pages that
+# still fail after SOFT_RETRY_TIMES retries)
+SOFT_RETRY_ENABLED = True
+SOFT_RETRY_TIMES = 10
+# maximum number of retries during a crawl, 0 for no limit
+SOFT_RETRY_BUDGET = 5000
+# delay before the first retry of a page (seconds), doubled at each retry up to SOFT_RETRY_BACKOFF_MAX
+SOFT_RETRY_BACKOFF_BASE = 1.0
+SOFT_RETRY_BACKOFF_MAX = 60.0
+SOFT_RETRY_PRIORITY_ADJUST = -1
+
+# Adapt the concurrency to the soft errors and the latency of the registry (-s ADAPTIVE_CONCURRENCY_ENABLED=True), instead
+# of the constant CONCURRENT_REQUESTS (which stays the upper bound)
+ADAPTIVE_CONCURRENCY_ENABLED = False
+ADAPTIVE_CONCURRENCY_START = 8
+ADAPTIVE_CONCURRENCY_MIN = 1
+# number of responses observed before each adjustment
+ADAPTIVE_CONCURRENCY_WINDOW = 50
+# rate of soft errors above which the concurrency is halved
+ADAPTIVE_CONCURRENCY_ERROR_RATE = 0.02
+# the concurrency is also halved when the latency gets above this factor times the lowest latency observed
+ADAPTIVE_CONCURRENCY_LATENCY_FACTOR = 3.0
+ADAPTIVE_CONCURRENCY_MAX_DELAY = 10.0
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'scrapy_scraper.extensions.CrawlMetrics': 500,
+    'scrapy_scraper.extensions.CrawlProfiler': 510,
+    'scrapy_scraper.extensions.IncompleteCrawlMarker': 520,
+}
+
+# Progress of the crawl (with its ETA) and figures of each callback (time, items, bytes, soft errors), logged every
+# METRICS_INTERVAL seconds, and written to a Prometheus textfile and appended to a file of JSON lines if they are set
+METRICS_ENABLED = True
+METRICS_INTERVAL = 60.0
+METRICS_PROMETHEUS_FILE = ''
+METRICS_JSON_FILE = ''
+
+# Profiling of a crawl, the results being written to PROFILE_DIR: sampling of the stacks of all the threads every
+# PROFILE_SAMPLING_INTERVAL seconds (flame graph), cProfile of one response out of PROFILE_EVERY for the callbacks of
+# PROFILE_CALLBACKS (e.g. ['parse_compliances']), and growth of the memory every PROFILE_TRACEMALLOC_INTERVAL seconds
+PROFILE_DIR = 'profiles'
+PROFILE_SAMPLING = False
+PROFILE_SAMPLING_INTERVAL = 0.01
+PROFILE_CALLBACKS = []
+PROFILE_EVERY = 100
+PROFILE_TRACEMALLOC = False
+PROFILE_TRACEMALLOC_INTERVAL = 600.0
+PROFILE_TRACEMALLOC_FRAMES = 1
+# number of functions or lines of code in the summaries
+PROFILE_TOP = 20
+
+# File written when the crawl closes with pages given up, '' to not write it (set by crawl_pages and crawl_shards for
+# each of their processes)
+INCOMPLETE_MARKER = ''
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
+ITEM_PIPELINES = {
 #    'scrapy_scraper.pipelines.ScrapyScraperPipeline': 300,
-#}
+    'scrapy_scraper.pipelines.TypeCoercionPipeline': 100,
+    'scrapy_scraper.pipelines.DuplicateTransactionPipeline': 200,
+    'scrapy_scraper.pipelines.DatabasePipeline': 500,
+    'scrapy_scraper.pipelines.QueuedWriterPipeline': 900,
+}
+
+# Convert the values of the items to the types of their fields (quantities to int, dates of the registry to dates)
+ITEM_COERCION_ENABLED = True
+
+# Drop the transactions scraped twice, the IDs being kept between the incremental runs (next to transaction_state.json
+# when launched from the spiders directory)
+DEDUP_ENABLED = True
+DEDUP_FILE = '../../transaction_ids.bin'
+
+# Store the items in a SQLite database too, updating the rows scraped before (-s DATABASE_ENABLED=True)
+DATABASE_ENABLED = False
+DATABASE_FILE = 'europa.sqlite'
+DATABASE_BATCH_SIZE = 1000
+
+# Write the items as JSON lines from a background thread instead of a feed (-s WRITER_ENABLED=True), orjson being
+# used when it is installed. With '{item}' in WRITER_FILE, each class of item is written to its own file
+WRITER_ENABLED = False
+WRITER_FILE = 'items.jsonl'
+WRITER_QUEUE_SIZE = 10000
+WRITER_BATCH_SIZE = 1000
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -1,7 +1,110 @@
 import asyncio
+import hashlib
 import logging
+from datetime import timedelta
+
 import scrapy  # pip install scrapy  --> scrapy ver. > 2.4 to use asyncio
 
+from w3lib.url import url_query_parameter
+
+from scrapy_scraper.extractors import ComplianceExtractor, TableExtractor
+from scrapy_scraper.items import ComplianceYearItem, HoldingAccountItem
+from scrapy_scraper.offload import ParsePool, has_pagination
+from scrapy_scraper.pagination import PageFrontier, next_pages, page_range
+from scrapy_scraper.state import AccountIndex, fingerprint
+from scrapy_scraper.utils import parse_int, to_bool, to_int
+
+# columns of the table of Operator Holding accounts: (field, number of the column)
+ACCOUNT_COLUMNS = (
+    ("National_Administrator", 1),
+    ("Account_Type", 2),
+    ("Account_Holder_Name", 3),
+    ("Installation/Aircraft_ID", 4),
+    ("Installation_Name/Aircraft_Operator_Code", 5),
+    ("Company_Regustration_No", 6),
+    ("Permit/Plan_ID", 7),
+    ("Permit/Plan_Date", 8),
+    ("Main_Activity_Type", 9),
+    ("Latest_Compliance_Code", 10),
+)
+
+# we start at tr:nth-child(n+3) since the infos we want start at the 3rd row
+ACCOUNT_TABLE = TableExtractor(
+    "table#tblAccountSearchResult tr:nth-child(n+3)", ACCOUNT_COLUMNS
+)
+
+# link of a row of the table to the compliance page of the account
+DETAIL_LINK = "td:nth-child(11) td:nth-child(2) a"
+
+# types of the items stored in the index of the accounts (-a refresh=1), the rows of the wide output are dict
+ITEM_TYPES = {cls.__name__: cls for cls in (HoldingAccountItem, ComplianceYearItem)}
+
+# schema of the compliance page of an account
+COMPLIANCE_PAGE = ComplianceExtractor(
+    header=(
+        # General Information
+        (
+            "table#tblAccountGeneralInfo tr:nth-child(3)",
+            (("Account_Status", 6),),
+        ),
+        # Details on Contact Information
+        (
+            "table#tblAccountContactInfo tr:nth-child(3)",
+            (
+                ("Type", 1),
+                ("Legal_Entity_Identifier", 3),
+                ("Main_Adress_Line", 4),
+                ("Secondary_Adress_Line", 5),
+                ("Postal_Code", 6),
+                ("City", 7),
+                ("Country", 8),
+                ("Telephone_1", 9),
+                ("Telephone_2", 10),
+                ("E-Mail_Adress", 11),
+            ),
+        ),
+        # other General Information
+        (
+            "table#tblChildDetails table:nth-child(1) tr:nth-child(3)",
+            (
+                ("Monitoring_plan—year_of_expiry", 5),
+                ("Name_of_Subsidiary_undertaking", 6),
+                ("Name_of_Parent_undertaking", 7),
+                ("E-PRTR_identification", 8),
+                ("Call_Sign_(ICAO_designator)", 9),
+                ("First_Year_of_Emissions", 10),
+                ("Last_Year_of_Emissions", 11),
+            ),
+        ),
+    ),
+    year_column=2,
+    metrics=(
+        ("Allowances_in_Allocation", 3),
+        ("Verified_Emissions", 4),
+        ("Units_Surrendered", 5),
+        ("Cumulative_Surrendered_Units", 6),
+        ("Cumulative_Verified_Emissions", 7),
+        ("Compliance_Code", 8),
+    ),
+    layouts=(
+        # two tables: EU compliance, and CH compliance (only AIRCRAFT OPERATOR ACCOUNT)
+        (
+            "[id=tblChildDetails] div:nth-child(2)",
+            (
+                ("EU", "[id=tblChildDetails] div:nth-child(1) table tr:nth-child(n+3)"),
+                # the first 4 rows are headers and the last 4 rows are not needed and produce errors
+                ("CH", "[id=tblChildDetails] div:nth-child(2) table tr:nth-child(n+5):not(:nth-last-child(-n+4))"),
+            ),
+        ),
+        # only one table: EU compliance
+        (
+            None,
+            (("EU", "[id=tblChildDetails] div table tr:nth-child(n+3)"),),
+        ),
+    ),
+)
+
+
 # when the command to start the spider is executed, it's the start_requests() method that is called first
 class europa_spider(scrapy.Spider):
     """
@@ -17,18 +120,61 @@ class europa_spider(scrapy.Spider):
         name (str): The name of the spider.
         start_urls (str): The starting URL for collecting data from Operator Holding accounts.
         custom_settings (dict): A dictionary of custom parameters for spider configuration.
+        output (str): 'wide' (default) for one row per account with a column per scheme, year and metric, 'long'
+            (-a output=long) for a HoldingAccountItem per account and a ComplianceYearItem per scheme and year.
+        refresh (bool): with -a refresh=1, only the compliance pages of the accounts whose row changed, or that were
+            downloaded more than REFRESH_MAX_AGE_DAYS ago, are downloaded, the other accounts are carried forward from
+            the index kept in index_file.
+        parse_pool (offload.ParsePool): the pool of processes parsing the pages (-s PARSE_PROCESSES=4), disabled by
+            default.
+        first_page, last_page (int): with '-a first_page=1 -a last_page=500', only the accounts of these pages of the
+            table of accounts are scraped (numbered from 1, included). Each range of pages can be scraped by a
+            separate process, see the crawl_pages command.
+        derived_meta (dict): the keys of the meta of the requests of each callback which are extracted from the page
+            leading to them, rebuilt from the re-parsed pages by 'scrapy reparse_archive'.
 
     Methods:
         start_requests(): A method for starting spider requests.
         parse_pages(response): A method for parsing data pages from Operator Holding accounts.
         parse(response): A method for parsing Operator Holding account data on web pages.
         parse_compliances(response): A method for parsing Operator Holding account data from the 2nd page.
+        extract_items(response, dico_table_data): A method extracting the items of the output from the 2nd page.
+        long_items(response, dico_table_data, header, years): A method building the items of the long output from the
+            2nd page.
+        is_soft_error(request, response): A method for detecting the error pages of the overloaded registry.
     """
     name = "europa_spider"
     start_urls = "https://ec.europa.eu/clima/ets/oha.do?form=oha&languageCode=fr&accountHolder=&installationIdentifier=&installationName=&permitIdentifier=&mainActivityType=-1&searchType=oha&currentSortSettings=accountTypeCode+ASC&backList=%3CBack&resultList.currentPageNumber=2"
     custom_settings = {
         "LOG_LEVEL": "INFO",
     }
+    output_formats = ("wide", "long")
+    index_file = "../../europa_index.sqlite"
+    # replaced by the pool of the crawl (PARSE_PROCESSES) in from_crawler
+    parse_pool = ParsePool()
+    derived_meta = {"parse_compliances": ("dico_table_data",)}
+
+    def __init__(self, output="wide", refresh=False, first_page=None, last_page=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if output not in self.output_formats:
+            raise ValueError(f"Unknown output '{output}', expected one of {', '.join(self.output_formats)}")
+        self.output = output
+        self.refresh = to_bool(refresh)
+        self.index = None
+        self.first_page = to_int(first_page)
+        self.last_page = to_int(last_page)
+        # each range of pages has its own checkpoint manifest
+        if self.first_page or self.last_page:
+            self.checkpoint_id = [f"pages{self.first_page or 1}-{self.last_page or ''}"]
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.parse_pool = ParsePool.from_crawler(crawler)
+        if spider.refresh:
+            max_age = timedelta(days=crawler.settings.getfloat("REFRESH_MAX_AGE_DAYS", 30))
+            spider.index = AccountIndex(spider.index_file, max_age)
+        return spider
 
     # override of the start_requests() method to call the parse_pages() method instead of the parse() method
     def start_requests(self):
@@ -44,9 +190,9 @@ class europa_spider(scrapy.Spider):
             callback=self.parse_pages,
         )
 
-    # function to know the number of pages to parse and to set up the columns of the .csv
+    # function to know the number of pages to parse
     def parse_pages(self, response):
-        """Method to parse the number of pages to parse and to set up the columns of the .csv. 
+        """Method to parse the number of pages to parse. 
 
         Args:
             response (scrapy.http.Response): the http response to be parsed.
@@ -55,21 +201,36 @@ class europa_spider(scrapy.Spider):
             scrapy.http.Request: A http request to be processed by the 'parse' callback function.
         """
         pages = response.css("td.bgpagecontent input:nth-child(5)::attr(value)").get()
+        if pages is None:
+            logging.error(f"Page content is None for {response.url}, the number of pages is unknown")
+            return
 
-        # allow to set up the columns of the .csv correctly, since the header is set up statically at the start
-        yield response.follow(
-            self.start_urls, callback=self.parse, meta={"page": 1}, priority=1
-        )
-
-        for page in range(3, int(pages) + 2):
-            url = (
-                f"https://ec.europa.eu/clima/ets/oha.do?form=oha&languageCode=fr&accountHolder=&installationIdentifier=&installationName=&permitIdentifier=&mainActivityType=-1&searchType=oha&currentSortSettings=accountTypeCode+ASC&backList=%3CBack&resultList.currentPageNumber="
-                + str(page)
+        pages = page_range(int(pages), self.first_page, self.last_page)
+        if 1 in pages:
+            yield response.follow(
+                self.start_urls,
+                callback=self.parse,
+                meta={"page": 1, "checkpoint": ["page", 1]},
             )
-            yield response.follow(url, callback=self.parse, meta={"page": page - 1})
+
+        # the next pages are requested lazily, PAGINATION_WINDOW at a time (see parse), the registry serving the page
+        # n - 1 for resultList.currentPageNumber=n
+        self.frontier = PageFrontier(
+            self,
+            range(max(pages.start, 2) + 1, pages.stop + 1),
+            lambda page: response.follow(
+                "https://ec.europa.eu/clima/ets/oha.do?form=oha&languageCode=fr&accountHolder=&installationIdentifier=&installationName=&permitIdentifier=&mainActivityType=-1&searchType=oha&currentSortSettings=accountTypeCode+ASC&backList=%3CBack&resultList.currentPageNumber="
+                + str(page),
+                callback=self.parse,
+                meta={"page": page - 1, "checkpoint": ["page", page - 1]},
+            ),
+            self.settings.getint("PAGINATION_WINDOW", 64),
+        )
+        for request in self.frontier.start():
+            yield request
 
     # extract the data from the web page
-    def parse(self, response):
+    async def parse(self, response):
         """Parse function to extract data from the web page.
 
         Args:
@@ -79,70 +240,38 @@ class europa_spider(scrapy.Spider):
             dict:a dictionnary containing the data extracted from the web page.
         """
         page = response.meta["page"]
-        print(
-            "page",
-            page,
-            "sur",
-            response.css("td.bgpagecontent input:nth-child(5)::attr(value)").get(),
-        )
+        # the progress of the crawl is logged by the CrawlMetrics extension
 
-        # if there was an error in the response, we try again
-        if (
-            response.css("td.bgpagecontent input:nth-child(5)::attr(value)").get()
-            is None
-        ):
-            logging.warning(f"Page content is None for {response.url}, retrying...")
-            yield response.follow(
-                response.url, callback=self.parse, meta={"page": page + 1}
-            )
+        # the error pages are retried with a backoff by SoftErrorRetryMiddleware, this one was given up
+        if self.is_soft_error(response.request, response):
+            logging.error(f"Page content is None for {response.url}, page {page} is skipped")
+            for request in next_pages(self, response.request):
+                yield request
         else:
-            for row in response.css(
-                "table#tblAccountSearchResult tr:nth-child(n+3)"
-            ):  #we start at tr:nth-child(n+3) since the infos we want start at the 3rd row
-                dico_table_data = {
-                    "National_Administrator": row.css("td:nth-child(1) span::text")
-                    .get(default=None)
-                    .strip(),
-                    "Account_Type": row.css("td:nth-child(2) span::text")
-                    .get(default=None)
-                    .strip(),
-                    "Account_Holder_Name": row.css("td:nth-child(3) span::text")
-                    .get(default=None)
-                    .strip(),
-                    "Installation/Aircraft_ID": row.css("td:nth-child(4) span::text")
-                    .get(default=None)
-                    .strip(),
-                    "Installation_Name/Aircraft_Operator_Code": row.css(
-                        "td:nth-child(5) span::text"
-                    )
-                    .get(default=None)
-                    .strip(),
-                    "Company_Regustration_No": row.css("td:nth-child(6) span::text")
-                    .get(default=None)
-                    .strip(),
-                    "Permit/Plan_ID": row.css("td:nth-child(7) span::text")
-                    .get(default=None)
-                    .strip(),
-                    "Permit/Plan_Date": row.css("td:nth-child(8) span::text")
-                    .get(default=None)
-                    .strip(),
-                    "Main_Activity_Type": row.css("td:nth-child(9) span::text")
-                    .get(default=None)
-                    .strip(),
-                    "Latest_Compliance_Code": row.css("td:nth-child(10) span::text")
-                    .get(default=None)
-                    .strip(),
-                }
-                url = row.css("td:nth-child(11) td:nth-child(2) a::attr(href)").get()
+            # the next pages are queued before the compliance pages of this one, which are downloaded first (LIFO)
+            for request in next_pages(self, response.request):
+                yield request
+            for dico_table_data, url in await self.parse_pool.rows(ACCOUNT_TABLE, response, DETAIL_LINK):
                 if url:
+                    if self.index is not None:
+                        record = self.index.get(url_query_parameter(url, "accountID"), self.output)
+                        if self.index.is_fresh(record, fingerprint(dico_table_data)):
+                            # the account did not change since the last run, its items are carried forward
+                            self.crawler.stats.inc_value("refresh/carried_forward")
+                            for item in self.load_items(record["items"]):
+                                yield item
+                            continue
                     # allows us to go trough the compliance page and extract the data
                     yield response.follow(
                         url,
                         self.parse_compliances,
-                        meta={"dico_table_data": dico_table_data},
+                        meta={
+                            "dico_table_data": dico_table_data,
+                            "checkpoint": ["detail", response.urljoin(url)],
+                        },
                     )
 
-    def parse_compliances(self, response):
+    async def parse_compliances(self, response):
         """Method to extract data from the compliance page. 
 
         Args:
@@ -152,306 +281,123 @@ class europa_spider(scrapy.Spider):
             dict: dictionnary containing the data extracted from the website.
         """
         dico_table_data = response.meta["dico_table_data"]
+        if self.index is None:
+            for item in await self.extract_items(response, dico_table_data):
+                yield item
+            return
 
-        # General Information
-        dico_table_data["Account_Status"] = (
-            response.css(
-                "table#tblAccountGeneralInfo tr:nth-child(3) td:nth-child(6) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        # the strip part is mandatory, else we pick up data under this format : '&nbsp;Operator Holding Account&nbsp;'
-        # Details on Contact Information
-        dico_table_data["Type"] = (
-            response.css(
-                "table#tblAccountContactInfo tr:nth-child(3) td:nth-child(1) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Legal_Entity_Identifier"] = (
-            response.css(
-                "table#tblAccountContactInfo tr:nth-child(3) td:nth-child(3) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Main_Adress_Line"] = (
-            response.css(
-                "table#tblAccountContactInfo tr:nth-child(3) td:nth-child(4) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Secondary_Adress_Line"] = (
-            response.css(
-                "table#tblAccountContactInfo tr:nth-child(3) td:nth-child(5) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Postal_Code"] = (
-            response.css(
-                "table#tblAccountContactInfo tr:nth-child(3) td:nth-child(6) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["City"] = (
-            response.css(
-                "table#tblAccountContactInfo tr:nth-child(3) td:nth-child(7) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Country"] = (
-            response.css(
-                "table#tblAccountContactInfo tr:nth-child(3) td:nth-child(8) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Telephone_1"] = (
-            response.css(
-                "table#tblAccountContactInfo tr:nth-child(3) td:nth-child(9) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Telephone_2"] = (
-            response.css(
-                "table#tblAccountContactInfo tr:nth-child(3) td:nth-child(10) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["E-Mail_Adress"] = (
-            response.css(
-                "table#tblAccountContactInfo tr:nth-child(3) td:nth-child(11) span::text"
-            )
-            .get(default="")
-            .strip()
+        account_id = url_query_parameter(response.url, "accountID")
+        listing_hash = fingerprint(dico_table_data)
+        content_hash = hashlib.sha1(response.body).hexdigest()
+        record = self.index.get(account_id, self.output)
+        if record is not None and (record["listing_hash"], record["content_hash"]) == (listing_hash, content_hash):
+            # downloaded again because of its age, but the page did not change: no need to parse it
+            self.crawler.stats.inc_value("refresh/unchanged_pages")
+            items = list(self.load_items(record["items"]))
+        else:
+            self.crawler.stats.inc_value("refresh/parsed_pages")
+            items = await self.extract_items(response, dico_table_data)
+        # the first item is the row of the wide output or the HoldingAccountItem, both hold the Account_Status
+        self.index.put(
+            account_id,
+            self.output,
+            listing_hash,
+            items[0].get("Account_Status", ""),
+            content_hash,
+            self.dump_items(items),
         )
+        for item in items:
+            yield item
 
-        # other General Information
-        dico_table_data["Monitoring_plan—year_of_expiry"] = (
-            response.css(
-                "table#tblChildDetails table:nth-child(1) tr:nth-child(3) td:nth-child(5) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Name_of_Subsidiary_undertaking"] = (
-            response.css(
-                "table#tblChildDetails table:nth-child(1) tr:nth-child(3) td:nth-child(6) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Name_of_Parent_undertaking"] = (
-            response.css(
-                "table#tblChildDetails table:nth-child(1) tr:nth-child(3) td:nth-child(7) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["E-PRTR_identification"] = (
-            response.css(
-                "table#tblChildDetails table:nth-child(1) tr:nth-child(3) td:nth-child(8) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Call_Sign_(ICAO_designator)"] = (
-            response.css(
-                "table#tblChildDetails table:nth-child(1) tr:nth-child(3) td:nth-child(9) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["First_Year_of_Emissions"] = (
-            response.css(
-                "table#tblChildDetails table:nth-child(1) tr:nth-child(3) td:nth-child(10) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
-        dico_table_data["Last_Year_of_Emissions"] = (
-            response.css(
-                "table#tblChildDetails table:nth-child(1) tr:nth-child(3) td:nth-child(11) span::text"
-            )
-            .get(default="")
-            .strip()
-        )
+    async def extract_items(self, response, dico_table_data):
+        """Method to extract the items of the output from the compliance page.
 
-        #get the data from the table with only one table
-        if response.css("[id=tblChildDetails] div:nth-child(2)") == []:
-            for row in response.css(
-                "[id=tblChildDetails] div table tr:nth-child(n+3)"
-            ):  # (-n+6) since the last 7 rows are not needed and prouced errors
-                key_year = row.css("td:nth-child(2) span::text").get(default="").strip()
-                if len(key_year) == 4:
-                    for cell in row.css("tr"):
-                        dico_table_data[
-                            "EU_Compliance_" + key_year + "_Allowances_in_Allocation"
-                        ] = (
-                            cell.css("td:nth-child(3) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "EU_Compliance_" + key_year + "_Verified_Emissions"
-                        ] = (
-                            cell.css("td:nth-child(4) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "EU_Compliance_" + key_year + "_Units_Surrendered"
-                        ] = (
-                            cell.css("td:nth-child(5) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "EU_Compliance_"
-                            + key_year
-                            + "_Cumulative_Surrendered_Units"
-                        ] = (
-                            cell.css("td:nth-child(6) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "EU_Compliance_"
-                            + key_year
-                            + "_Cumulative_Verified_Emissions"
-                        ] = (
-                            cell.css("td:nth-child(7) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "EU_Compliance_" + key_year + "_Compliance_Code"
-                        ] = (
-                            cell.css("td:nth-child(8) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-
-        # get information related to EU copmliance and CH compliance when there are two tables
-        else:
+        Args:
+            response (scrapy.http.Response): response of the http request.
+            dico_table_data (dict): the data of the account extracted from the table of accounts.
 
-            for row in response.css(
-                "[id=tblChildDetails] div:nth-child(1) table tr:nth-child(n+3)"
-            ):  # (-n+6) since the last 7 rows are not needed and produces errors
-                key_year = row.css("td:nth-child(2) span::text").get(default="").strip()
-                if len(key_year) == 4:
-                    for cell in row.css("tr"):
-                        dico_table_data[
-                            "EU_Compliance_" + key_year + "_Allowances_in_Allocation"
-                        ] = (
-                            cell.css("td:nth-child(3) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "EU_Compliance_" + key_year + "_Verified_Emissions"
-                        ] = (
-                            cell.css("td:nth-child(4) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "EU_Compliance_" + key_year + "_Units_Surrendered"
-                        ] = (
-                            cell.css("td:nth-child(5) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "EU_Compliance_"
-                            + key_year
-                            + "_Cumulative_Surrendered_Units"
-                        ] = (
-                            cell.css("td:nth-child(6) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "EU_Compliance_"
-                            + key_year
-                            + "_Cumulative_Verified_Emissions"
-                        ] = (
-                            cell.css("td:nth-child(7) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "EU_Compliance_" + key_year + "_Compliance_Code"
-                        ] = (
-                            cell.css("td:nth-child(8) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-
-            # CH Compliance information - only AIRCRAFT OPERATOR ACCOUNT
-            for row in response.css(
-                "[id=tblChildDetails] div:nth-child(2) table tr:nth-child(n+5):not(:nth-last-child(-n+4))"
-            ):  
-                key_year = row.css("td:nth-child(2) span::text").get(default="").strip()
-                if len(key_year) == 4:
-                    for cell in row.css("tr"):
-
-                        dico_table_data[
-                            "CH_Compliance_" + key_year + "_Allowances_in_Allocation"
-                        ] = (
-                            cell.css("td:nth-child(3) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "CH_Compliance_" + key_year + "_Verified_Emissions"
-                        ] = (
-                            cell.css("td:nth-child(4) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "CH_Compliance_" + key_year + "_Units_Surrendered"
-                        ] = (
-                            cell.css("td:nth-child(5) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "CH_Compliance_"
-                            + key_year
-                            + "_Cumulative_Surrendered_Units"
-                        ] = (
-                            cell.css("td:nth-child(6) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "CH_Compliance_"
-                            + key_year
-                            + "_Cumulative_Verified_Emissions"
-                        ] = (
-                            cell.css("td:nth-child(7) span::text")
-                            .get(default="")
-                            .strip()
-                        )
-                        dico_table_data[
-                            "CH_Compliance_" + key_year + "_Compliance_Code"
-                        ] = (
-                            cell.css("td:nth-child(8) span::text")
-                            .get(default="")
-                            .strip()
-                        )
+        Returns:
+            list: the row of the account in the wide output, or the items of the long output (see long_items).
+        """
+        # parsed by the pool of processes with PARSE_PROCESSES
+        header, years = await self.parse_pool.compliance_page(COMPLIANCE_PAGE, response)
+        if self.output == "long":
+            return list(self.long_items(response, dico_table_data, header, years))
+        # the strip part is done by the extractor, else we pick up data under this format : '&nbsp;Operator Holding Account&nbsp;'
+        dico_table_data.update(COMPLIANCE_PAGE.to_row(header, years))
 
         # send the data to the pipeline to be stored in a csv file
-        yield dico_table_data
+        return [dico_table_data]
+
+    def long_items(self, response, dico_table_data, header, years):
+        """Method to build the items of the compliance page: an account record and one record per scheme and year.
+
+        Args:
+            response (scrapy.http.Response): response of the http request.
+            dico_table_data (dict): the data of the account extracted from the table of accounts.
+            header (dict): the fields of the header of the compliance page.
+            years (list): the (scheme, year, metrics) of the compliance tables of the page.
+
+        Yields:
+            HoldingAccountItem: the account, then
+            ComplianceYearItem: the compliance of each scheme and year, with integer quantities.
+        """
+        account_id = url_query_parameter(response.url, "accountID")
+        yield HoldingAccountItem(
+            Account_ID=account_id,
+            **dico_table_data,
+            **header,
+        )
+        for scheme, year, metrics in years:
+            item = ComplianceYearItem(Account_ID=account_id, Scheme=scheme, Year=int(year))
+            for metric, value in metrics.items():
+                item[metric] = value if metric == "Compliance_Code" else parse_int(value)
+            yield item
+
+    def is_soft_error(self, request, response):
+        """Tell whether the registry answered a page of the table of accounts with an error page (overload).
+
+        Args:
+            request (scrapy.Request): the request of the page.
+            response (scrapy.http.TextResponse): the downloaded page.
+
+        Returns:
+            bool: True if a page of the table has no pagination, the compliance pages are never considered as errors.
+        """
+        if request.callback not in (self.parse_pages, self.parse):
+            return False
+        if self.parse_pool.enabled:
+            # the page is parsed by the pool of processes, not here
+            return not has_pagination(response)
+        return response.css("td.bgpagecontent input:nth-child(5)::attr(value)").get() is None
+
+    @staticmethod
+    def dump_items(items):
+        """Convert items to (type name, dict) pairs, to be stored in the index of the accounts."""
+        return [[type(item).__name__, dict(item)] for item in items]
+
+    @staticmethod
+    def load_items(stored):
+        """Rebuild the items stored in the index of the accounts.
+
+        Args:
+            stored (list): the (type name, dict) pairs returned by dump_items.
+
+        Yields:
+            dict: the items, with their original type.
+        """
+        for type_name, data in stored:
+            yield ITEM_TYPES.get(type_name, dict)(data)
+
+    def closed(self, reason):
+        """Save the index of the accounts (refresh mode).
+
+        Args:
+            reason (str): the reason why the spider was closed.
+        """
+        # the records of the accounts are complete even if the crawl was interrupted
+        if self.index is not None:
+            self.index.close()
+
 
 
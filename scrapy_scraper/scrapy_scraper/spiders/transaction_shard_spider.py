@@ -0,0 +1,123 @@
+import logging
+import math
+from datetime import date, timedelta
+
+import scrapy
+
+from scrapy_scraper.spiders.transaction_spider import is_empty_search, transaction_spider
+
+
+class transaction_shard_spider(transaction_spider):
+    """
+        A spider class splitting the history of the EU ETS transactions into shards.
+
+        This spider only reads the number of pages of the searches restricted to windows of dates. A window holding more
+        than max_pages pages is split into smaller windows until every window (a shard) holds a bounded number of pages,
+        so that each shard can be scraped by an independent transaction_spider, in a separate process or on a separate
+        computer:
+        scrapy crawl transaction_shard_spider -O shards.json
+        scrapy crawl_shards shards.json -j 4 -o data_transaction.csv
+
+    Attributes:
+
+        name (str): The name of the spider.
+        history_start (date): The first day of the EU ETS.
+        custom_settings (dict): A dictionary of custom parameters for spider configuration.
+
+    Methods:
+
+        start_requests(): A method for starting spider requests.
+        parse_window(response): A method for reading the number of pages of a window of dates.
+
+    Arguments:
+
+        max_pages (int): the maximum number of pages of a shard (500 by default).
+        start_date, end_date (str): the dates to split (from the start of the EU ETS to today by default).
+    """
+    name = "transaction_shard_spider"
+
+    history_start = date(2005, 1, 1)
+
+    # a window without its number of pages (an error page) is retried a few times (by SoftErrorRetryMiddleware), then
+    # recorded with an unknown number of pages, for crawl_shards to scrape it (and fail if it still gets no
+    # transaction), while a window without any transaction is recorded with 0 pages
+    max_attempts = 5
+
+    custom_settings = {
+        "LOG_LEVEL": "INFO",
+    }
+
+    def __init__(self, max_pages=500, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_pages = int(max_pages)
+        self.start_date = self.start_date or self.history_start
+        self.end_date = self.end_date or date.today()
+
+    def start_requests(self):
+        """Override the start_requests function to probe the whole history first.
+
+        Yields:
+            scrapy.Request: The request to be processed by the 'parse_window' callback function.
+        """
+        yield self.window_request(self.start_date, self.end_date)
+
+    def window_request(self, start_date, end_date):
+        """Build the request of the search of the transactions between two dates (both included)."""
+        return scrapy.Request(
+            self.search_url(start_date, end_date),
+            callback=self.parse_window,
+            meta={
+                "start_date": start_date,
+                "end_date": end_date,
+                "max_soft_retry_times": self.max_attempts - 1,
+            },
+            dont_filter=True,
+        )
+
+    def parse_window(self, response):
+        """Read the number of pages of a window of dates, and split it if it is too large.
+
+        Args:
+            response (scrapy.http.Response): the first page of the search restricted to the window.
+
+        Yields:
+            dict or scrapy.Request: The shard if the window is small enough, else the requests of the smaller windows.
+        """
+        start_date, end_date = response.meta["start_date"], response.meta["end_date"]
+        if is_empty_search(response):
+            yield {
+                "Start_Date": start_date.isoformat(),
+                "End_Date": end_date.isoformat(),
+                "Pages": 0,
+            }
+            return
+
+        pages = response.xpath("//input[@name='resultList.lastPageNumber']/@value").get()
+        if pages is None:
+            logging.error(
+                f"Number of pages unknown between {start_date} and {end_date} after {self.max_attempts} attempts, "
+                "the window is recorded as a shard with 'Pages': null"
+            )
+            self.crawler.stats.inc_value("shards/unknown_pages")
+            yield {
+                "Start_Date": start_date.isoformat(),
+                "End_Date": end_date.isoformat(),
+                "Pages": None,
+            }
+            return
+
+        pages = int(pages)
+        days = (end_date - start_date).days + 1
+        if pages <= self.max_pages or days == 1:
+            yield {
+                "Start_Date": start_date.isoformat(),
+                "End_Date": end_date.isoformat(),
+                "Pages": pages,
+            }
+            return
+
+        # the transactions are assumed evenly spread inside the window, the smaller windows are probed again anyway
+        parts = min(math.ceil(pages / self.max_pages), days)
+        bounds = [start_date + timedelta(days=days * k // parts) for k in range(parts + 1)]
+        for first, next_first in zip(bounds, bounds[1:]):
+            yield self.window_request(first, next_first - timedelta(days=1))
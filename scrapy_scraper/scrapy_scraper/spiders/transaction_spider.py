@@ -1,7 +1,45 @@
 import scrapy  # pip install scrapy  --> scrapy ver. > 2.4 to use asyncio 
+from scrapy import signals
 import logging
 from datetime import datetime, timedelta
 
+from scrapy_scraper.extractors import TableExtractor
+from scrapy_scraper.items import TransactionItem
+from scrapy_scraper.offload import ParsePool, has_pagination
+from scrapy_scraper.pagination import PageFrontier, next_pages, page_range
+from scrapy_scraper.state import IncrementalState
+from scrapy_scraper.utils import (
+    format_form_date,
+    parse_argument_date,
+    parse_registry_date,
+    to_bool,
+    to_int,
+)
+
+# columns of the table of transactions: (field, number of the column)
+TRANSACTION_COLUMNS = (
+    ("Transaction_ID", 1),
+    ("Transaction_Type", 2),
+    ("Transaction_Date", 3),
+    ("Transaction_Status", 4),
+    ("Transferring_Registry", 5),
+    ("Transferring_Account_Type", 6),
+    ("Transferring_Account_Name", 7),
+    ("Transferring_Account_Identifier", 8),
+    ("Transferring_Account_Holder", 9),
+    ("Acquiring_Registry", 10),
+    ("Acquiring_Account_Type", 11),
+    ("Acquiring_Account_Name", 12),
+    ("Acquiring_Account_Identifier", 13),
+    ("Acquiring_Account_Holder", 14),
+    ("Nb_of_Units", 15),
+)
+
+# we start at the third row to avoid the header
+TRANSACTION_TABLE = TableExtractor(
+    "table#tblTransactionSearchResult tr:nth-child(n+3)", TRANSACTION_COLUMNS
+)
+
 
 class transaction_spider(scrapy.Spider):
     """
@@ -13,29 +51,102 @@ class transaction_spider(scrapy.Spider):
 
         name (str): The name of the spider.
         start_urls (str): The starting URL for collecting transactions.
+        search_url_template (str): The URL of a search of transactions, with the dates of the searched window.
+        page_url_template (str): The URL of a page of a search of transactions.
+        sorted_page_url (str): The URL of a page of transactions sorted by ascending date (used by the incremental mode).
+        state_file (str): The file keeping the last ingested transaction between two incremental runs.
+        parse_pool (offload.ParsePool): The pool of processes parsing the pages (-s PARSE_PROCESSES=4), disabled by
+            default.
         custom_settings (dict): A dictionary of custom parameters for spider configuration.
     Methods:
 
         start_requests(): A method for starting spider requests.
         parse_checker(response): A method for checking if the CSV file is up-to-date.
         parse_pages(response): A method for parsing transaction pages.
+        parse_search(response): A method for finding the first page holding new transactions (incremental mode).
         parse(response): A method for parsing transactions on web pages.
+        paginate(pages, make_request): A method for requesting the pages lazily (see PAGINATION_WINDOW).
+        is_soft_error(request, response): A method for detecting the error pages of the overloaded registry.
+
+    Arguments:
+
+        incremental (bool): given with '-a incremental=1', only the transactions newer than the ones of the last
+            incremental run are scraped, instead of the whole list.
+        start_date, end_date (str): given with '-a start_date=2021-01-01 -a end_date=2021-06-30', only the
+            transactions of this window (a shard) are scraped, without checking if the CSV is up to date. Each shard
+            can be scraped by a separate process or computer, see the crawl_shards and merge_shards commands.
+        first_page, last_page (int): given with '-a first_page=1 -a last_page=5000', only these pages of the search
+            are scraped (numbered from 1, included), without checking if the CSV is up to date. Each range of pages
+            can be scraped by a separate process, see the crawl_pages command.
     """
     name = "transaction_spider"
 
     start_urls = "https://ec.europa.eu/clima/ets/transaction.do?endDate=&suppTransactionType=-1&transactionStatus=4&originatingAccountType=-1&originatingAccountIdentifier=&originatingAccountHolder=&languageCode=en&destinationAccountIdentifier=&transactionID=&transactionType=-1&destinationAccountType=-1&search=Search&toCompletionDate=&originatingRegistry=-1&destinationAccountHolder=&fromCompletionDate=&destinationRegistry=-1&startDate=&TITLESORT-currentSortSettings-transactionDate-H=A&currentSortSettings=transactionDate%20ASC"
 
+    search_url_template = "https://ec.europa.eu/clima/ets/transaction.do?languageCode=en&startDate={start_date}&endDate={end_date}&transactionStatus=4&fromCompletionDate=&toCompletionDate=&transactionID=&transactionType=-1&suppTransactionType=-1&originatingRegistry=-1&destinationRegistry=-1&originatingAccountType=-1&destinationAccountType=-1&originatingAccountIdentifier=&destinationAccountIdentifier=&originatingAccountHolder=&destinationAccountHolder=&search=Search&currentSortSettings="
+
+    page_url_template = "https://ec.europa.eu/clima/ets/transaction.do?languageCode=fr&startDate={start_date}&endDate={end_date}&transactionStatus=4&fromCompletionDate=&toCompletionDate=&transactionID=&transactionType=-1&suppTransactionType=-1&originatingRegistry=-1&destinationRegistry=-1&originatingAccountType=-1&destinationAccountType=-1&originatingAccountIdentifier=&destinationAccountIdentifier=&originatingAccountHolder=&destinationAccountHolder=&currentSortSettings=&backList=%3CBack&resultList.currentPageNumber={page}"
+
+    # the registry serves the page n - 1 for resultList.currentPageNumber=n
+    sorted_page_url = "https://ec.europa.eu/clima/ets/transaction.do?languageCode=en&startDate=&endDate=&transactionStatus=4&fromCompletionDate=&toCompletionDate=&transactionID=&transactionType=-1&suppTransactionType=-1&originatingRegistry=-1&destinationRegistry=-1&originatingAccountType=-1&destinationAccountType=-1&originatingAccountIdentifier=&destinationAccountIdentifier=&originatingAccountHolder=&destinationAccountHolder=&currentSortSettings=transactionDate%20ASC&backList=%3CBack&resultList.currentPageNumber={}"
+
+    state_file = "../../transaction_state.json"
+
+    # replaced by the pool of the crawl (PARSE_PROCESSES) in from_crawler
+    parse_pool = ParsePool()
+
     custom_settings = {
         "LOG_LEVEL": "INFO",
+        # the columns of the output in the order of the table (the fields of an item are sorted by name)
+        "FEED_EXPORT_FIELDS": [field for field, _ in TRANSACTION_COLUMNS],
     }
 
+    def __init__(self, incremental=False, start_date=None, end_date=None, first_page=None, last_page=None, *args,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.incremental = to_bool(incremental)
+        self.start_date = parse_argument_date(start_date)
+        self.end_date = parse_argument_date(end_date)
+        self.first_page = to_int(first_page)
+        self.last_page = to_int(last_page)
+        if self.incremental and (self.start_date or self.end_date):
+            raise ValueError("The incremental mode can't be restricted to a window of dates")
+        if self.incremental and (self.first_page or self.last_page):
+            raise ValueError("The incremental mode can't be restricted to a range of pages")
+        # each window of dates and each range of pages has its own checkpoint manifest
+        self.checkpoint_id = [str(d) for d in (self.start_date, self.end_date) if d]
+        if self.first_page or self.last_page:
+            self.checkpoint_id.append(f"pages{self.first_page or 1}-{self.last_page or ''}")
+        self.state = IncrementalState(self.state_file) if self.incremental else None
+        # set when a page had to be skipped
+        self.incomplete = False
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.parse_pool = ParsePool.from_crawler(crawler)
+        crawler.signals.connect(spider.spider_error, signal=signals.spider_error)
+        return spider
+
+    def spider_error(self, failure, response, spider):
+        # the transactions of a page whose callback failed are missing, the incremental state can't move past them
+        self.incomplete = True
+
     def start_requests(self): 
         """Override the scrapy.Spider.start_requests method to use parse_checker instead of parse as callback function for the first request.
 
+        In incremental mode, or when a window of dates or a range of pages is given, the check is skipped and the
+        transactions are directly paginated.
+
         Yields:
             scrapy.Request: the request to parse_checker method. 
         """
-        yield scrapy.Request(self.start_urls, callback=self.parse_checker)
+        if self.incremental:
+            yield scrapy.Request(self.start_urls, callback=self.parse_pages)
+        elif self.start_date or self.end_date or self.first_page or self.last_page:
+            yield scrapy.Request(self.search_url(), callback=self.parse_pages)
+        else:
+            yield scrapy.Request(self.start_urls, callback=self.parse_checker)
 
     # ------- Part to check if our CSV is up to date -------
     def parse_checker(self, response):
@@ -84,10 +195,7 @@ class transaction_spider(scrapy.Spider):
         print("Delta between both dates : ", delta)
         # We put back the same condition since we don't want to start the scraping in the open mode
         if date_verif != last_date or delta >= timedelta(days=90):
-            yield scrapy.Request(
-                "https://ec.europa.eu/clima/ets/transaction.do?languageCode=en&startDate=&endDate=&transactionStatus=4&fromCompletionDate=&toCompletionDate=&transactionID=&transactionType=-1&suppTransactionType=-1&originatingRegistry=-1&destinationRegistry=-1&originatingAccountType=-1&destinationAccountType=-1&originatingAccountIdentifier=&destinationAccountIdentifier=&originatingAccountHolder=&destinationAccountHolder=&search=Search&currentSortSettings=",
-                callback=self.parse_pages,
-            )
+            yield scrapy.Request(self.search_url(), callback=self.parse_pages)
 
     # ----- SCRAPING PART ----- (only if our CSV is not up to date)
     async def parse_pages(self, response):
@@ -99,12 +207,142 @@ class transaction_spider(scrapy.Spider):
         Yields:
             scrapy.Request: A request to parse the next page of transactions.
         """
-        pages = int(
-            response.xpath("//input[@name='resultList.lastPageNumber']/@value").get()
+        pages = response.xpath("//input[@name='resultList.lastPageNumber']/@value").get()
+        if pages is None:
+            if is_empty_search(response):
+                logging.info(f"No transaction for {response.url}")
+                return
+            logging.error(f"Page content is None for {response.url}, the number of pages is unknown")
+            # none of the transactions were scraped
+            self.incomplete = True
+            return
+        pages = int(pages)
+        if self.incremental:
+            if self.state.last_date is None:
+                logging.info("No previous incremental run, scraping every page.")
+                for request in self.paginate(range(1, pages + 1), self.sorted_page_request):
+                    yield request
+            else:
+                # binary search of the first page holding transactions newer than the last run
+                low, high = 1, pages
+                yield self.sorted_page_request(
+                    (low + high) // 2,
+                    callback=self.parse_search,
+                    meta={"low": low, "high": high, "total_pages": pages},
+                )
+            return
+
+        # the registry serves the page n - 1 for resultList.currentPageNumber=n
+        pages = page_range(pages, self.first_page, self.last_page)
+        for request in self.paginate(
+            range(pages.start + 1, pages.stop + 1),
+            lambda page: response.follow(
+                self.page_url(page),
+                callback=self.parse,
+                meta={"checkpoint": ["page", page - 1]},
+            ),
+        ):
+            yield request
+
+    def paginate(self, pages, make_request):
+        """Start requesting the pages, only PAGINATION_WINDOW of them being queued or downloaded at the same time.
+
+        Args:
+            pages (iterable): the numbers of the pages.
+            make_request (callable): builds the request of a page from its number.
+
+        Returns:
+            list: the requests of the first pages, the next ones are yielded by parse as the pages are parsed.
+        """
+        self.frontier = PageFrontier(self, pages, make_request, self.settings.getint("PAGINATION_WINDOW", 64))
+        return self.frontier.start()
+
+    def search_url(self, start_date=None, end_date=None):
+        """Build the URL of the search of the transactions, restricted to the window of the spider by default.
+
+        Args:
+            start_date (date): the first day of the searched transactions, no limit if None.
+            end_date (date): the last day of the searched transactions, no limit if None.
+
+        Returns:
+            str: the URL of the first page of the search.
+        """
+        return self.search_url_template.format(
+            start_date=format_form_date(start_date or self.start_date),
+            end_date=format_form_date(end_date or self.end_date),
+        )
+
+    def page_url(self, page):
+        """Build the URL of a page of the search of the transactions (the registry serves page n - 1 for n)."""
+        return self.page_url_template.format(
+            start_date=format_form_date(self.start_date),
+            end_date=format_form_date(self.end_date),
+            page=page,
+        )
+
+    def sorted_page_request(self, page, callback=None, meta=None):
+        """Build the request of a page of the transactions sorted by ascending date.
+
+        Args:
+            page (int): the number of the page, starting at 1.
+            callback (callable): the callback of the request, parse by default.
+            meta (dict): the meta of the request.
+
+        Returns:
+            scrapy.Request: the request of the page.
+        """
+        meta = dict(meta or {}, page=page)
+        if callback is None:
+            meta["checkpoint"] = ["page", page]
+        return scrapy.Request(
+            self.sorted_page_url.format(page + 1),
+            callback=callback or self.parse,
+            meta=meta,
         )
-        for page in range(2, pages + 2):
-            url = f"https://ec.europa.eu/clima/ets/transaction.do?languageCode=fr&startDate=&endDate=&transactionStatus=4&fromCompletionDate=&toCompletionDate=&transactionID=&transactionType=-1&suppTransactionType=-1&originatingRegistry=-1&destinationRegistry=-1&originatingAccountType=-1&destinationAccountType=-1&originatingAccountIdentifier=&destinationAccountIdentifier=&originatingAccountHolder=&destinationAccountHolder=&currentSortSettings=&backList=%3CBack&resultList.currentPageNumber={page}"
-            yield response.follow(url, callback=self.parse)
+
+    def parse_search(self, response):
+        """Step of the binary search of the first page holding new transactions.
+
+        The transactions being sorted by date, a page whose last transaction is older than the last ingested one only
+        holds transactions already scraped, and so do the pages before it.
+
+        Args:
+            response (scrapy.Response): The http response of the probed page.
+
+        Yields:
+            scrapy.Request: The next page to probe, or the requests of every page from the first new one to the last.
+        """
+        low, high = response.meta["low"], response.meta["high"]
+        total_pages = response.meta["total_pages"]
+        page = response.meta["page"]
+
+        dates = [
+            row["Transaction_Date"]
+            for _, row in TRANSACTION_TABLE.extract(response.selector.root)
+        ]
+        last_date = parse_registry_date(dates[-1]) if dates else None
+        if last_date is None:
+            # the error pages are retried with a backoff by SoftErrorRetryMiddleware, this one was given up
+            logging.error(f"Page content is None for {response.url}, the search of the new transactions failed")
+            return
+
+        if last_date < self.state.last_date:
+            low = page + 1
+        else:
+            high = page
+
+        if low < high:
+            yield self.sorted_page_request(
+                (low + high) // 2,
+                callback=self.parse_search,
+                meta={"low": low, "high": high, "total_pages": total_pages},
+            )
+        else:
+            logging.info(
+                f"Transactions newer than {self.state.last_date} start at page {low} out of {total_pages}"
+            )
+            for request in self.paginate(range(low, total_pages + 1), self.sorted_page_request):
+                yield request
 
     async def parse(self, response):
         """Extracts data from a table in the response.
@@ -113,73 +351,73 @@ class transaction_spider(scrapy.Spider):
         response (scrapy.http.Response): The response object containing the HTML page to parse.
 
         Yields:
-        dict: A dictionary containing the extracted data from each row in the table. The keys in the dictionary
-        represent the different columns in the table, such as 'Transaction_ID', 'Transaction_Type', etc.
+        TransactionItem: The data extracted from each row in the table. The fields represent the different columns
+        in the table, such as 'Transaction_ID', 'Transaction_Type', etc.
         """
-        total_pages = response.xpath(
-            "//input[@name='resultList.lastPageNumber']/@value"
-        ).get()
-        page = response.xpath(
-            "//input[@name='resultList.currentPageNumber']/@value"
-        ).get()
-        print(f"page {page} out of {total_pages}")
-
-        if total_pages is None:
-            logging.warning(f"Page content is None for {response.url}, retrying...")
-            yield response.follow(response.url, callback=self.parse)
+        # the error pages are retried with a backoff by SoftErrorRetryMiddleware, this one was given up
+        if self.is_soft_error(response.request, response):
+            logging.error(f"Page content is None for {response.url}, the page is skipped")
+            # the transactions of the page are missing, the incremental state can't move past them
+            self.incomplete = True
+            for request in next_pages(self, response.request):
+                yield request
         else:
-            for row in response.css(
-                "table#tblTransactionSearchResult tr:nth-child(n+3)"
-            ):  # We start at the third row to avoid the header
-                dico_data = {
-                    "Transaction_ID": row.css("td:nth-child(1) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Transaction_Type": row.css("td:nth-child(2) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Transaction_Date": row.css("td:nth-child(3) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Transaction_Status": row.css("td:nth-child(4) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Transferring_Registry": row.css("td:nth-child(5) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Transferring_Account_Type": row.css("td:nth-child(6) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Transferring_Account_Name": row.css("td:nth-child(7) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Transferring_Account_Identifier": row.css(
-                        "td:nth-child(8) span::text"
-                    )
-                    .get(default="")
-                    .strip(),
-                    "Transferring_Account_Holder": row.css("td:nth-child(9) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Acquiring_Registry": row.css("td:nth-child(10) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Acquiring_Account_Type": row.css("td:nth-child(11) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Acquiring_Account_Name": row.css("td:nth-child(12) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Acquiring_Account_Identifier": row.css(
-                        "td:nth-child(13) span::text"
-                    )
-                    .get(default="")
-                    .strip(),
-                    "Acquiring_Account_Holder": row.css("td:nth-child(14) span::text")
-                    .get(default="")
-                    .strip(),
-                    "Nb_of_Units": row.css("td:nth-child(15) span::text")
-                    .get(default="")
-                    .strip(),
-                }
-                yield dico_data
+            # this page leaves the window of the pagination, the next ones are requested
+            for request in next_pages(self, response.request):
+                yield request
+            # parsed by the pool of processes with PARSE_PROCESSES
+            for dico_data, _ in await self.parse_pool.rows(TRANSACTION_TABLE, response):
+                if self.incremental:
+                    transaction_date = parse_registry_date(dico_data["Transaction_Date"])
+                    if not self.state.is_new(dico_data["Transaction_ID"], transaction_date):
+                        continue
+                    self.state.update(dico_data["Transaction_ID"], transaction_date)
+                yield TransactionItem(dico_data)
+
+    def is_soft_error(self, request, response):
+        """Tell whether the registry answered with an error page, which happens when it is overloaded.
+
+        Args:
+            request (scrapy.Request): the request of the page.
+            response (scrapy.http.TextResponse): the downloaded page.
+
+        Returns:
+            bool: True if the page has no pagination (the table of transactions is missing).
+        """
+        if self.parse_pool.enabled:
+            # the page is parsed by the pool of processes, not here
+            return not has_pagination(response) and not is_empty_search(response)
+        return (
+            response.xpath("//input[@name='resultList.lastPageNumber']/@value").get() is None
+            and not is_empty_search(response)
+        )
+
+    def closed(self, reason):
+        """Save the last ingested transaction once an incremental run went through every page.
+
+        Args:
+            reason (str): the reason why the spider was closed.
+        """
+        # pages are scraped concurrently, so the state is only reliable when the whole run is over
+        if not self.incremental or reason != "finished":
+            return
+        frontier = getattr(self, "frontier", None)
+        if self.incomplete or (frontier is not None and frontier.failures):
+            logging.error("Pages of transactions are missing, the incremental state is not saved")
+            return
+        self.state.save()
+
+
+def is_empty_search(response):
+    """Tell whether a search of transactions has no result: its table is there, without any row (the error pages of
+    the registry have no table).
+
+    Args:
+        response (scrapy.http.TextResponse): a page of the search.
+
+    Returns:
+        bool: True if the search holds no transaction.
+    """
+    return bool(response.css("table#tblTransactionSearchResult")) and not response.css(
+        "table#tblTransactionSearchResult tr:nth-child(n+3)"
+    )
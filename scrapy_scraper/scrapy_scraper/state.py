@@ -0,0 +1,369 @@
+# Persistent state kept by the spiders between two launches
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+from scrapy_scraper.utils import parse_registry_date
+
+
+class IncrementalState:
+    """
+        Remember the most recent transaction ingested by transaction_spider.
+
+        The state is a small JSON file holding the date of the last transaction that was scraped and the IDs of the
+        transactions sharing this exact date (several transactions can be completed at the same time), so that an
+        incremental run only keeps the rows that are strictly newer.
+
+    Attributes:
+
+        path (str): location of the JSON file.
+        last_date (datetime): date of the last ingested transaction, None if nothing was ingested yet.
+        last_ids (set): IDs of the ingested transactions dated exactly last_date.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last_date = None
+        self.last_ids = set()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            self.last_date = parse_registry_date(data.get("Transaction_Date"))
+            self.last_ids = set(data.get("Transaction_IDs", []))
+        # newest transaction seen during the current run, only saved once the run is over
+        self._seen_date = self.last_date
+        self._seen_ids = set(self.last_ids)
+
+    def is_new(self, transaction_id, transaction_date):
+        """Tell whether a transaction was not ingested by a previous run.
+
+        Args:
+            transaction_id (str): the Transaction_ID of the row.
+            transaction_date (datetime): the Transaction_Date of the row.
+
+        Returns:
+            bool: True if the row has to be scraped.
+        """
+        if self.last_date is None or transaction_date is None:
+            return True
+        if transaction_date == self.last_date:
+            return transaction_id not in self.last_ids
+        return transaction_date > self.last_date
+
+    def update(self, transaction_id, transaction_date):
+        """Record a transaction scraped during the current run."""
+        if transaction_date is None:
+            return
+        if self._seen_date is None or transaction_date > self._seen_date:
+            self._seen_date = transaction_date
+            self._seen_ids = {transaction_id}
+        elif transaction_date == self._seen_date:
+            self._seen_ids.add(transaction_id)
+
+    def save(self):
+        """Write the newest transaction of the run to the JSON file (atomically)."""
+        if self._seen_date is None:
+            return
+        data = {
+            "Transaction_Date": str(self._seen_date),
+            "Transaction_IDs": sorted(self._seen_ids),
+            "Last_Update": str(datetime.now()),
+        }
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+        self.last_date, self.last_ids = self._seen_date, set(self._seen_ids)
+
+
+class Checkpoint:
+    """
+        Manifest of the pages whose items were all exported, used to resume an interrupted crawl.
+
+        A page is identified by a key such as ["page", 12] (a listing page) or ["detail", url] (a compliance page). The
+        keys are appended to a JSON lines file as soon as they are completed, so a crawl interrupted at any time can be
+        resumed without downloading the completed pages again.
+
+    Attributes:
+
+        path (str): location of the manifest.
+        done (set): the keys (tuples) of the completed pages.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        line = ""
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        self.done.add(tuple(json.loads(line)))
+                    except ValueError:
+                        # last line cut by the interruption of the crawl
+                        continue
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a")
+        if line and not line.endswith("\n"):
+            # the next keys are not appended to the cut line
+            self._file.write("\n")
+
+    def __contains__(self, key):
+        return tuple(key) in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, key):
+        """Record a completed page in the manifest."""
+        key = tuple(key)
+        if key in self.done:
+            return
+        self.done.add(key)
+        self._file.write(json.dumps(key) + "\n")
+        self._file.flush()
+
+    def close(self, clear=False):
+        """Close the manifest, and delete it when the crawl went through every page (clear=True)."""
+        self._file.close()
+        if clear:
+            os.remove(self.path)
+
+
+def fingerprint(data):
+    """Hash of a dictionary of scraped fields, independent of the order of the keys."""
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class AccountIndex:
+    """
+        Index of the compliance pages scraped by europa_spider, used to refresh only the accounts that changed.
+
+        For each account, the index keeps the fingerprint of its row in the table of accounts (which holds its
+        Latest_Compliance_Code and its Permit/Plan_Date), its Account_Status, the hash of its compliance page, the date
+        of the download of this page, and the items that were extracted from it. An account whose row did not change
+        and whose page is recent enough is not downloaded again, its items are carried forward from the index.
+
+    Attributes:
+
+        path (str): location of the SQLite database.
+        max_age (timedelta): age after which a compliance page is downloaded again, even if its row did not change.
+    """
+
+    def __init__(self, path, max_age=timedelta(days=30)):
+        self.path = path
+        self.max_age = max_age
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS accounts (
+                account_id TEXT,
+                output TEXT,
+                listing_hash TEXT,
+                account_status TEXT,
+                content_hash TEXT,
+                fetched_at TEXT,
+                items TEXT,
+                PRIMARY KEY (account_id, output)
+            )
+            """
+        )
+        self._pending = 0
+
+    def get(self, account_id, output):
+        """Read the record of an account.
+
+        Args:
+            account_id (str): the accountID of the compliance page.
+            output (str): the output format of the spider, the items depend on it.
+
+        Returns:
+            dict: the listing_hash, account_status, content_hash, fetched_at (datetime) and items (list) of the
+                account, None if the account is not in the index.
+        """
+        row = self._db.execute(
+            "SELECT listing_hash, account_status, content_hash, fetched_at, items FROM accounts "
+            "WHERE account_id = ? AND output = ?",
+            (account_id, output),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "listing_hash": row[0],
+            "account_status": row[1],
+            "content_hash": row[2],
+            "fetched_at": datetime.fromisoformat(row[3]),
+            "items": json.loads(row[4]),
+        }
+
+    def is_fresh(self, record, listing_hash, now=None):
+        """Tell whether the items of a record can be carried forward without downloading the page again.
+
+        Args:
+            record (dict): the record returned by get(), or None.
+            listing_hash (str): the fingerprint of the current row of the account in the table of accounts.
+            now (datetime): the current date, datetime.now() by default.
+
+        Returns:
+            bool: True if the row did not change and the page was downloaded less than max_age ago.
+        """
+        if record is None or record["listing_hash"] != listing_hash:
+            return False
+        return (now or datetime.now()) - record["fetched_at"] < self.max_age
+
+    def put(self, account_id, output, listing_hash, account_status, content_hash, items):
+        """Record the compliance page of an account that was just downloaded.
+
+        Args:
+            account_id (str): the accountID of the compliance page.
+            output (str): the output format of the spider.
+            listing_hash (str): the fingerprint of the row of the account in the table of accounts.
+            account_status (str): the Account_Status read on the page.
+            content_hash (str): the hash of the body of the page.
+            items (list): the items extracted from the page, as (type name, dict) pairs.
+        """
+        self._db.execute(
+            "INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                account_id,
+                output,
+                listing_hash,
+                account_status,
+                content_hash,
+                datetime.now().isoformat(),
+                json.dumps(items),
+            ),
+        )
+        # committing every record would make the crawl wait for the disk
+        self._pending += 1
+        if self._pending >= 100:
+            self.commit()
+
+    def commit(self):
+        """Write the recorded pages to the database."""
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        """Commit and close the database."""
+        self.commit()
+        self._db.close()
+
+
+# a Transaction_ID of the registry: the code of the registry, then a number (e.g. 'EU764117')
+# the numbers with a leading zero are hashed, else 'EU0764117' and 'EU764117' would get the same integer
+TRANSACTION_ID = re.compile(r"([A-Z]{1,4})([1-9]\d{0,11})")
+
+# integer of each code of registry, computed once
+_REGISTRY_CODES = {}
+
+
+def encode_transaction_id(transaction_id):
+    """Convert a Transaction_ID to a positive 63-bit integer.
+
+    The code of the registry (4 letters at most) and the number (without leading zero) are packed together, so two IDs
+    get the same integer only if they are equal. The IDs which don't look like that are hashed (with a bit telling
+    them apart), their integers are then unique with a very high probability only.
+
+    Args:
+        transaction_id (str): the Transaction_ID, e.g. 'EU764117'.
+
+    Returns:
+        int: the integer of the ID.
+    """
+    match = TRANSACTION_ID.fullmatch(transaction_id)
+    if match is None:
+        digest = hashlib.blake2b(transaction_id.encode("utf-8"), digest_size=8).digest()
+        return 1 << 62 | int.from_bytes(digest, "big") & (1 << 62) - 1
+    registry, number = match.groups()
+    code = _REGISTRY_CODES.get(registry)
+    if code is None:
+        code = 0
+        for letter in registry:
+            code = code * 27 + ord(letter) - ord("A") + 1
+        code = _REGISTRY_CODES[registry] = code << 40
+    return code | int(number)
+
+
+class TransactionIdSet:
+    """
+        Set of Transaction_ID kept in a few bytes per ID, for tens of millions of transactions.
+
+        The IDs are stored as integers (see encode_transaction_id) in a sorted array of 8-byte integers, searched by
+        bisection. The IDs added recently are kept in a small Python set, merged into the array once it holds an
+        eighth of the size of the array, so that the array is rebuilt a logarithmic number of times.
+
+        The set can be saved to a binary file (the sorted array) and loaded by a later run.
+
+    Attributes:
+
+        path (str): location of the binary file, None if the set is not saved.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._ids = array("q")
+        self._recent = set()
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                self._ids.frombytes(f.read())
+
+    def __len__(self):
+        return len(self._ids) + len(self._recent)
+
+    def __contains__(self, transaction_id):
+        return self._contains(encode_transaction_id(transaction_id))
+
+    def _contains(self, value):
+        if value in self._recent:
+            return True
+        i = bisect_left(self._ids, value)
+        return i < len(self._ids) and self._ids[i] == value
+
+    def add(self, transaction_id):
+        """Add a Transaction_ID to the set.
+
+        Returns:
+            bool: False if the ID was already in the set.
+        """
+        value = encode_transaction_id(transaction_id)
+        if self._contains(value):
+            return False
+        self._recent.add(value)
+        if len(self._recent) >= max(100000, len(self._ids) // 8):
+            self._merge()
+        return True
+
+    def _merge(self):
+        # the slices between two recent IDs are copied at once, only the recent IDs are handled one by one
+        merged = array("q")
+        start = 0
+        for value in sorted(self._recent):
+            end = bisect_left(self._ids, value, start)
+            merged.extend(self._ids[start:end])
+            merged.append(value)
+            start = end
+        merged.extend(self._ids[start:])
+        self._ids = merged
+        self._recent = set()
+
+    def save(self):
+        """Write the set to its binary file (atomically).
+
+        Raises:
+            ValueError: if the set has no binary file.
+        """
+        if self.path is None:
+            raise ValueError("no path to save to")
+        self._merge()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            self._ids.tofile(f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,102 @@
+# Small helpers shared by the spiders, pipelines and commands of the project
+
+from datetime import date, datetime
+
+# start of the URLs of the pages of the registry
+REGISTRY_URL = "https://ec.europa.eu"
+
+# formats used by the registry for its timestamps, e.g. '2019-04-30 19:02:55.43'
+REGISTRY_DATE_FORMATS = (
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d",
+    "%d/%m/%Y",
+)
+
+
+def parse_registry_date(value):
+    """Convert a timestamp scraped from the registry to a datetime.
+
+    Args:
+        value (str): the text of the cell, e.g. '2019-04-30 19:02:55.43'.
+
+    Returns:
+        datetime: the parsed timestamp, or None if the value is empty or not a date.
+    """
+    value = (value or "").strip()
+    for date_format in REGISTRY_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+# format of the dates expected by the search forms of the registry (startDate, endDate, ...)
+FORM_DATE_FORMAT = "%d/%m/%Y"
+
+
+def parse_argument_date(value):
+    """Convert a date given on the command line (-a start_date=2021-01-31) to a date.
+
+    Args:
+        value (str): the date, in ISO format (YYYY-MM-DD), or None.
+
+    Returns:
+        date: the parsed date, None if no value was given.
+    """
+    if value is None or isinstance(value, date):
+        return value
+    return datetime.strptime(value.strip(), "%Y-%m-%d").date()
+
+
+def format_form_date(value):
+    """Format a date as expected by the search forms of the registry, an empty string standing for no filter."""
+    if value is None:
+        return ""
+    return value.strftime(FORM_DATE_FORMAT).replace("/", "%2F")
+
+
+def to_bool(value):
+    """Interpret a spider argument given on the command line (-a name=value) as a boolean."""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def to_int(value):
+    """Interpret a spider argument given on the command line (-a name=value) as an integer, None if it is not given."""
+    if value is None or value == "":
+        return None
+    return int(value)
+
+
+def parse_int(value):
+    """Convert a quantity scraped from the registry (allowances, emissions, ...) to an integer.
+
+    Args:
+        value (str): the text of the cell, e.g. '12345', '12 345' or '-' when there is no data.
+
+    Returns:
+        int: the quantity, or None if the cell is empty or does not hold a number (e.g. 'Excluded').
+    """
+    value = (value or "").strip().replace(" ", "").replace(",", "").replace("\xa0", "")
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def mirror_url(url, mirror):
+    """Send a URL of the registry to another server (see REGISTRY_MIRROR).
+
+    Args:
+        url (str): the URL of a page.
+        mirror (str): the URL of the server replacing the registry, '' to keep the URL.
+
+    Returns:
+        str: the URL on the mirror, the same URL if it is not a page of the registry.
+    """
+    if not mirror or not url.startswith(REGISTRY_URL):
+        return url
+    return mirror.rstrip("/") + url[len(REGISTRY_URL):]
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests are run from the scrapy_scraper directory (python -m pytest tests), the package being next to them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
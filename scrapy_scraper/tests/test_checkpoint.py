@@ -0,0 +1,163 @@
+import os
+
+import pytest
+from scrapy import Spider
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from scrapy_scraper.middlewares import CheckpointMiddleware
+from scrapy_scraper.state import Checkpoint
+
+
+def test_checkpoint_add_and_reload(tmp_path):
+    path = str(tmp_path / "checkpoints" / "spider.jsonl")
+    checkpoint = Checkpoint(path)
+    checkpoint.add(["page", 1])
+    checkpoint.add(("detail", "https://ec.europa.eu/a"))
+    checkpoint.add(["page", 1])
+    checkpoint.close()
+
+    reloaded = Checkpoint(path)
+    assert len(reloaded) == 2
+    assert ["page", 1] in reloaded
+    assert ("detail", "https://ec.europa.eu/a") in reloaded
+    assert ["page", 2] not in reloaded
+    reloaded.close()
+
+
+def test_checkpoint_truncated_last_line(tmp_path):
+    path = tmp_path / "spider.jsonl"
+    path.write_text('["page", 1]\n["page", 2]\n["pa')
+    checkpoint = Checkpoint(str(path))
+    assert checkpoint.done == {("page", 1), ("page", 2)}
+    checkpoint.add(["page", 3])
+    checkpoint.close()
+
+    # the key added after the cut line is read back
+    assert Checkpoint(str(path)).done == {("page", 1), ("page", 2), ("page", 3)}
+
+
+def test_checkpoint_close(tmp_path):
+    path = str(tmp_path / "spider.jsonl")
+    checkpoint = Checkpoint(path)
+    checkpoint.add(["page", 1])
+    checkpoint.close()
+    assert os.path.exists(path)
+
+    checkpoint = Checkpoint(path)
+    checkpoint.close(clear=True)
+    assert not os.path.exists(path)
+
+
+@pytest.fixture
+def middleware(tmp_path):
+    crawler = get_crawler(Spider)
+    middleware = CheckpointMiddleware(crawler, str(tmp_path))
+    middleware.spider_opened(Spider("spider"))
+    yield middleware
+    middleware.checkpoint.close()
+
+
+def page_request(page, root=False):
+    meta = {"checkpoint": ["page", page]}
+    if root:
+        meta["checkpoint_root"] = True
+    return Request(f"https://ec.europa.eu/page{page}", meta=meta)
+
+
+def detail_request(account):
+    url = f"https://ec.europa.eu/detail{account}"
+    return Request(url, meta={"checkpoint": ["detail", url]})
+
+
+def parse(middleware, request, output):
+    """Run the output of the callback of a request through the middleware, as the spider middleware manager would."""
+    response = HtmlResponse(request.url, body=b"<html></html>", request=request)
+    return response, list(middleware.process_spider_output(response, iter(output), None))
+
+
+def test_page_recorded_once_its_items_and_details_are_done(middleware):
+    first = page_request(1)
+    assert list(middleware.process_start_requests([first], None)) == [first]
+
+    item, detail, second = {"Account": 1}, detail_request(1), page_request(2, root=True)
+    response, output = parse(middleware, first, [item, detail, second])
+    assert output == [item, detail, second]
+    middleware.item_done(item, response, None)
+    # the detail page is still running
+    assert ["page", 1] not in middleware.checkpoint
+
+    detail_item = {"Compliance": 1}
+    detail_response, _ = parse(middleware, detail, [detail_item])
+    assert ["detail", detail.url] not in middleware.checkpoint
+    middleware.item_done(detail_item, detail_response, None)
+
+    # recorded without waiting for the next page of the pagination
+    assert ["detail", detail.url] in middleware.checkpoint
+    assert ["page", 1] in middleware.checkpoint
+    assert ["page", 2] not in middleware.checkpoint
+    assert set(middleware.pending) == {("page", 2)}
+
+    parse(middleware, second, [])
+    assert ["page", 2] in middleware.checkpoint
+    assert not middleware.pending
+    assert not middleware.parents
+
+
+def test_child_page_waited_for_by_its_parent(middleware):
+    first = page_request(1)
+    list(middleware.process_start_requests([first], None))
+    # a page yielded without checkpoint_root is a child of the page yielding it
+    child = page_request(2)
+    parse(middleware, first, [child])
+    assert ["page", 1] not in middleware.checkpoint
+
+    parse(middleware, child, [])
+    assert ["page", 2] in middleware.checkpoint
+    assert ["page", 1] in middleware.checkpoint
+
+
+def test_retry_of_a_page_keeps_it_pending(middleware):
+    first = page_request(1)
+    list(middleware.process_start_requests([first], None))
+    # e.g. an error page retried by the spider, with the key of the page
+    retry = first.replace(dont_filter=True)
+    parse(middleware, first, [retry])
+    assert ["page", 1] not in middleware.checkpoint
+
+    parse(middleware, retry, [])
+    assert ["page", 1] in middleware.checkpoint
+
+
+def test_completed_pages_are_dropped(middleware):
+    middleware.checkpoint.add(["page", 2])
+    first = page_request(1)
+    list(middleware.process_start_requests([first], None))
+    _, output = parse(middleware, first, [page_request(2, root=True), page_request(3, root=True)])
+    assert [request.meta["checkpoint"] for request in output] == [["page", 3]]
+    # the pages requested outside of the callbacks, e.g. refilled by the frontier
+    assert not middleware.schedule(page_request(2, root=True))
+    assert middleware.schedule(page_request(4, root=True))
+    assert ("page", 4) in middleware.pending
+
+
+def test_feeds_written_on_close():
+    exporters = {
+        "csv": "scrapy_scraper.exporters.UnionCsvItemExporter",
+        "parquet": "scrapy_scraper.exporters.ParquetItemExporter",
+    }
+    crawler = get_crawler(Spider, {
+        "CHECKPOINT_ENABLED": True,
+        "FEED_EXPORTERS": exporters,
+        "FEEDS": {"accounts.csv": {"format": "csv"}, "transactions.jl": {"format": "jsonlines"}},
+    })
+    # the rows of the union CSV are spilled to a file as they come
+    assert not list(CheckpointMiddleware.feeds_written_on_close(crawler.settings))
+
+    crawler = get_crawler(Spider, {
+        "CHECKPOINT_ENABLED": True,
+        "FEED_EXPORTERS": exporters,
+        "FEEDS": {"transactions.parquet": {"format": "parquet"}},
+    })
+    with pytest.raises(ValueError):
+        CheckpointMiddleware.from_crawler(crawler)
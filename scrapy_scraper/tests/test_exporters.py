@@ -0,0 +1,57 @@
+import csv
+import os
+
+from scrapy_scraper.exporters import UnionCsvItemExporter
+
+
+def export(path, items, resume=False, finish=True):
+    f = open(path, "wb")
+    exporter = UnionCsvItemExporter(f, spill_batch_size=2)
+    if resume:
+        exporter.resume()
+    exporter.start_exporting()
+    for item in items:
+        exporter.export_item(item)
+    if finish:
+        exporter.finish_exporting()
+    else:
+        # the crawl is interrupted once the rows of the pages are flushed (see CheckpointMiddleware)
+        exporter.flush()
+    f.close()
+    return exporter
+
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.reader(f))
+
+
+def test_union_of_the_columns(tmp_path):
+    path = str(tmp_path / "accounts.csv")
+    exporter = export(path, [{"Account": 1}, {"Account": 2, "EU_Compliance_2021_Verified": 10}, {"Name": "a"}])
+    assert read_csv(path) == [
+        ["Account", "Name", "EU_Compliance_2021_Verified"],
+        ["1", "", ""],
+        ["2", "", "10"],
+        ["", "a", ""],
+    ]
+    assert exporter.spill == path + ".rows.jl"
+    assert not os.path.exists(exporter.spill)
+
+
+def test_interrupted_export_resumed(tmp_path):
+    path = str(tmp_path / "accounts.csv")
+    exporter = export(path, [{"Account": 1}, {"Account": 2}, {"Account": 3, "Name": "c"}], finish=False)
+    with open(exporter.spill, "a", encoding="utf-8") as f:
+        f.write('{"Acc')
+
+    export(path, [{"Account": 4}], resume=True)
+    assert read_csv(path) == [["Account", "Name"], ["1", ""], ["2", ""], ["3", "c"], ["4", ""]]
+    assert not os.path.exists(exporter.spill)
+
+
+def test_new_export_replaces_the_spill_file(tmp_path):
+    path = str(tmp_path / "accounts.csv")
+    export(path, [{"Account": 1}], finish=False)
+    export(path, [{"Account": 2}])
+    assert read_csv(path) == [["Account"], ["2"]]
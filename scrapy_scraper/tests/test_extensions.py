@@ -0,0 +1,30 @@
+import json
+
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+
+from scrapy_scraper.extensions import IncompleteCrawlMarker
+from scrapy_scraper.launcher import crawl_succeeded, incomplete_marker
+
+
+def test_marker_written_when_pages_were_given_up(tmp_path):
+    output = tmp_path / "pages.csv.part"
+    output.write_text("Transaction_ID\n")
+    marker = incomplete_marker(str(output))
+    crawler = get_crawler(Spider, {"INCOMPLETE_MARKER": marker})
+    extension = IncompleteCrawlMarker.from_crawler(crawler)
+    spider = Spider("pages")
+
+    extension.spider_opened(spider)
+    extension.spider_closed(spider, "finished")
+    assert crawl_succeeded(0, str(output))
+
+    crawler.stats.inc_value("soft_retry/max_reached")
+    extension.spider_closed(spider, "finished")
+    with open(marker, encoding="utf-8") as f:
+        assert json.load(f) == {"soft_retry/max_reached": 1}
+    assert not crawl_succeeded(0, str(output))
+
+    # a new crawl into the same output starts clean
+    extension.spider_opened(spider)
+    assert crawl_succeeded(0, str(output))
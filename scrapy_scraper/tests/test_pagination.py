@@ -0,0 +1,78 @@
+import pytest
+from scrapy import Spider
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from scrapy_scraper.middlewares import SoftErrorRetryMiddleware
+from scrapy_scraper.pagination import PageFrontier
+
+
+class PagesSpider(Spider):
+    name = "pages"
+
+    def is_soft_error(self, request, response):
+        return b"error" in response.body
+
+
+class Engine:
+    """Records the requests sent to the engine outside of the callbacks."""
+
+    def __init__(self):
+        self.requests = []
+
+    def crawl(self, request):
+        self.requests.append(request)
+
+
+@pytest.fixture
+def crawler():
+    crawler = get_crawler(PagesSpider, {"SOFT_RETRY_ENABLED": True})
+    crawler.spider = crawler._create_spider()
+    crawler.engine = Engine()
+    return crawler
+
+
+def page_request(page):
+    return Request(f"https://ec.europa.eu/page{page}", meta={"checkpoint": ["page", page]})
+
+
+def test_window_not_refilled_while_a_retry_is_waiting(crawler):
+    spider = crawler.spider
+    retry_middleware = SoftErrorRetryMiddleware.from_crawler(crawler)
+    frontier = PageFrontier(spider, range(1, 4), page_request, window=1)
+    (first,) = frontier.start()
+
+    response = HtmlResponse(first.url, body=b"<html>error</html>", request=first)
+    with pytest.raises(IgnoreRequest):
+        retry_middleware.process_response(first, response, spider)
+    assert crawler.stats.get_value("soft_retry/waiting") == 1
+
+    # only the retry of the first page is left, waiting for its delay
+    with pytest.raises(DontCloseSpider):
+        retry_middleware.spider_idle(spider)
+    frontier.spider_idle(spider)
+    assert frontier.in_flight == {1}
+    assert not crawler.engine.requests
+    assert frontier.failures == 0
+
+    # the retry is cancelled, e.g. when the spider is closed: the page is lost and the window filled again
+    retry_middleware.spider_closed(spider)
+    assert crawler.stats.get_value("soft_retry/waiting") == 0
+    with pytest.raises(DontCloseSpider):
+        frontier.spider_idle(spider)
+    assert frontier.failures == 1
+    assert frontier.in_flight == {2}
+    assert [request.meta["frontier_page"] for request in crawler.engine.requests] == [2]
+
+
+def test_retried_page_done_once(crawler):
+    spider = crawler.spider
+    frontier = PageFrontier(spider, range(1, 3), page_request, window=1)
+    (first,) = frontier.start()
+    # the retry keeps the meta of the request, and the page its place in the window
+    retry = first.replace(dont_filter=True)
+    assert frontier.done(retry)[0].meta["frontier_page"] == 2
+    assert frontier.completed == 1
+    assert not frontier.done(first)
+    assert frontier.completed == 1
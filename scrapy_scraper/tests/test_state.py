@@ -0,0 +1,65 @@
+import pytest
+
+from scrapy_scraper.state import TransactionIdSet, encode_transaction_id
+
+
+def test_encode_transaction_id_packs_registry_and_number():
+    assert encode_transaction_id("EU764117") == encode_transaction_id("EU764117")
+    assert encode_transaction_id("EU764117") != encode_transaction_id("GB764117")
+    assert encode_transaction_id("EU764117") < 1 << 62
+
+
+def test_encode_transaction_id_keeps_leading_zeros_apart():
+    assert encode_transaction_id("EU0764117") != encode_transaction_id("EU764117")
+    assert encode_transaction_id("EU0764117") >= 1 << 62
+
+
+def test_encode_transaction_id_hashes_other_ids():
+    assert encode_transaction_id("not an id") >= 1 << 62
+    assert encode_transaction_id("not an id") != encode_transaction_id("not an id either")
+
+
+def test_add():
+    ids = TransactionIdSet()
+    assert ids.add("EU764117")
+    assert not ids.add("EU764117")
+    assert ids.add("EU0764117")
+    assert "EU764117" in ids
+    assert "EU0764117" in ids
+    assert "EU764118" not in ids
+    assert len(ids) == 2
+
+
+def test_merge_keeps_the_ids_sorted():
+    ids = TransactionIdSet()
+    for number in (5, 1, 9):
+        ids.add(f"EU{number}")
+    ids._merge()
+    for number in (7, 3, 11, 1):
+        ids.add(f"EU{number}")
+    ids._merge()
+    assert list(ids._ids) == sorted(ids._ids)
+    assert len(ids) == 6
+    assert all(f"EU{number}" in ids for number in (1, 3, 5, 7, 9, 11))
+    assert "EU4" not in ids
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "ids.bin")
+    ids = TransactionIdSet(path)
+    for transaction_id in ("EU764117", "EU0764117", "GB1", "not an id"):
+        ids.add(transaction_id)
+    ids.save()
+
+    loaded = TransactionIdSet(path)
+    assert len(loaded) == 4
+    assert all(transaction_id in loaded for transaction_id in ("EU764117", "EU0764117", "GB1", "not an id"))
+    assert not loaded.add("GB1")
+    assert loaded.add("GB2")
+
+
+def test_save_without_path():
+    ids = TransactionIdSet()
+    ids.add("EU1")
+    with pytest.raises(ValueError, match="no path to save to"):
+        ids.save()